@@ -0,0 +1,129 @@
+"""
+Process-wide registry of boto region connections.
+
+Connecting to a region is cheap in itself, however every new connection has
+to resolve the endpoint and perform a new TLS handshake on its first request.
+The :obj:`connection_registry` makes sure we reuse connections for every
+lookup in the same region, even across many hosts in a single awsfab run.
+"""
+from os import getpid
+from time import time
+from threading import Lock, current_thread, enumerate as enumerate_threads
+
+from awsfabrictasks.conf import awsfab_settings
+
+
+
+def _get_connect_to_region(service):
+    if service == 'ec2':
+        from boto.ec2 import connect_to_region
+    elif service == 'rds':
+        from boto.rds import connect_to_region
+    else:
+        raise ValueError('Unsupported service: {0}'.format(service))
+    return connect_to_region
+
+
+class ConnectionRegistry(object):
+    """
+    Hands out reusable region connections keyed by
+    ``(service, region, credentials)``.
+
+    boto connections are not safe to share between threads (or between
+    processes forked by ``fabric.decorators.parallel``), so connections are
+    per thread: each thread gets its own connection for each key. The
+    connections of threads that have exited are closed and evicted on the next
+    call to :meth:`get_connection` or :meth:`evict_idle`, so short-lived
+    worker threads do not leak connections. Connections not used for
+    ``awsfab_settings.CONNECTION_MAX_IDLE`` seconds are closed and evicted.
+    """
+    def __init__(self, connect=_get_connect_to_region, clock=time):
+        """
+        :param connect:
+            Callable that takes a service name (E.g.: ``"ec2"``), and returns
+            the ``connect_to_region`` function for the service.
+        :param clock:
+            Callable returning the current time in seconds.
+        """
+        self.connect = connect
+        self.clock = clock
+        self._lock = Lock()
+        self._connections = {}
+
+    def _get_key(self, service, region):
+        credentials = tuple(sorted(awsfab_settings.AUTH.items()))
+        return (service, region, credentials, getpid(), current_thread().ident)
+
+    def get_connection(self, service, region):
+        """
+        Get a connection to ``region`` for the given ``service``. Reuses the
+        connection from an earlier call in the same thread if possible.
+
+        :param service: One of ``"ec2"`` or ``"rds"``.
+        :param region: Name of a region.
+        :return:
+            The connection, or ``None`` if ``connect_to_region`` does not know
+            the region (failed connections are not cached).
+        """
+        key = self._get_key(service, region)
+        now = self.clock()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._connections.get(key)
+            if entry:
+                entry[1] = now
+                return entry[0]
+        connection = self.connect(service)(region_name=region, **awsfab_settings.AUTH)
+        if connection:
+            with self._lock:
+                self._connections[key] = [connection, now]
+        return connection
+
+    def _evict_idle(self, now):
+        max_idle = awsfab_settings.CONNECTION_MAX_IDLE
+        pid = getpid()
+        live_threads = set(thread.ident for thread in enumerate_threads())
+        for key, (connection, last_used) in list(self._connections.items()):
+            thread_exited = key[3] == pid and not key[4] in live_threads
+            if thread_exited or now - last_used > max_idle:
+                del self._connections[key]
+                self._close(connection)
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def evict_idle(self):
+        """
+        Close and forget all connections that have been idle for more than
+        ``awsfab_settings.CONNECTION_MAX_IDLE`` seconds, and all connections
+        belonging to threads that have exited.
+        """
+        with self._lock:
+            self._evict_idle(self.clock())
+
+    def clear(self):
+        """
+        Close and forget all connections.
+        """
+        with self._lock:
+            connections = self._connections
+            self._connections = {}
+        for connection, last_used in connections.values():
+            self._close(connection)
+
+    def __len__(self):
+        return len(self._connections)
+
+
+#: The process-wide :class:`ConnectionRegistry`.
+connection_registry = ConnectionRegistry()
+
+
+def get_region_connection(service, region):
+    """
+    Shortcut for ``connection_registry.get_connection(service, region)``.
+    """
+    return connection_registry.get_connection(service, region)
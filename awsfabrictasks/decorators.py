@@ -1,6 +1,6 @@
 from functools import wraps
 from fabric.decorators import _wrap_as_new
-from .ec2.api import Ec2InstanceWrapper
+from .ec2.api import resolve_instances
 
 
 try:
@@ -26,20 +26,78 @@ def _list_annotating_decorator(attribute, *values):
     return attach_list
 
 
+class LazyHostsList(list):
+    """
+    A list of hosts that is filled by calling ``resolve()`` the first time
+    it is used. Fabric only uses the ``hosts`` of a task when the task is
+    executed, so this defers any work needed to find the hosts until then.
+    """
+    def __init__(self, resolve):
+        super(LazyHostsList, self).__init__()
+        self._resolve = resolve
+        self._resolved = False
+
+    def resolve(self):
+        """
+        Fill the list (only the first time this is called).
+        """
+        if not self._resolved:
+            self._resolved = True
+            super(LazyHostsList, self).extend(self._resolve())
+        return self
+
+    def __iter__(self):
+        return super(LazyHostsList, self.resolve()).__iter__()
+
+    def __len__(self):
+        return super(LazyHostsList, self.resolve()).__len__()
+
+    def __getitem__(self, index):
+        return super(LazyHostsList, self.resolve()).__getitem__(index)
+
+    def __contains__(self, host):
+        return super(LazyHostsList, self.resolve()).__contains__(host)
+
+    def __eq__(self, other):
+        return super(LazyHostsList, self.resolve()).__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        if not self._resolved:
+            return 'LazyHostsList(<unresolved>)'
+        return super(LazyHostsList, self).__repr__()
+
+    def __bool__(self):
+        return len(self) > 0
+    __nonzero__ = __bool__
+
+
 def ec2instance(nametag=None, instanceid=None, tags=None, region=None):
     """
     Wraps the decorated function to execute as if it had been invoked with
     ``--ec2names`` or ``--ec2ids``.
+
+    The instances are not looked up until the task is executed, so importing
+    the fabfile (E.g.: ``awsfab --list``) does not make any requests to AWS.
+    The lookup is memoized (see
+    :func:`awsfabrictasks.ec2.api.resolve_instances`) for the rest of the
+    process, and shared with ``--ec2names``, ``--ec2ids`` and ``--ec2tags``.
     """
-    instancewrappers = []
-    if instanceid:
-        instancewrappers += [Ec2InstanceWrapper.get_by_instanceid(instanceid)]
-    if nametag:
-        instancewrappers += [Ec2InstanceWrapper.get_by_nametag(nametag)]
-    if tags:
-        instancewrappers += Ec2InstanceWrapper.get_by_tagvalue(tags, region)
     if not (instanceid or nametag or tags):
         raise ValueError('nametag, instanceid, or tags must be supplied.')
 
-    return _list_annotating_decorator('hosts', [instancewrapper['public_dns_name']
-        for instancewrapper in instancewrappers])
+    def resolve():
+        instancewrappers = resolve_instances(instanceids=instanceid and [instanceid] or [],
+                                             names=nametag and [nametag] or [],
+                                             tags=tags, tags_region=region)
+        return [instancewrapper['public_dns_name'] for instancewrapper in instancewrappers]
+
+    def attach_hosts(func):
+        @wraps(func)
+        def inner_decorator(*args, **kwargs):
+            return func(*args, **kwargs)
+        inner_decorator.hosts = LazyHostsList(resolve)
+        return _wrap_as_new(func, inner_decorator)
+    return attach_hosts
@@ -9,6 +9,52 @@ AUTH = {}
 #: The default AWS region to use with the commands where REGION is supported.
 DEFAULT_REGION = 'eu-west-1'
 
+#: Maximum number of regions queried concurrently when an operation spans
+#: more than one region (E.g.: resolving ``--ec2names`` in many regions).
+REGION_WORKERS = 8
+
+#: Number of seconds a region connection may be unused before it is closed
+#: and evicted from :obj:`awsfabrictasks.connections.connection_registry`.
+CONNECTION_MAX_IDLE = 300
+
+#: Maximum number of instances requested in each page when iterating over EC2
+#: instances (see :meth:`awsfabrictasks.ec2.api.Ec2InstanceWrapper.iter_instances`).
+#: AWS accepts values from 5 to 1000.
+EC2_PAGE_SIZE = 500
+
+#: Directory for the EC2 inventory cache used with ``awsfab --ec2-cache``.
+#: Filtered through os.path.expanduser.
+EC2_INVENTORY_CACHE_DIR = '~/.cache/awsfab'
+
+#: Number of seconds a cached EC2 inventory is used by ``awsfab --ec2-cache=use``
+#: before it is fetched again.
+EC2_INVENTORY_CACHE_TTL = 60
+
+#: The default polling policy used when waiting for EC2 instances to change
+#: state (E.g.: when starting, stopping and launching instances). The keys are
+#: arguments for :class:`awsfabrictasks.ec2.api.PollingPolicy`:
+#:
+#:     timeout --- Give up after this many seconds.
+#:     initial_interval --- Seconds to sleep before the second poll.
+#:     multiplier --- Multiply the interval with this after each poll ...
+#:     max_interval --- ... until it reaches this many seconds.
+#:     jitter --- Randomize each sleep by up to +/- this fraction.
+#:     state_hints --- Dict of the number of seconds we expect the transition
+#:                     into each state to take. ``"ssh"`` is used when waiting
+#:                     for SSH to accept connections after an instance is running.
+EC2_WAIT_POLICY = {'timeout': 600,
+                   'initial_interval': 2,
+                   'multiplier': 1.5,
+                   'max_interval': 15,
+                   'jitter': 0.2,
+                   'state_hints': {'stopped': 30,
+                                   'running': 40,
+                                   'ssh': 20}}
+
+#: Maximum number of instances probed concurrently when waiting for SSH
+#: (see :func:`awsfabrictasks.ec2.api.wait_for_ssh`).
+SSH_PROBE_WORKERS = 20
+
 #: Default ssh user if the ``awsfab-ssh-user`` tag is not set
 EC2_INSTANCE_DEFAULT_SSHUSER = 'root'
 
@@ -20,6 +66,23 @@ KEYPAIR_PATH = ['.', '~/.ssh/']
 #: Extra SSH arguments. Used with ``ssh`` and ``rsync``.
 EXTRA_SSH_ARGS = '-o StrictHostKeyChecking=no'
 
+#: Maximum number of concurrent rsync processes when syncing many EC2
+#: instances at once (E.g.: ``ec2_rsync_upload_dir:fanout=true``).
+RSYNC_WORKERS = 10
+
+#: Number of seconds (or an ssh time format like ``"10m"``) to keep a shared
+#: SSH master connection open after the last ``ec2_login`` or rsync to an EC2
+#: instance exits. Later logins and rsyncs to the same instance reuse the
+#: connection instead of making a new one (see ``ControlMaster`` and
+#: ``ControlPersist`` in ssh_config(5)). The master connections keep running
+#: in the background after awsfab exits. Close them with the
+#: ``ec2_close_ssh_connections`` task. Disabled when ``None`` (the default).
+SSH_CONTROL_PERSIST = None
+
+#: Directory for the SSH ControlMaster sockets. Filtered through
+#: os.path.expanduser.
+SSH_CONTROL_DIR = '~/.ssh/awsfab-control'
+
 #: Configuration for ec2_launch_instance (see the docs)
 EC2_LAUNCH_CONFIGS = {}
 
@@ -42,3 +105,51 @@ EC2_LAUNCH_CONFIGS = {}
 #:      :meth:`awsfabrictasks.s3.api.S3ConnectionWrapper.get_bucket_using_pattern`,
 #:      :func:`awsfabrictasks.s3.api.settingsformat_bucketname`
 S3_BUCKET_PATTERN = '{bucketname}'
+
+#: Number of worker threads used by ``s3_syncupload_dir`` and
+#: ``s3_syncdownload_dir`` to compare and transfer files concurrently. Each
+#: worker uses its own S3 connection. Override with the ``workers`` argument.
+S3_SYNC_WORKERS = 8
+
+#: Files larger than this number of bytes are uploaded to S3 in parts (using
+#: multipart upload), with the parts uploaded concurrently. Set to ``None`` to
+#: always upload files with a single request.
+S3_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+
+#: Size of each part in a multipart upload in bytes. S3 requires at least
+#: 5MB (smaller values are increased to 5MB), and at most 10000 parts (the
+#: part size is increased for files that would need more parts).
+S3_MULTIPART_PARTSIZE = 16 * 1024 * 1024
+
+#: Maximum number of parts uploaded concurrently in a multipart upload.
+S3_MULTIPART_WORKERS = 4
+
+#: Number of times to retry uploading a part of a multipart upload before
+#: the upload is aborted.
+S3_MULTIPART_RETRIES = 3
+
+#: S3 keys larger than this number of bytes are downloaded in byte ranges
+#: fetched concurrently. Set to ``None`` to always download keys with a single
+#: request.
+S3_RANGED_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+
+#: Size of each byte range in a ranged download.
+S3_RANGED_DOWNLOAD_PARTSIZE = 16 * 1024 * 1024
+
+#: Maximum number of byte ranges downloaded concurrently.
+S3_RANGED_DOWNLOAD_WORKERS = 4
+
+#: Number of times to retry downloading a byte range before the download
+#: fails.
+S3_RANGED_DOWNLOAD_RETRIES = 3
+
+#: SQLite database used to cache the checksums of local files compared with S3
+#: by ``s3_syncupload_dir``, ``s3_syncdownload_dir`` and ``s3_is_same_file``.
+#: Files with the same path, size, modification time and inode as when they
+#: were hashed are not read again. Filtered through os.path.expanduser. Set to
+#: ``None`` to disable the cache.
+S3_CHECKSUM_CACHE = '~/.cache/awsfab/checksums.sqlite'
+
+#: Cached checksums not used for this number of seconds are evicted from
+#: ``S3_CHECKSUM_CACHE``.
+S3_CHECKSUM_CACHE_MAX_AGE = 30 * 24 * 60 * 60
@@ -1,13 +1,34 @@
 from __future__ import print_function, unicode_literals
 
-from os.path import exists, join, expanduser, abspath
+from os import makedirs, listdir, remove, devnull
+from os.path import exists, join, expanduser, abspath, dirname, basename
+from subprocess import call
+import socket
+from hashlib import sha1
+try:
+    from shlex import quote as shellquote
+except ImportError:
+    from pipes import quote as shellquote
+from time import time, sleep
+from random import uniform
+from threading import Lock
 from warnings import warn
 from pprint import pformat
-from boto.ec2 import connect_to_region
-from fabric.api import local, env, abort
+from boto.ec2 import regions as get_regions
+from fabric.api import local, env, abort, settings, hide
 
 from awsfabrictasks.conf import awsfab_settings
+from awsfabrictasks.connections import get_region_connection
 from awsfabrictasks.utils import rsyncformat_path
+from awsfabrictasks.utils import iter_parallel
+from awsfabrictasks.utils import thread_pool
+from awsfabrictasks.utils import run_local_commands
+from awsfabrictasks.utils import LocalCommandResult
+from awsfabrictasks.utils import force_slashend
+from awsfabrictasks.utils import force_noslashend
+from awsfabrictasks.ec2.inventory import Ec2InventoryCache
+from awsfabrictasks.ec2.inventory import instance_from_dict
+from awsfabrictasks.ec2.inventory import invalidate_region
 
 def zipit(ss):
     """
@@ -26,6 +47,77 @@ def zipit(ss):
     f.close()
     return out.getvalue()
 
+def get_ssh_control_path(ssh_uri):
+    """
+    Get the path of the SSH ControlMaster socket for the given SSH URI. The
+    sockets are stored in ``awsfab_settings.SSH_CONTROL_DIR``, and named by a
+    hash of ``ssh_uri`` to stay within the socket path length limit.
+    """
+    controldir = expanduser(awsfab_settings.SSH_CONTROL_DIR)
+    urihash = sha1(ssh_uri.encode('utf-8')).hexdigest()[:20]
+    return join(controldir, '{0}.sock'.format(urihash))
+
+def get_ssh_control_args(ssh_uri):
+    """
+    Get the ssh arguments that make ssh share a single master connection to
+    ``ssh_uri`` (see ``ControlMaster`` in ssh_config(5)), or an empty string if
+    ``awsfab_settings.SSH_CONTROL_PERSIST`` is ``None``. Creates
+    ``awsfab_settings.SSH_CONTROL_DIR`` if it does not exist.
+    """
+    persist = awsfab_settings.SSH_CONTROL_PERSIST
+    if persist is None:
+        return ''
+    controlpath = get_ssh_control_path(ssh_uri)
+    controldir = dirname(controlpath)
+    if not exists(controldir):
+        try:
+            makedirs(controldir, 0o700)
+        except OSError:
+            if not exists(controldir):
+                raise
+    return ('-o ControlMaster=auto -o ControlPath={controlpath} '
+            '-o ControlPersist={persist}').format(**vars())
+
+def get_extra_ssh_args(ssh_uri):
+    """
+    Get :func:`get_ssh_control_args` followed by
+    ``awsfab_settings.EXTRA_SSH_ARGS``. Used with ``ssh`` and ``rsync``.
+    """
+    control_args = get_ssh_control_args(ssh_uri)
+    return ' '.join(args for args in (control_args, awsfab_settings.EXTRA_SSH_ARGS) if args)
+
+def close_ssh_control_master(controlpath):
+    """
+    Ask the ssh master listening on ``controlpath`` to exit, and remove the
+    socket if it is stale.
+
+    :return: ``True`` if the socket existed.
+    """
+    if not exists(controlpath):
+        return False
+    with settings(hide('everything'), warn_only=True):
+        local('ssh -O exit -o ControlPath={controlpath} awsfab'.format(**vars()))
+    if exists(controlpath):
+        remove(controlpath)
+    return True
+
+def close_all_ssh_control_masters():
+    """
+    Run :func:`close_ssh_control_master` for all the sockets in
+    ``awsfab_settings.SSH_CONTROL_DIR``.
+
+    :return: The number of sockets closed.
+    """
+    controldir = expanduser(awsfab_settings.SSH_CONTROL_DIR)
+    if not exists(controldir):
+        return 0
+    closed = 0
+    for filename in sorted(listdir(controldir)):
+        if filename.endswith('.sock'):
+            if close_ssh_control_master(join(controldir, filename)):
+                closed += 1
+    return closed
+
 def ec2_rsync_upload_command(instancewrapper, local_dir, remote_dir,
                              rsync_args='-av', sync_content=False):
     """
@@ -36,7 +128,7 @@ def ec2_rsync_upload_command(instancewrapper, local_dir, remote_dir,
     """
     ssh_uri = instancewrapper.get_ssh_uri()
     key_filename = instancewrapper.get_ssh_key_filename()
-    extra_ssh_args = awsfab_settings.EXTRA_SSH_ARGS
+    extra_ssh_args = get_extra_ssh_args(ssh_uri)
     local_dir = rsyncformat_path(local_dir, sync_content)
     rsync_cmd = ('rsync {rsync_args} -e "ssh -i {key_filename} {extra_ssh_args}" '
                  '{local_dir} {ssh_uri}:{remote_dir}').format(**vars())
@@ -75,7 +167,7 @@ def ec2_rsync_download_command(instancewrapper, remote_dir, local_dir,
     """
     ssh_uri = instancewrapper.get_ssh_uri()
     key_filename = instancewrapper.get_ssh_key_filename()
-    extra_ssh_args = awsfab_settings.EXTRA_SSH_ARGS
+    extra_ssh_args = get_extra_ssh_args(ssh_uri)
     remote_dir = rsyncformat_path(remote_dir, sync_content)
     rsync_cmd = ('rsync {rsync_args} -e "ssh -i {key_filename} {extra_ssh_args}" '
                  '{ssh_uri}:{remote_dir} {local_dir}').format(**vars())
@@ -97,6 +189,166 @@ def ec2_rsync_download(remote_dir, local_dir, rsync_args='-av', sync_content=Fal
                                            rsync_args, sync_content)
     local(rsync_cmd)
 
+def ec2_rsync_upload_many(instancewrappers, local_dir, remote_dir, rsync_args='-av',
+                          sync_content=False, workers=None):
+    """
+    rsync ``local_dir`` into ``remote_dir`` on many EC2 instances
+    concurrently. The commands are created with
+    :func:`ec2_rsync_upload_command`, and run with
+    :func:`awsfabrictasks.utils.run_local_commands`, so the output of each
+    command is prefixed with the ssh URI of the instance.
+
+    :param instancewrappers: Iterable of :class:`Ec2InstanceWrapper` objects.
+    :param workers:
+        Maximum number of concurrent rsync processes. Defaults to
+        ``awsfab_settings.RSYNC_WORKERS``.
+    :return:
+        List of :class:`awsfabrictasks.utils.LocalCommandResult` objects (one
+        for each instance) labeled with the ssh URI of the instance.
+
+    See :func:`ec2_rsync_upload` for the rest of the parameters.
+    """
+    commands = [(instancewrapper.get_ssh_uri(),
+                 ec2_rsync_upload_command(instancewrapper, local_dir, remote_dir,
+                                          rsync_args, sync_content))
+                for instancewrapper in instancewrappers]
+    return run_local_commands(commands, workers=workers or awsfab_settings.RSYNC_WORKERS)
+
+def ec2_rsync_download_many(instancewrappers, remote_dir, local_dir, rsync_args='-av',
+                            sync_content=False, workers=None):
+    """
+    Just like :func:`ec2_rsync_upload_many`, except that it downloads
+    ``remote_dir`` from each instance using
+    :func:`ec2_rsync_download_command`. To avoid that the instances overwrite
+    each other, each instance is downloaded into ``<local_dir>/<instance-id>/``.
+    """
+    commands = []
+    for instancewrapper in instancewrappers:
+        host_local_dir = join(local_dir, instancewrapper['id'])
+        if not exists(host_local_dir):
+            makedirs(host_local_dir)
+        commands.append((instancewrapper.get_ssh_uri(),
+                         ec2_rsync_download_command(instancewrapper, remote_dir, host_local_dir,
+                                                    rsync_args, sync_content)))
+    return run_local_commands(commands, workers=workers or awsfab_settings.RSYNC_WORKERS)
+
+def ec2_rsync_peer_command(source, target, remote_path, rsync_args='-av'):
+    """
+    Returns a command that, when run on the local host, logs into the
+    ``source`` instance and rsyncs the contents of ``remote_path`` on
+    ``source`` into ``remote_path`` on the ``target`` instance over the
+    private network (see :meth:`Ec2InstanceWrapper.get_private_ssh_uri`). The
+    data never passes through the local host.
+
+    The login to ``source`` forwards the local ssh agent (``ssh -A``), so the
+    key for ``target`` must be added to the agent with ``ssh-add``.
+
+    :param source: :class:`Ec2InstanceWrapper` that already has ``remote_path``.
+    :param target: :class:`Ec2InstanceWrapper` to copy ``remote_path`` to.
+    """
+    ssh_uri = source.get_ssh_uri()
+    key_filename = source.get_ssh_key_filename()
+    extra_ssh_args = get_extra_ssh_args(ssh_uri)
+    peer_ssh_args = awsfab_settings.EXTRA_SSH_ARGS
+    source_path = force_slashend(remote_path)
+    target_path = '{0}:{1}'.format(target.get_private_ssh_uri(), force_noslashend(remote_path))
+    remote_cmd = shellquote('rsync {rsync_args} -e "ssh {peer_ssh_args}" '
+                            '{source_path} {target_path}'.format(**vars()))
+    return 'ssh -A -i {key_filename} {extra_ssh_args} {ssh_uri} {remote_cmd}'.format(**vars())
+
+def plan_broadcast_round(holders, pending, fanout):
+    """
+    Pair each of the ``holders`` with up to ``fanout`` of the ``pending``
+    targets. Used by :func:`ec2_rsync_broadcast` to plan each round of the
+    broadcast tree.
+
+    :return: ``(pairs, remaining)`` where ``pairs`` is a list of
+        ``(holder, target)`` tuples, and ``remaining`` is the list of pending
+        targets not included in any pair.
+    """
+    pairs = []
+    pending = list(pending)
+    for index in range(fanout):
+        for holder in holders:
+            if not pending:
+                return pairs, pending
+            pairs.append((holder, pending.pop(0)))
+    return pairs, pending
+
+def _group_instancewrappers_by_network(instancewrappers):
+    groups = {}
+    for instancewrapper in instancewrappers:
+        key = (instancewrapper.get_region_name(), instancewrapper['vpc_id'])
+        groups.setdefault(key, []).append(instancewrapper)
+    return [groups[key] for key in sorted(groups, key=repr)]
+
+def ec2_rsync_broadcast(instancewrappers, local_dir, remote_dir, rsync_args='-av',
+                        sync_content=False, fanout=2, workers=None):
+    """
+    Upload ``local_dir`` into ``remote_dir`` on many EC2 instances while only
+    uploading it once from the local host.
+
+    The instances are grouped by region and VPC (instances can only reach
+    each other over private IPs within the same network). In each group,
+    ``local_dir`` is uploaded to one seed instance with
+    :func:`ec2_rsync_upload_command`. Each instance that has the directory
+    then copies it to ``fanout`` other instances with
+    :func:`ec2_rsync_peer_command`, round by round, until all instances have
+    it. With ``fanout=2``, 200 instances are done in 5 rounds after the seed
+    upload. Instances that fail are not used as sources, and every other
+    instance is still tried.
+
+    :param instancewrappers: Iterable of :class:`Ec2InstanceWrapper` objects.
+    :param fanout: Number of instances each instance copies to in each round.
+    :param workers:
+        Maximum number of concurrent rsync processes. Defaults to
+        ``awsfab_settings.RSYNC_WORKERS``.
+    :return:
+        List of :class:`awsfabrictasks.utils.LocalCommandResult` objects (one
+        for each instance) labeled with the ssh URI of the instance.
+
+    See :func:`ec2_rsync_upload` for the rest of the parameters.
+    """
+    workers = workers or awsfab_settings.RSYNC_WORKERS
+    if sync_content:
+        target_dir = remote_dir
+    else:
+        target_dir = join(remote_dir, basename(force_noslashend(local_dir)))
+    groups = _group_instancewrappers_by_network(instancewrappers)
+
+    results = []
+    holders = []
+    pending = []
+    seeds = [group[0] for group in groups]
+    seedresults = ec2_rsync_upload_many(seeds, local_dir, remote_dir, rsync_args,
+                                        sync_content, workers)
+    results.extend(seedresults)
+    for group, seedresult in zip(groups, seedresults):
+        if seedresult.succeeded():
+            holders.append([group[0]])
+            pending.append(group[1:])
+        else:
+            for instancewrapper in group[1:]:
+                results.append(LocalCommandResult(instancewrapper.get_ssh_uri(), None, None, 0,
+                                                  error='seed {0} failed'.format(seedresult.label)))
+
+    while any(pending):
+        commands = []
+        targets = []
+        for index, groupholders in enumerate(holders):
+            pairs, pending[index] = plan_broadcast_round(groupholders, pending[index],
+                                                         int(fanout))
+            for source, target in pairs:
+                commands.append((target.get_ssh_uri(),
+                                 ec2_rsync_peer_command(source, target, target_dir, rsync_args)))
+                targets.append((index, target))
+        roundresults = run_local_commands(commands, workers=workers)
+        results.extend(roundresults)
+        for (index, target), result in zip(targets, roundresults):
+            if result.succeeded():
+                holders[index].append(target)
+    return results
+
 
 def _parse_instanceident(instanceid_with_optional_region):
     if ':' in instanceid_with_optional_region:
@@ -127,6 +379,57 @@ def parse_instancename(instancename_with_optional_region):
     """
     return _parse_instanceident(instancename_with_optional_region)
 
+def parse_regionlist(regionlist):
+    """
+    Parse a comma-separated list of region names. ``"all"`` means all the
+    EC2 regions.
+
+    :return: A list of region names.
+    """
+    if regionlist == 'all':
+        return sorted(region.name for region in get_regions(**awsfab_settings.AUTH))
+    return [region.strip() for region in regionlist.split(',') if region.strip()]
+
+def parse_filterlist(filterlist, nameprefix=''):
+    """
+    Parse a comma-separated list of ``name=value`` pairs into a dict of EC2
+    filters (see the ``DescribeInstances`` documentation for the available
+    filter names). Separate values with ``|`` to match any of them. Values
+    may be empty, which matches an empty value (E.g.: ``tag:role=`` matches
+    instances with an empty ``role``-tag).
+
+    Example::
+
+        >>> parse_filterlist('instance-state-name=running,tag:role=web|worker')
+        {'instance-state-name': 'running', 'tag:role': ['web', 'worker']}
+        >>> parse_filterlist('role=web|worker', nameprefix='tag:')
+        {'tag:role': ['web', 'worker']}
+
+    :param filterlist: The string to parse. ``None`` and ``""`` is allowed.
+    :param nameprefix:
+        Prefixed to each filter name. Use ``"tag:"`` to parse ``tag=value``
+        pairs.
+    :raise ValueError:
+        If any of the pairs does not contain ``=``, or has an empty name.
+    :return: A dict of filters.
+    """
+    filters = {}
+    for pair in (filterlist or '').split(','):
+        if not pair.strip():
+            continue
+        if not '=' in pair:
+            raise ValueError('Invalid filter: {0!r}. Use name=value.'.format(pair))
+        name, value = pair.split('=', 1)
+        name = name.strip()
+        if not name:
+            raise ValueError('Invalid filter: {0!r}. The name is empty.'.format(pair))
+        values = value.split('|')
+        if len(values) == 1:
+            filters[nameprefix + name] = value
+        else:
+            filters[nameprefix + name] = values
+    return filters
+
 
 class Ec2RegionConnectionError(Exception):
     """
@@ -196,6 +499,15 @@ class Ec2InstanceWrapper(object):
         """
         return self.instance.state == 'stopped'
 
+    def get_region_name(self):
+        """
+        Get the name of the region containing the instance. Falls back to
+        ``awsfab_settings.DEFAULT_REGION`` if the instance does not know its
+        region.
+        """
+        region = getattr(self.instance, 'region', None)
+        return region and region.name or awsfab_settings.DEFAULT_REGION
+
     def prettyname(self):
         """
         Return a pretty-formatted name for this instance, using the Name-tag if
@@ -218,6 +530,18 @@ class Ec2InstanceWrapper(object):
         host = self['public_dns_name']
         return '{user}@{host}'.format(**vars())
 
+    def get_private_ssh_uri(self):
+        """
+        Just like :meth:`get_ssh_uri`, however it uses the private IP address
+        of the instance. Only reachable from within the VPC/network of the
+        instance.
+
+        :return: "<instance.tags['awsfab-ssh-user']>@<instance.private_ip_address>"
+        """
+        user = self['tags'].get('awsfab-ssh-user', awsfab_settings.EC2_INSTANCE_DEFAULT_SSHUSER)
+        host = self['private_ip_address']
+        return '{user}@{host}'.format(**vars())
+
     def get_ssh_key_filename(self):
         """
         Get the SSH indentify filename (.pem-file) for the instance. Searches
@@ -248,6 +572,23 @@ class Ec2InstanceWrapper(object):
         if not key_filename in env.key_filename:
             env.key_filename.append(key_filename)
 
+    @classmethod
+    def get_connection(cls, region=None):
+        """
+        Connect to the given region, and return the connection. The
+        connection is reused for later calls (see
+        :mod:`awsfabrictasks.connections`).
+
+        :param region:
+            Defaults to ``awsfab_settings.DEFAULT_REGION`` if ``None``.
+        :raise Ec2RegionConnectionError: If connecting to the region fails.
+        """
+        region = region is None and awsfab_settings.DEFAULT_REGION or region
+        connection = get_region_connection('ec2', region)
+        if not connection:
+            raise Ec2RegionConnectionError(region)
+        return connection
+
     @classmethod
     def get_by_nametag(cls, instancename_with_optional_region):
         """
@@ -262,9 +603,7 @@ class Ec2InstanceWrapper(object):
         :return: A :class:`Ec2InstanceWrapper` contaning the requested instance.
         """
         region, name = parse_instancename(instancename_with_optional_region)
-        connection = connect_to_region(region_name=region, **awsfab_settings.AUTH)
-        if not connection:
-            raise Ec2RegionConnectionError(region)
+        connection = cls.get_connection(region)
         reservations = connection.get_all_instances(filters={'tag:Name': name})
         if len(reservations) == 0:
             raise NoInstanceWithNameFound('No ec2 instances with tag:Name={0}'.format(name))
@@ -290,20 +629,55 @@ class Ec2InstanceWrapper(object):
             matching instances.
         """
 
-        region = region is None and awsfab_settings.DEFAULT_REGION or region
-        connection = connect_to_region(region_name=region, **awsfab_settings.AUTH)
-        if not connection:
-            raise Ec2RegionConnectionError(region)
-        tags = dict((('tag:%s' % oldk, v) for (oldk, v) in tags.items()))
-        reservations = connection.get_all_instances(filters=tags)
-        if len(reservations) == 0:
-            return []
+        filters = dict((('tag:%s' % oldk, v) for (oldk, v) in tags.items()))
+        return list(cls.iter_instances(filters=filters, region=region))
 
-        insts = []
-        for r in reservations:
-            for instance in r.instances:
-                insts.append(cls(instance))
-        return insts
+    @classmethod
+    def iter_reservations(cls, filters=None, region=None, page_size=None):
+        """
+        Connect to AWS and iterate over the reservations matching ``filters``.
+
+        The reservations are requested in pages of at most ``page_size``
+        instances, and each reservation is yielded as soon as its page
+        arrives, so callers can start working before all the instances in a
+        large account are retrieved.
+
+        :param filters:
+            Optional dict of EC2 filters (E.g.:
+            ``{'instance-state-name': 'running', 'tag:role': ['web', 'db']}``).
+            See the ``DescribeInstances`` documentation for the available
+            filters.
+        :param region:
+            Defaults to ``awsfab_settings.DEFAULT_REGION`` if ``None``.
+        :param page_size:
+            Maximum number of instances per page. Defaults to
+            ``awsfab_settings.EC2_PAGE_SIZE``.
+        :raise Ec2RegionConnectionError: If connecting to the region fails.
+        """
+        connection = cls.get_connection(region)
+        if page_size is None:
+            page_size = awsfab_settings.EC2_PAGE_SIZE
+        next_token = None
+        while True:
+            reservations = connection.get_all_reservations(filters=filters or None,
+                                                           max_results=page_size,
+                                                           next_token=next_token)
+            for reservation in reservations:
+                yield reservation
+            next_token = getattr(reservations, 'next_token', None)
+            if not next_token:
+                break
+
+    @classmethod
+    def iter_instances(cls, filters=None, region=None, page_size=None):
+        """
+        Just like :meth:`iter_reservations`, however yields a
+        :class:`Ec2InstanceWrapper` for each instance instead of reservations.
+        """
+        for reservation in cls.iter_reservations(filters=filters, region=region,
+                                                 page_size=page_size):
+            for instance in reservation.instances:
+                yield cls(instance)
 
 
     @classmethod
@@ -330,9 +704,7 @@ class Ec2InstanceWrapper(object):
         :return: A :class:`Ec2InstanceWrapper` contaning the requested instance.
         """
         region, instanceid = parse_instanceid(instanceid)
-        connection = connect_to_region(region_name=region, **awsfab_settings.AUTH)
-        if not connection:
-            raise Ec2RegionConnectionError(region)
+        connection = cls.get_connection(region)
         reservations = connection.get_all_instances([instanceid])
         if len(reservations) == 0:
             raise LookupError('No ec2 instances with instanceid={0}'.format(instanceid))
@@ -341,6 +713,88 @@ class Ec2InstanceWrapper(object):
             raise LookupError('Did not get exactly one instance with instanceid={0}'.format(instanceid))
         return cls(reservation.instances[0])
 
+    @classmethod
+    def get_many(cls, instanceids=(), names=(), tags=None, tags_region=None,
+                 cache='off', filters=None):
+        """
+        Get many instances at once. This gives the same result as using
+        :meth:`get_by_instanceid`, :meth:`get_by_nametag` and
+        :meth:`get_by_tagvalue` for each item, however the lookups are grouped
+        by region, each region is queried with a single request for each kind
+        of lookup (see :class:`Ec2RegionLookup`), and the regions are queried
+        concurrently (at most ``awsfab_settings.REGION_WORKERS`` at a time).
+
+        :param instanceids:
+            Iterable of instance IDs. Parsed with :func:`parse_instanceid`.
+        :param names:
+            Iterable of instance names. Parsed with :func:`parse_instancename`.
+        :param tags:
+            Optional dict of tag:value pairs. Works just like
+            :meth:`get_by_tagvalue`. Use a list of values to match any of
+            them.
+        :param tags_region:
+            The region to look for ``tags`` and ``filters`` in. Defaults to
+            ``awsfab_settings.DEFAULT_REGION``.
+        :param cache:
+            The EC2 inventory cache mode. One of the
+            :obj:`awsfabrictasks.ec2.inventory.CACHE_MODES`. Defaults to
+            ``"off"``.
+        :param filters:
+            Optional dict of EC2 filters (see :func:`parse_filterlist`). The
+            filters are AND-ed with ``tags`` in a single request, so only
+            the matching instances are returned by AWS.
+        :raise Ec2RegionConnectionError: If connecting to a region fails.
+        :raise LookupError: If any of the ``instanceids`` is not found.
+        :raise NoInstanceWithNameFound: If any of the ``names`` is not found.
+        :raise MultipleInstancesWithSameNameError:
+            If more than one instance has one of the ``names``.
+        :return:
+            A list of :class:`Ec2InstanceWrapper` objects. Instances matching
+            ``instanceids`` come first, then ``names``, and then ``tags``.
+            Instances matching ``tags`` and ``filters`` come last. Instances
+            selected more than once are only included once.
+        """
+        inventory = Ec2InventoryCache(cache)
+        lookups = {}
+        def get_lookup(region):
+            if not region in lookups:
+                lookups[region] = Ec2RegionLookup(region, wrapperclass=cls,
+                                                  inventory=inventory)
+            return lookups[region]
+
+        parsed_instanceids = [parse_instanceid(instanceid) for instanceid in instanceids]
+        for region, instanceid in parsed_instanceids:
+            get_lookup(region).instanceids.add(instanceid)
+        parsed_names = [parse_instancename(name) for name in names]
+        for region, name in parsed_names:
+            get_lookup(region).names.add(name)
+        if tags or filters:
+            tags_region = tags_region is None and awsfab_settings.DEFAULT_REGION or tags_region
+            get_lookup(tags_region).tags = tags or {}
+            get_lookup(tags_region).filters = filters or {}
+
+        for lookup, result, error in iter_parallel(lambda lookup: lookup.perform(),
+                                                   lookups.values(),
+                                                   workers=awsfab_settings.REGION_WORKERS):
+            if error:
+                raise error
+
+        instancewrappers = []
+        seen_instanceids = set()
+        def add(instancewrapper):
+            if not instancewrapper['id'] in seen_instanceids:
+                seen_instanceids.add(instancewrapper['id'])
+                instancewrappers.append(instancewrapper)
+
+        for region, instanceid in parsed_instanceids:
+            add(lookups[region].get_by_instanceid(instanceid))
+        for region, name in parsed_names:
+            add(lookups[region].get_by_nametag(name))
+        if tags or filters:
+            for instancewrapper in lookups[tags_region].tagged:
+                add(instancewrapper)
+        return instancewrappers
+
     @classmethod
     def get_from_host_string(cls):
         """
@@ -351,61 +805,732 @@ class Ec2InstanceWrapper(object):
         return env.ec2instances[env.host_string]
 
 
+class Ec2RegionLookup(object):
+    """
+    Looks up many instances within a single region using a single
+    DescribeInstances request for each kind of lookup: one for all the
+    instance IDs, one for all the Name-tags (using a multi-value ``tag:Name``
+    filter), and one for the tag:value pairs and other filters.
+
+    If an enabled :class:`awsfabrictasks.ec2.inventory.Ec2InventoryCache`
+    is provided, all lookups are made against the cached inventory of the
+    region instead, and the inventory is only fetched (with a single
+    unfiltered request) if it is not cached, or if the cached inventory does
+    not contain all the requested instance IDs and names (E.g.: instances
+    launched after the inventory was cached). IDs and names that still do
+    not exist after fetching are saved with the inventory, so they do not
+    make every later lookup fetch it again. Filters that can not be matched
+    against the cached attributes (see :obj:`.CACHED_FILTERS`) are still
+    sent to AWS.
+
+    Used by :meth:`Ec2InstanceWrapper.get_many`.
+    """
+
+    #: Maps the EC2 filters we can match against cached instances to
+    #: instance attributes. Tag filters (``tag:<name>``) are also supported.
+    CACHED_FILTERS = {'instance-id': 'id',
+                      'instance-state-name': 'state',
+                      'instance-type': 'instance_type',
+                      'availability-zone': 'placement',
+                      'vpc-id': 'vpc_id',
+                      'subnet-id': 'subnet_id',
+                      'key-name': 'key_name',
+                      'image-id': 'image_id',
+                      'ip-address': 'ip_address',
+                      'private-ip-address': 'private_ip_address'}
+
+    def __init__(self, region, wrapperclass=Ec2InstanceWrapper, inventory=None):
+        """
+        :param region: The region to look for instances in.
+        :param wrapperclass:
+            The class used to wrap the instances (and to get the connection
+            using its ``get_connection()`` method).
+        :param inventory:
+            A :class:`awsfabrictasks.ec2.inventory.Ec2InventoryCache`
+            object, or ``None``.
+        """
+        self.region = region
+        self.wrapperclass = wrapperclass
+        self.inventory = inventory
+
+        #: Set of instance IDs to look up.
+        self.instanceids = set()
+
+        #: Set of Name-tags to look up.
+        self.names = set()
+
+        #: Dict of tag:value pairs to look up, or ``None``.
+        self.tags = None
+
+        #: Dict of EC2 filters AND-ed with :obj:`.tags`, or ``None``.
+        self.filters = None
+
+        #: Instances matching :obj:`.instanceids` by instance ID.
+        self.by_instanceid = {}
+
+        #: Instances matching :obj:`.names` by Name-tag. The values are lists.
+        self.by_name = {}
+
+        #: Instances matching :obj:`.tags` and :obj:`.filters`.
+        self.tagged = []
+
+    def _get_instancewrappers(self, filters=None):
+        return list(self.wrapperclass.iter_instances(filters=filters, region=self.region))
+
+    def perform(self):
+        """
+        Perform the lookup, and fill :obj:`.by_instanceid`, :obj:`.by_name`
+        and :obj:`.tagged`.
+
+        :raise Ec2RegionConnectionError: If connecting to the region fails.
+        """
+        connection = self.wrapperclass.get_connection(self.region)
+        if self.inventory and self.inventory.is_enabled():
+            self._perform_using_inventory(connection)
+            return
+        if self.instanceids:
+            filters = {'instance-id': sorted(self.instanceids)}
+            for instancewrapper in self._get_instancewrappers(filters=filters):
+                self.by_instanceid[instancewrapper['id']] = instancewrapper
+        if self.names:
+            filters = {'tag:Name': sorted(self.names)}
+            for instancewrapper in self._get_instancewrappers(filters=filters):
+                name = instancewrapper['tags'].get('Name')
+                self.by_name.setdefault(name, []).append(instancewrapper)
+        if self.tags or self.filters:
+            self.tagged = self._get_instancewrappers(filters=self.get_filters())
+
+    def get_filters(self):
+        """
+        Get :obj:`.tags` and :obj:`.filters` as a single dict of EC2 filters.
+        """
+        filters = dict((('tag:%s' % k, v) for (k, v) in (self.tags or {}).items()))
+        filters.update(self.filters or {})
+        return filters
+
+    def _perform_using_inventory(self, connection):
+        instances = None
+        instancedicts = self.inventory.load(self.region)
+        if instancedicts is not None:
+            instances = [instance_from_dict(instancedict, connection)
+                         for instancedict in instancedicts]
+            missing_instanceids, missing_names = self._get_missing(instances)
+            if missing_instanceids or missing_names:
+                known_instanceids, known_names = self.inventory.load_missing(self.region)
+                if not (missing_instanceids <= known_instanceids and missing_names <= known_names):
+                    self.inventory.invalidate(self.region)
+                    instances = None
+        if instances is None:
+            instances = [instancewrapper.instance
+                         for instancewrapper in self._get_instancewrappers()]
+            missing_instanceids, missing_names = self._get_missing(instances)
+            self.inventory.save(self.region, instances, missing_instanceids=missing_instanceids,
+                                missing_names=missing_names)
+        filters = self.get_filters()
+        matchlocal = (self.tags or self.filters) and self._can_match_locally(filters)
+        for instance in instances:
+            instancewrapper = self.wrapperclass(instance)
+            if instance.id in self.instanceids:
+                self.by_instanceid[instance.id] = instancewrapper
+            name = instance.tags.get('Name')
+            if name in self.names:
+                self.by_name.setdefault(name, []).append(instancewrapper)
+            if matchlocal and self._matches_filters(instance, filters):
+                self.tagged.append(instancewrapper)
+        if (self.tags or self.filters) and not matchlocal:
+            self.tagged = self._get_instancewrappers(filters=filters)
+
+    def _get_missing(self, instances):
+        instanceids = set(instance.id for instance in instances)
+        names = set(instance.tags.get('Name') for instance in instances)
+        return self.instanceids - instanceids, self.names - names
+
+    def _can_match_locally(self, filters):
+        for name in filters:
+            if not (name.startswith('tag:') or name in self.CACHED_FILTERS):
+                return False
+        return True
+
+    def _matches_filters(self, instance, filters):
+        for name, values in filters.items():
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            if name.startswith('tag:'):
+                value = instance.tags.get(name[4:])
+            else:
+                value = getattr(instance, self.CACHED_FILTERS[name], None)
+            if not value in values:
+                return False
+        return True
+
+    def get_by_instanceid(self, instanceid):
+        """
+        Get the instance with the given ``instanceid`` after :meth:`perform`.
+
+        :raise LookupError: If the instance was not found.
+        """
+        try:
+            return self.by_instanceid[instanceid]
+        except KeyError:
+            raise LookupError('No ec2 instances with instanceid={0}'.format(instanceid))
+
+    def get_by_nametag(self, name):
+        """
+        Get the instance with the given Name-tag after :meth:`perform`.
+
+        :raise NoInstanceWithNameFound: If no instance has the name.
+        :raise MultipleInstancesWithSameNameError: If more than one instance has the name.
+        """
+        instancewrappers = self.by_name.get(name, [])
+        if len(instancewrappers) == 0:
+            raise NoInstanceWithNameFound('No ec2 instances with tag:Name={0}'.format(name))
+        if len(instancewrappers) > 1:
+            raise MultipleInstancesWithSameNameError('More than one ec2 instance with tag:Name={0}'.format(name))
+        return instancewrappers[0]
+
+
+#: Process-wide memo used by :func:`resolve_instances`.
+_resolved_instances = {}
+_resolved_instances_lock = Lock()
+
+def _freeze_filters(filters):
+    return tuple(sorted((name, isinstance(value, (list, tuple)) and tuple(value) or value)
+                        for name, value in (filters or {}).items()))
+
+def resolve_instances(instanceids=(), names=(), tags=None, tags_region=None,
+                      filters=None, cache='off'):
+    """
+    Memoized :meth:`Ec2InstanceWrapper.get_many`. Each instance ID, each
+    name, and each combination of ``tags`` and ``filters`` is only looked up
+    once per process. Later calls reuse the results, and only look up what
+    has not been resolved before. Starting, stopping, launching and tagging
+    instances forget the results for their region (see
+    :func:`invalidate_region_instances`).
+
+    Used to resolve ``--ec2ids``, ``--ec2names``, ``--ec2tags`` and
+    ``--ec2filters`` and the :func:`awsfabrictasks.decorators.ec2instance`
+    decorator, so they share the results.
+
+    Takes the same parameters, and returns the same result as
+    :meth:`Ec2InstanceWrapper.get_many`.
+    """
+    tags_region = tags_region is None and awsfab_settings.DEFAULT_REGION or tags_region
+    idkeys = [('instanceid',) + parse_instanceid(instanceid) for instanceid in instanceids]
+    namekeys = [('name',) + parse_instancename(name) for name in names]
+    tagskey = None
+    if tags or filters:
+        tagskey = ('tags', tags_region, _freeze_filters(tags), _freeze_filters(filters))
+
+    missing_idkeys = [key for key in idkeys if not key in _resolved_instances]
+    missing_namekeys = [key for key in namekeys if not key in _resolved_instances]
+    if missing_idkeys or missing_namekeys:
+        found = Ec2InstanceWrapper.get_many(
+            instanceids=['{1}:{2}'.format(*key) for key in missing_idkeys],
+            names=['{1}:{2}'.format(*key) for key in missing_namekeys],
+            cache=cache)
+        with _resolved_instances_lock:
+            for key in missing_idkeys:
+                _resolved_instances[key] = [instancewrapper for instancewrapper in found
+                                            if instancewrapper['id'] == key[2]]
+            for key in missing_namekeys:
+                matching = [instancewrapper for instancewrapper in found
+                            if instancewrapper['tags'].get('Name') == key[2]]
+                if len(matching) > 1:
+                    matching = [instancewrapper for instancewrapper in matching
+                                if instancewrapper.get_region_name() == key[1]]
+                _resolved_instances[key] = matching
+    if tagskey and not tagskey in _resolved_instances:
+        tagged = Ec2InstanceWrapper.get_many(tags=tags, tags_region=tags_region,
+                                             filters=filters, cache=cache)
+        with _resolved_instances_lock:
+            _resolved_instances[tagskey] = tagged
+
+    instancewrappers = []
+    seen_instanceids = set()
+    for key in idkeys + namekeys + (tagskey and [tagskey] or []):
+        for instancewrapper in _resolved_instances[key]:
+            if not instancewrapper['id'] in seen_instanceids:
+                seen_instanceids.add(instancewrapper['id'])
+                instancewrappers.append(instancewrapper)
+    return instancewrappers
+
+def clear_resolved_instances():
+    """
+    Forget all the instances memoized by :func:`resolve_instances`.
+    """
+    with _resolved_instances_lock:
+        _resolved_instances.clear()
+
+def invalidate_region_instances(region):
+    """
+    Forget the instances in ``region`` memoized by :func:`resolve_instances`,
+    and remove the cached inventory of the region (see
+    :func:`awsfabrictasks.ec2.inventory.invalidate_region`). Use this after
+    starting, stopping, launching or tagging any instance in the region, so
+    later lookups in the same process see the change.
+    """
+    with _resolved_instances_lock:
+        for key in list(_resolved_instances.keys()):
+            if key[1] == region:
+                del _resolved_instances[key]
+    invalidate_region(region)
+
+
+def retry_on_ec2responseerror(function, description, retry_count=4, retry_sleep=2):
+    """
+    Call ``function()``, and retry if it raises
+    :class:`boto.exception.EC2ResponseError`. This is typically needed right
+    after launching instances, since EC2 is eventually consistent, and
+    newly created instances may not be visible to all API calls yet.
+
+    :param function: Callable without arguments.
+    :param description: Description of the operation used in the retry message.
+    :param retry_count: Number of times to retry before re-raising the error.
+    :param retry_sleep: Number of seconds to sleep before each retry.
+    :return: The return value of ``function``.
+    """
+    from boto.exception import EC2ResponseError
+    retries = 0
+    while True:
+        try:
+            return function()
+        except EC2ResponseError:
+            if retries >= retry_count:
+                raise
+            retries += 1
+            print(('Got EC2ResponseError while {description}. Retrying in '
+                   '{retry_sleep} seconds...').format(**vars()))
+            sleep(retry_sleep)
+
+
+def create_tags(region, resource_ids, tags, **retry_kwargs):
+    """
+    Add ``tags`` to all the ``resource_ids`` in ``region`` with a single
+    CreateTags request. Existing tags with the same names are overwritten.
+
+    :param region: The region containing the resources.
+    :param resource_ids: List of resource IDs (E.g.: instance IDs).
+    :param tags: Dict of tag:value pairs.
+    :param retry_kwargs: Forwarded to :func:`retry_on_ec2responseerror`.
+    """
+    connection = Ec2InstanceWrapper.get_connection(region)
+    description = 'adding tags to {0}'.format(', '.join(resource_ids))
+    retry_on_ec2responseerror(lambda: connection.create_tags(list(resource_ids), tags),
+                              description, **retry_kwargs)
+    invalidate_region_instances(region)
+
+
+def delete_tags(region, resource_ids, tagnames, **retry_kwargs):
+    """
+    Remove the tags named ``tagnames`` from all the ``resource_ids`` in
+    ``region`` with a single DeleteTags request.
+
+    :param region: The region containing the resources.
+    :param resource_ids: List of resource IDs (E.g.: instance IDs).
+    :param tagnames: List of tag names.
+    :param retry_kwargs: Forwarded to :func:`retry_on_ec2responseerror`.
+    """
+    connection = Ec2InstanceWrapper.get_connection(region)
+    description = 'removing tags from {0}'.format(', '.join(resource_ids))
+    retry_on_ec2responseerror(lambda: connection.delete_tags(list(resource_ids), list(tagnames)),
+                              description, **retry_kwargs)
+    invalidate_region_instances(region)
+
+
+def _group_instancewrappers_by_region(instancewrappers):
+    regions = {}
+    for instancewrapper in instancewrappers:
+        regions.setdefault(instancewrapper.get_region_name(), []).append(instancewrapper)
+    return regions
+
+def add_tags_to_instances(instancewrappers, tags):
+    """
+    Add ``tags`` to all the given instances using :func:`create_tags` (a
+    single request per region). The ``tags`` of each instance is updated to
+    reflect the change.
+
+    :param instancewrappers: Iterable of :class:`Ec2InstanceWrapper` objects.
+    :param tags: Dict of tag:value pairs.
+    """
+    for region, wrappers in _group_instancewrappers_by_region(instancewrappers).items():
+        create_tags(region, [wrapper['id'] for wrapper in wrappers], tags)
+        for wrapper in wrappers:
+            wrapper.instance.tags.update(tags)
+
+def remove_tags_from_instances(instancewrappers, tagnames):
+    """
+    Remove the tags named ``tagnames`` from all the given instances using
+    :func:`delete_tags` (a single request per region). The ``tags`` of each
+    instance is updated to reflect the change.
+
+    :param instancewrappers: Iterable of :class:`Ec2InstanceWrapper` objects.
+    :param tagnames: List of tag names.
+    """
+    for region, wrappers in _group_instancewrappers_by_region(instancewrappers).items():
+        delete_tags(region, [wrapper['id'] for wrapper in wrappers], tagnames)
+        for wrapper in wrappers:
+            for tagname in tagnames:
+                wrapper.instance.tags.pop(tagname, None)
+
 
 class WaitForStateError(Exception):
     """
-    Raises when :func:`wait_for_state` times out.
+    Raises when :func:`wait_for_state` or :func:`wait_for_states` times out.
+
+    :ivar reached:
+        Dict of the instances that reached the desired state before the
+        timeout (same format as the return value of :func:`wait_for_states`).
+    :ivar pending:
+        List of the instance IDs that did not reach the desired state.
     """
+    def __init__(self, msg, reached=None, pending=None):
+        super(WaitForStateError, self).__init__(msg)
+        self.reached = reached or {}
+        self.pending = pending or []
+
+
+def _poll_instances_in_region(region, instanceids):
+    filters = {'instance-id': sorted(instanceids)}
+    return list(Ec2InstanceWrapper.iter_instances(filters=filters, region=region))
 
 
-def wait_for_state(instanceid, state_name, sleep_intervals=[15, 5], last_sleep_repeat=40):
+class PollingPolicy(object):
     """
-    Poll the instance with ``instanceid`` until its ``state_name`` matches the
+    Decides how long to sleep between each poll when waiting for an instance
+    state (see :func:`wait_for_states`).
+
+    The first poll is made immediately. We then sleep ``initial_interval``
+    seconds before the next poll, and multiply the interval with
+    ``multiplier`` after each poll until it reaches ``max_interval``. Each
+    sleep is randomized by up to ``+/- jitter`` (a fraction of the interval)
+    to avoid polling many instances in lockstep. We give up when ``timeout``
+    seconds have passed since the first poll.
+
+    ``state_hints`` maps state names to the number of seconds we expect the
+    transition into the state to take. For a hinted state, the interval
+    never grows above a quarter of the hint, so we poll at least four times
+    within the expected time instead of oversleeping a fast transition.
+
+    The default policy is configured with ``awsfab_settings.EC2_WAIT_POLICY``
+    (see :meth:`.from_settings`).
+    """
+    def __init__(self, timeout=600, initial_interval=2, multiplier=1.5,
+                 max_interval=15, jitter=0.2, state_hints=None):
+        self.timeout = timeout
+        self.initial_interval = initial_interval
+        self.multiplier = multiplier
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.state_hints = state_hints or {}
+
+    @classmethod
+    def from_settings(cls, **overrides):
+        """
+        Create a policy from ``awsfab_settings.EC2_WAIT_POLICY``. Any
+        ``overrides`` replace the corresponding settings.
+        """
+        kwargs = dict(awsfab_settings.EC2_WAIT_POLICY)
+        kwargs.update(overrides)
+        return cls(**kwargs)
+
+    def get_max_interval(self, state_name=None):
+        """
+        Get the maximum interval between polls when waiting for ``state_name``.
+        """
+        hint = self.state_hints.get(state_name)
+        if hint:
+            return min(self.max_interval, max(self.initial_interval, hint / 4.0))
+        return self.max_interval
+
+    def iter_sleeps(self, state_name=None, clock=time):
+        """
+        Yield the number of seconds to sleep before each poll after the
+        first one. Stops when the ``timeout`` is reached. The last sleep is
+        shortened so the last poll is made at the timeout.
+
+        :param state_name: The state we are waiting for.
+        :param clock: Callable returning the current time in seconds.
+        """
+        deadline = clock() + self.timeout
+        max_interval = self.get_max_interval(state_name)
+        interval = min(self.initial_interval, max_interval)
+        while True:
+            remaining = deadline - clock()
+            if remaining <= 0:
+                return
+            sleep_sec = interval * (1 + uniform(-self.jitter, self.jitter))
+            yield max(0, min(sleep_sec, max_interval, remaining))
+            interval = min(interval * self.multiplier, max_interval)
+
+
+class FixedPollingPolicy(PollingPolicy):
+    """
+    A :class:`PollingPolicy` with a fixed schedule. Used when the deprecated
+    ``sleep_intervals`` and ``last_sleep_repeat`` arguments are given to
+    :func:`wait_for_state`.
+    """
+    def __init__(self, sleep_intervals, last_sleep_repeat=40):
+        """
+        :param sleep_intervals: See :func:`wait_for_state`.
+        :param last_sleep_repeat: See :func:`wait_for_state`.
+        """
+        self.sleep_intervals = list(sleep_intervals) + [sleep_intervals[-1]] * last_sleep_repeat
+        super(FixedPollingPolicy, self).__init__(timeout=sum(self.sleep_intervals))
+
+    def iter_sleeps(self, state_name=None, clock=time):
+        return iter(self.sleep_intervals)
+
+
+def _get_polling_policy(policy, sleep_intervals, last_sleep_repeat):
+    if policy:
+        return policy
+    if sleep_intervals is not None or last_sleep_repeat is not None:
+        warn('sleep_intervals and last_sleep_repeat are deprecated. Use a PollingPolicy instead.',
+             DeprecationWarning)
+        return FixedPollingPolicy(sleep_intervals or [15, 5],
+                                  40 if last_sleep_repeat is None else last_sleep_repeat)
+    return PollingPolicy.from_settings()
+
+
+def wait_for_states(instanceids, state_name, sleep_intervals=None, last_sleep_repeat=None,
+                    policy=None):
+    """
+    Poll all the instances in ``instanceids`` until their state matches the
     desired ``state_name``.
 
+    Each poll makes a single DescribeInstances request per region for all
+    the instances that have not reached the desired state yet (regions are
+    polled concurrently), and instances are dropped from the poll as soon
+    as they reach the desired state.
+
     The first poll is performed without any delay, and the rest of the polls are
-    performed according to ``sleep_intervals``.
+    performed according to ``policy``.
+
+    :param instanceids:
+        Iterable of instance IDs. Parsed with :func:`parse_instanceid`, so
+        they may be prefixed with a region. The same instance given more than
+        once (E.g.: as ``i-123`` and ``<DEFAULT_REGION>:i-123``) is only
+        polled once.
+    :param state_name: The state_name to wait for.
+    :param sleep_intervals: Deprecated. See :func:`wait_for_state`.
+    :param last_sleep_repeat: Deprecated. See :func:`wait_for_state`.
+    :param policy:
+        A :class:`PollingPolicy`. Defaults to
+        :meth:`PollingPolicy.from_settings`.
+    :raise WaitForStateError:
+        If any of the instances does not reach the desired state in time.
+    :return:
+        Dict mapping each of the given ``instanceids`` to an
+        :class:`Ec2InstanceWrapper` for the instance in the desired state.
+    """
+    policy = _get_polling_policy(policy, sleep_intervals, last_sleep_repeat)
+    pending = {}
+    for instanceid_with_optional_region in instanceids:
+        region, instanceid = parse_instanceid(instanceid_with_optional_region)
+        given = pending.setdefault(region, {}).setdefault(instanceid, [])
+        if not instanceid_with_optional_region in given:
+            given.append(instanceid_with_optional_region)
+    max_wait_sec = policy.timeout
+    count = sum(len(ids) for ids in pending.values())
+    print('Waiting for {count} instance(s) to change state to: "{state_name}". Will try for {max_wait_sec}s.'.format(**vars()))
+
+    reached = {}
+    sleeps = policy.iter_sleeps(state_name)
+    with thread_pool(min(awsfab_settings.REGION_WORKERS, len(pending))) as pool:
+        pollnumber = 1
+        while True:
+            current_states = {}
+            polls = iter_parallel(lambda region: _poll_instances_in_region(region, pending[region].keys()),
+                                  list(pending.keys()), pool=pool)
+            for region, instancewrappers, error in polls:
+                if error:
+                    raise error
+                for instancewrapper in instancewrappers:
+                    current_state_name = instancewrapper['state']
+                    if current_state_name == state_name:
+                        for instanceid in pending[region].pop(instancewrapper['id']):
+                            reached[instanceid] = instancewrapper
+                            print('.. {instanceid}: OK'.format(**vars()))
+                    else:
+                        current_states[current_state_name] = current_states.get(current_state_name, 0) + 1
+                if not pending[region]:
+                    del pending[region]
+            if not pending:
+                return reached
+            sleep_sec = next(sleeps, None)
+            if sleep_sec is None:
+                break
+            pollnumber += 1
+            pending_count = sum(len(ids) for ids in pending.values())
+            states = ', '.join('{0}={1}'.format(name, num) for name, num in sorted(current_states.items()))
+            print('.. {pending_count} instance(s) pending. Current states: {states}. Next poll (#{pollnumber}) for "{state_name}"-state in {sleep_sec:.1f}s.'.format(**vars()))
+            sleep(sleep_sec)
+    pending_ids = sorted(instanceid for ids in pending.values()
+                         for given in ids.values() for instanceid in given)
+    raise WaitForStateError('Desired state, "{state_name}", not achieved in {max_wait_sec}s for: {ids}.'.format(ids=', '.join(pending_ids), **vars()),
+                            reached=reached, pending=pending_ids)
+
+
+def wait_for_state(instanceid, state_name, sleep_intervals=None, last_sleep_repeat=None,
+                   policy=None):
+    """
+    Poll the instance with ``instanceid`` until its ``state_name`` matches the
+    desired ``state_name``. Uses :func:`wait_for_states`.
+
+    The first poll is performed without any delay, and the rest of the polls are
+    performed according to ``policy``.
 
     :param instanceid: ID of an instance.
     :param state_name: The state_name to wait for.
-    :param sleep_intervals: List of seconds to wait between each poll for state. The first poll
+    :param sleep_intervals: Deprecated (use ``policy``). List of seconds to wait between each poll for state. The first poll
         is made immediately, then we wait for sleep_intervals[0] seconds before the next poll,
         and repeat for each item in sleep_intervals. Then we repeat for ``last_sleep_repeat``
         using the last item in ``sleep_intervals`` as the timout for each wait.
     :param last_sleep_repeat:
-        Number of times to repeat the last item in ``sleep_intervals``. If this
+        Deprecated (use ``policy``). Number of times to repeat the last item in ``sleep_intervals``. If this
         is 20, we will wait for a maximum of ``sum(sleep_intervals) + sleep_intervals[-1]*20``.
+    :param policy:
+        A :class:`PollingPolicy`. Defaults to
+        :meth:`PollingPolicy.from_settings`.
+    :return: A :class:`Ec2InstanceWrapper` for the instance in the desired state.
     """
-    from time import sleep
-    region, instanceid = parse_instanceid(instanceid)
-    sleep_intervals.extend([sleep_intervals[-1] for x in xrange(last_sleep_repeat)])
-    max_wait_sec = sum(sleep_intervals)
-    print('Waiting for {instanceid} to change state to: "{state_name}". Will try for {max_wait_sec}s.'.format(**vars()))
-
-    sleep_intervals_len = len(sleep_intervals)
-    for index, sleep_sec in enumerate(sleep_intervals):
-        instancewrapper = Ec2InstanceWrapper.get_by_instanceid(instanceid)
-        current_state_name = instancewrapper['state']
-        if current_state_name == state_name:
-            print('.. OK')
-            return
-        index_n1 = index + 1
-        print('.. Current state: "{current_state_name}". Next poll ({index_n1}/{sleep_intervals_len}) for "{state_name}"-state in {sleep_sec}s.'.format(**vars()))
-        sleep(sleep_sec)
-    raise WaitForStateError('Desired state, "{state_name}", not achieved in {max_wait_sec}s.'.format(**vars()))
+    reached = wait_for_states([instanceid], state_name, policy=policy,
+                              sleep_intervals=sleep_intervals,
+                              last_sleep_repeat=last_sleep_repeat)
+    return reached[instanceid]
 
 
 def wait_for_stopped_state(instanceid, **kwargs):
     """
     Shortcut for ``wait_for_state(instanceid, 'stopped', **kwargs)``.
     """
-    wait_for_state(instanceid, 'stopped', **kwargs)
+    return wait_for_state(instanceid, 'stopped', **kwargs)
 
 def wait_for_running_state(instanceid, **kwargs):
     """
     Shortcut for ``wait_for_state(instanceid, 'running', **kwargs)``.
     """
-    wait_for_state(instanceid, 'running', **kwargs)
+    return wait_for_state(instanceid, 'running', **kwargs)
+
+
+class WaitForSshError(WaitForStateError):
+    """
+    Raised by :func:`wait_for_ssh` when any of the instances does not accept
+    SSH connections in time. :obj:`.reached` and :obj:`.pending` works just
+    like for :class:`WaitForStateError`.
+    """
+
+
+def probe_ssh(host, port=22, timeout=3, check_banner=True):
+    """
+    Check if ``host`` accepts TCP connections on ``port``, and, if
+    ``check_banner`` is ``True``, that it responds with an SSH banner
+    (``SSH-...``).
+
+    :param timeout: Timeout in seconds for the connection and the banner.
+    :return: ``True`` if the host is ready.
+    """
+    try:
+        connection = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    try:
+        if not check_banner:
+            return True
+        try:
+            return connection.recv(64).startswith(b'SSH-')
+        except (socket.error, socket.timeout):
+            return False
+    finally:
+        connection.close()
+
+def probe_ssh_login(instancewrapper, timeout=5):
+    """
+    Check if we can log into ``instancewrapper`` with ssh and run ``true``.
+    Uses the same ssh arguments as ``ec2_login``.
+
+    :return: ``True`` if the login succeeded.
+    """
+    ssh_uri = instancewrapper.get_ssh_uri()
+    key_filename = instancewrapper.get_ssh_key_filename()
+    extra_ssh_args = get_extra_ssh_args(ssh_uri)
+    cmd = ('ssh -i {key_filename} {extra_ssh_args} -o BatchMode=yes '
+           '-o ConnectTimeout={timeout} {ssh_uri} true').format(**vars())
+    with open(devnull, 'w') as null:
+        return call(cmd, shell=True, stdout=null, stderr=null) == 0
+
+def _is_ssh_ready(instancewrapper, port, probe_timeout, check_banner, check_login):
+    host = instancewrapper['public_dns_name'] or instancewrapper['ip_address']
+    if not host or not probe_ssh(host, port, probe_timeout, check_banner):
+        return False
+    if check_login:
+        return probe_ssh_login(instancewrapper, probe_timeout)
+    return True
+
+def iter_ssh_ready(instancewrappers, policy=None, port=22, probe_timeout=3,
+                   check_banner=True, check_login=False):
+    """
+    Probe all the ``instancewrappers`` concurrently (at most
+    ``awsfab_settings.SSH_PROBE_WORKERS`` at a time) until they accept SSH
+    connections, and yield each instance as soon as it is ready. The
+    instances should be running (see :func:`wait_for_states`). All the
+    rounds of probes run in the same pool of threads.
+
+    :param instancewrappers: Iterable of :class:`Ec2InstanceWrapper` objects.
+    :param policy:
+        A :class:`PollingPolicy` deciding how long to wait between each round
+        of probes. Defaults to :meth:`PollingPolicy.from_settings`. Uses the
+        ``"ssh"`` state hint.
+    :param port: The SSH port.
+    :param probe_timeout: Timeout in seconds for each probe.
+    :param check_banner: Require an SSH banner (see :func:`probe_ssh`).
+    :param check_login:
+        Also require that we can log in and run a command (see
+        :func:`probe_ssh_login`). Defaults to ``False``.
+    :raise WaitForSshError:
+        If any of the instances is not ready within the timeout of ``policy``.
+    """
+    policy = policy or PollingPolicy.from_settings()
+    pending = dict((instancewrapper['id'], instancewrapper) for instancewrapper in instancewrappers)
+    reached = {}
+    sleeps = policy.iter_sleeps('ssh')
+    with thread_pool(min(awsfab_settings.SSH_PROBE_WORKERS, len(pending))) as pool:
+        while True:
+            probes = iter_parallel(lambda instanceid: _is_ssh_ready(pending[instanceid], port,
+                                                                    probe_timeout, check_banner,
+                                                                    check_login),
+                                   list(pending.keys()), pool=pool)
+            for instanceid, ready, error in probes:
+                if error:
+                    raise error
+                if ready:
+                    instancewrapper = pending.pop(instanceid)
+                    reached[instanceid] = instancewrapper
+                    print('.. {instanceid}: SSH ready'.format(**vars()))
+                    yield instancewrapper
+            if not pending:
+                return
+            sleep_sec = next(sleeps, None)
+            if sleep_sec is None:
+                break
+            print('.. {0} instance(s) not accepting SSH connections yet. Next probe in {1:.1f}s.'.format(
+                len(pending), sleep_sec))
+            sleep(sleep_sec)
+    pending_ids = sorted(pending.keys())
+    raise WaitForSshError('SSH not ready in {timeout}s for: {ids}.'.format(ids=', '.join(pending_ids),
+                                                                         timeout=policy.timeout),
+                          reached=reached, pending=pending_ids)
+
+def wait_for_ssh(instancewrappers, **kwargs):
+    """
+    Wait until all the ``instancewrappers`` accept SSH connections. Takes
+    the same arguments as :func:`iter_ssh_ready`.
+
+    :return: List of the instances in the order they became ready.
+    """
+    instancewrappers = list(instancewrappers)
+    print('Waiting for {0} instance(s) to accept SSH connections.'.format(len(instancewrappers)))
+    return list(iter_ssh_ready(instancewrappers, **kwargs))
 
 
 def print_ec2_instance(instance, full=False, indentspaces=3):
@@ -468,6 +1593,7 @@ class Ec2LaunchInstance(object):
 
         a = Ec2LaunchInstance(extra_tags={'Name': 'a'})
         b = Ec2LaunchInstance(extra_tags={'Name': 'b'})
+        # Checks all the names with a single request per region
         Ec2LaunchInstance.confirm_many([a, b])
         Ec2LaunchInstance.run_many_instances([a, b])
         # Note: that we can start doing stuff with ``a`` and ``b`` that does not
@@ -484,39 +1610,108 @@ class Ec2LaunchInstance(object):
     @classmethod
     def wait_for_running_state_many(cls, launchers, **kwargs):
         """
-        Loop through ``launchers`` and run :func:`wait_for_running_state`.
+        Wait for all the ``launchers`` to reach the running state using
+        :func:`wait_for_states`, which polls all the instances at once.
 
         :param launchers:
             List of Ec2LaunchInstance objects that have been lauched with
             :meth:`Ec2LaunchInstance.run_instance`.
         :param kwargs:
-            Forwarded to :func:`wait_for_running_state`.
+            Forwarded to :func:`wait_for_states`.
+        :return: See :func:`wait_for_states`.
         """
-        for launcher in launchers:
-            wait_for_running_state(launcher.instance.id, **kwargs)
+        instanceids = [launcher.get_instanceid_with_region() for launcher in launchers]
+        return wait_for_states(instanceids, 'running', **kwargs)
+
+    @classmethod
+    def wait_for_ssh_many(cls, launchers, **kwargs):
+        """
+        Wait for all the ``launchers`` to reach the running state (see
+        :meth:`.wait_for_running_state_many`), and then for all of them to
+        accept SSH connections (see :func:`iter_ssh_ready`).
+
+        :param launchers:
+            List of Ec2LaunchInstance objects that have been lauched with
+            :meth:`Ec2LaunchInstance.run_instance`.
+        :param kwargs:
+            Forwarded to :func:`iter_ssh_ready`.
+        :return:
+            Generator yielding an :class:`Ec2InstanceWrapper` for each
+            instance as soon as it accepts SSH connections.
+        """
+        running = cls.wait_for_running_state_many(launchers, policy=kwargs.get('policy'))
+        return iter_ssh_ready(running.values(), **kwargs)
 
     @classmethod
     def run_many_instances(cls, launchers):
         """
-        Loop through ``launchers`` and run :func:`run_instance`.
+        Launch all the ``launchers``, and add the tags to each of the
+        instances (:meth:`.get_all_tags`).
+
+        The names of launchers with :obj:`.duplicate_name_protection` that
+        have not been checked yet are checked first (see
+        :meth:`.check_if_names_exist`).
+
+        Launchers with the same configuration (see :meth:`.get_launch_key`)
+        are launched with a single ``run_instances()`` request using
+        ``min_count`` and ``max_count``, and the groups are launched
+        concurrently (at most ``awsfab_settings.REGION_WORKERS`` at a time).
+        Sets :obj:`.instance` on each launcher.
 
         :param launchers:
             List of Ec2LaunchInstance objects.
-        :param kwargs:
-            Forwarded to :func:`wait_for_running_state`.
+        :raise:
+            The error from the first group that failed to launch. This is
+            raised when all the other groups have completed, so
+            :obj:`.instance` is set on all the launchers that was launched.
         """
+        cls._check_names_once(launchers)
+        groups = {}
         for launcher in launchers:
-            launcher.run_instance()
+            groups.setdefault(launcher.get_launch_key(), []).append(launcher)
+        errors = []
+        for group, result, error in iter_parallel(cls._run_group, list(groups.values()),
+                                                  workers=awsfab_settings.REGION_WORKERS):
+            if error:
+                errors.append(error)
+        if errors:
+            raise errors[0]
 
     @classmethod
-    def confirm_many(cls, launchers):
+    def _run_group(cls, launchers):
+        first = launchers[0]
+        region = first.conf['region']
+        count = len(launchers)
+        connection = Ec2InstanceWrapper.get_connection(region)
+        reservation = connection.run_instances(first.conf['ami'], min_count=count,
+                                               max_count=count, **first.kw)
+        invalidate_region_instances(region)
+        for launcher, instance in zip(launchers, reservation.instances):
+            launcher.instance = instance
+        cls._add_tags(region, launchers)
+
+    @classmethod
+    def confirm_many(cls, launchers, duplicate_name_protection=None):
         """
         Loop through
         Use :meth:`prettyprint` to show the user their choices, and ask
         for confirmation. Runs ``fabric.api.abort()`` if the user does
         not confirm the choices.
+
+        :param duplicate_name_protection:
+            If this is ``True``, run :meth:`.check_if_names_exist` for all
+            the ``launchers`` before asking for confirmation. If this is
+            ``None`` (the default), only check the launchers with
+            :obj:`.duplicate_name_protection`. In both cases, all the names
+            are checked with a single request per region.
         """
         from textwrap import fill
+        if duplicate_name_protection:
+            cls.check_if_names_exist(launchers)
+            for launcher in launchers:
+                launcher._name_checked = True
+        elif duplicate_name_protection is None:
+            cls._check_names_once(launchers)
         print(fill('Are you sure you want to launch (create) the following new instances '
                    'with the following settings and tags?', 80))
         print('-' * 80)
@@ -526,6 +1721,57 @@ class Ec2LaunchInstance(object):
         print('-' * 80)
         Ec2LaunchInstance._confirm('Create instances')
 
+    @classmethod
+    def check_if_names_exist(cls, launchers):
+        """
+        Make sure no EC2 instance exists with the same Name-tag as any of the
+        ``launchers``, and that no two launchers have the same name. Uses
+        :class:`Ec2RegionLookup` to check all the names in each region with
+        a single request (using a multi-value ``tag:Name`` filter), and
+        checks the regions concurrently.
+
+        Runs ``fabric.api.abort()`` listing all the conflicting names if any
+        name is taken.
+        """
+        lookups = {}
+        conflicts = set()
+        for launcher in launchers:
+            name = launcher.get_all_tags().get('Name')
+            if not name:
+                continue
+            region = launcher.conf['region']
+            if not region in lookups:
+                lookups[region] = Ec2RegionLookup(region)
+            if name in lookups[region].names:
+                conflicts.add('{region}:{name} (more than one launcher)'.format(**vars()))
+            lookups[region].names.add(name)
+        if not lookups:
+            return
+        count = sum(len(lookup.names) for lookup in lookups.values())
+        print()
+        print('Making sure no EC2 instance exists with any of the {count} names...'.format(**vars()))
+        for lookup, result, error in iter_parallel(lambda lookup: lookup.perform(),
+                                                   lookups.values(),
+                                                   workers=awsfab_settings.REGION_WORKERS):
+            if error:
+                raise error
+            for name in lookup.by_name:
+                conflicts.add('{region}:{name}'.format(region=lookup.region, name=name))
+        if conflicts:
+            abort('The following instance names are already taken: {0}'.format(
+                ', '.join(sorted(conflicts))))
+        print('OK')
+        print()
+
+    @classmethod
+    def _check_names_once(cls, launchers):
+        unchecked = [launcher for launcher in launchers
+                     if launcher.duplicate_name_protection and not launcher._name_checked]
+        if unchecked:
+            cls.check_if_names_exist(unchecked)
+            for launcher in unchecked:
+                launcher._name_checked = True
+
     @staticmethod
     def _confirm(question):
         if raw_input(question + ' [y/N]? ').lower() != 'y':
@@ -544,6 +1790,8 @@ class Ec2LaunchInstance(object):
         :param configname_help:
             The help to show above the prompt for configname input (only used
             if ``configname`` is ``None``.
+        :param duplicate_name_protection:
+            See :obj:`.duplicate_name_protection`. Defaults to ``True``.
         """
         if not awsfab_settings.EC2_LAUNCH_CONFIGS:
             abort('You have no awsfab_settings.EC2_LAUNCH_CONFIGS.')
@@ -561,13 +1809,19 @@ class Ec2LaunchInstance(object):
         #: See the docs for the __init__ parameter.
         self.configname_help = configname_help
 
+        #: Make sure no EC2 instance exists with the same Name-tag before
+        #: launching. The name is checked once, by the first of
+        #: :meth:`.confirm`, :meth:`.confirm_many`, :meth:`.run_instance` and
+        #: :meth:`.run_many_instances`. The ``*_many`` methods check all the
+        #: launchers with a single request per region.
+        self.duplicate_name_protection = duplicate_name_protection
+        self._name_checked = False
+
         #: The instance launced by :meth:`.run_instance`. None when
         #: run_instance() has not been invoked.
         self.instance = None
 
         self.create_config_ask_if_none()
-        if duplicate_name_protection:
-            self.check_if_name_exists()
 
     def _ask_for_configname(self):
         """
@@ -669,6 +1923,7 @@ class Ec2LaunchInstance(object):
         not confirm the choices.
         """
         from textwrap import fill
+        self._check_names_once([self])
         print(fill('Are you sure you want to launch (create) a new instance '
                    'with the following settings and tags?', 80))
         print('-' * 80)
@@ -676,6 +1931,13 @@ class Ec2LaunchInstance(object):
         print('-' * 80)
         Ec2LaunchInstance._confirm('Create instance')
 
+    def get_instanceid_with_region(self):
+        """
+        Get the ID of the launched instance prefixed with the region
+        (``<region>:<instanceid>``), as parsed by :func:`parse_instanceid`.
+        """
+        return '{0}:{1}'.format(self.conf['region'], self.instance.id)
+
     def run_instance(self):
         """
         Run/launch the configured instance, and add the tags to the instance
@@ -683,26 +1945,48 @@ class Ec2LaunchInstance(object):
 
         :return: The launched instance.
         """
-        connection = connect_to_region(region_name=self.conf['region'], **awsfab_settings.AUTH)
-        reservation = connection.run_instances(self.conf['ami'], **self.kw)
-        instance = reservation.instances[0]
-        self._add_tags(instance)
-        self.instance = instance
-        return instance
+        self._check_names_once([self])
+        self._run_group([self])
+        return self.instance
 
-    def _add_tag(self, instance, tagname, value, retries=0):
-        import time
-        from boto.exception import EC2ResponseError
-        try:
-            instance.add_tag(tagname, value)
-        except EC2ResponseError:
-            if retries > self.tag_retry_count:
-                raise
-            print(('Got EC2ResponseError while adding tag to {id}. Retrying in '
-                   '{sec} seconds...').format(id=instance.id, sec=self.tag_retry_sleep))
-            time.sleep(self.tag_retry_sleep)
-            self._add_tag(instance, tagname, value, retries=retries+1)
-
-    def _add_tags(self, instance):
-        for tagname, value in self.get_all_tags().items():
-            self._add_tag(instance, tagname, value)
+    def get_launch_key(self):
+        """
+        Get a key that is equal for all launchers that can be launched
+        with a single ``run_instances()`` request (the same region, ami and
+        :obj:`.kw`). Used by :meth:`.run_many_instances`.
+
+        The gzipped ``user_data`` in :obj:`.kw` includes a timestamp, so the
+        uncompressed ``user_data`` from the config is used instead.
+        """
+        kw = dict(self.kw)
+        if 'user_data' in kw:
+            kw['user_data'] = self.conf['user_data']
+        return (self.conf['region'], self.conf['ami'], repr(sorted(kw.items())))
+
+    @classmethod
+    def _add_tags(cls, region, launchers):
+        """
+        Add the tags from :meth:`.get_all_tags` to the instances of all the
+        ``launchers`` (all in ``region``). Tags shared by all the launchers
+        are added with a single request, and the rest (typically the Name-tag)
+        with one request per distinct set of tags.
+        """
+        alltags = [launcher.get_all_tags() for launcher in launchers]
+        common = dict((tagname, value) for tagname, value in alltags[0].items()
+                      if all(tags.get(tagname) == value for tags in alltags))
+        requests = []
+        if common:
+            requests.append((common, launchers))
+        rest = {}
+        for launcher, tags in zip(launchers, alltags):
+            launcher_tags = dict((tagname, value) for tagname, value in tags.items()
+                                 if not tagname in common)
+            if launcher_tags:
+                key = repr(sorted(launcher_tags.items()))
+                rest.setdefault(key, (launcher_tags, []))[1].append(launcher)
+        requests.extend(rest.values())
+        for tags, tagged_launchers in requests:
+            create_tags(region, [launcher.instance.id for launcher in tagged_launchers], tags,
+                        retry_count=cls.tag_retry_count, retry_sleep=cls.tag_retry_sleep)
+            for launcher in tagged_launchers:
+                launcher.instance.tags.update(tags)
@@ -0,0 +1,209 @@
+"""
+Persistent, on-disk cache of the EC2 instances in each region.
+
+The cache makes it possible to resolve ``--ec2names``, ``--ec2ids`` and
+``--ec2tags`` without any requests to AWS when the same fleet is used by many
+``awsfab`` invocations within a short time. It is controlled by the
+``--ec2-cache`` option to ``awsfab``:
+
+    off --- Do not use the cache (the default).
+    use --- Use the cached inventory of a region if it is younger than
+            ``awsfab_settings.EC2_INVENTORY_CACHE_TTL`` seconds, and
+            contains all the requested instance IDs and names (or knows
+            that they do not exist). Otherwise, fetch the inventory and
+            cache it.
+    refresh --- Always fetch the inventory and cache it.
+
+Operations that change instances (start, stop, tagging, launching) invalidate
+the cached inventory of the region they affect, whether or not the cache is
+enabled for the current run.
+"""
+import json
+from hashlib import sha1
+from os import makedirs, remove, rename, getpid
+from os.path import join, exists, expanduser
+from time import time
+
+from boto.ec2.instance import Instance
+
+from awsfabrictasks.conf import awsfab_settings
+
+
+#: Valid values for the ``--ec2-cache`` option.
+CACHE_MODES = ('off', 'use', 'refresh')
+
+#: The instance attributes stored in the cache.
+CACHED_ATTRIBUTES = ('id', 'tags', 'state', 'placement', 'instance_type',
+                     'key_name', 'public_dns_name', 'private_dns_name',
+                     'ip_address', 'private_ip_address', 'vpc_id', 'subnet_id',
+                     'image_id')
+
+
+class InvalidCacheMode(ValueError):
+    """
+    Raised when an invalid cache mode (see :obj:`CACHE_MODES`) is used.
+    """
+
+
+def instance_to_dict(instance):
+    """
+    Serialize the :obj:`CACHED_ATTRIBUTES` of a :class:`boto.ec2.instance.Instance`
+    into a JSON-serializable dict.
+    """
+    dct = {}
+    for attrname in CACHED_ATTRIBUTES:
+        value = getattr(instance, attrname, None)
+        if attrname == 'tags':
+            value = dict(value or {})
+        dct[attrname] = value
+    return dct
+
+def instance_from_dict(dct, connection=None):
+    """
+    Create a :class:`boto.ec2.instance.Instance` from a dict created with
+    :func:`instance_to_dict`. The instance is bound to ``connection``, so
+    methods like ``start()`` and ``add_tag()`` work just like they do for
+    instances returned by boto.
+    """
+    instance = Instance(connection)
+    for attrname, value in dct.items():
+        if attrname == 'state':
+            instance._state.name = value
+        elif attrname == 'placement':
+            instance._placement.zone = value
+        elif attrname == 'tags':
+            instance.tags.update(value)
+        else:
+            setattr(instance, attrname, value)
+    return instance
+
+
+class Ec2InventoryCache(object):
+    """
+    Reads and writes the cached inventory of each region as a JSON file in
+    ``awsfab_settings.EC2_INVENTORY_CACHE_DIR``. The files are separated by
+    access key, so switching credentials never returns instances from another
+    account.
+    """
+    def __init__(self, mode='off'):
+        """
+        :param mode: One of :obj:`CACHE_MODES`.
+        :raise InvalidCacheMode: If ``mode`` is not in :obj:`CACHE_MODES`.
+        """
+        if not mode in CACHE_MODES:
+            raise InvalidCacheMode('Invalid EC2 cache mode: {0}. Use one of: {1}'.format(
+                mode, ', '.join(CACHE_MODES)))
+        self.mode = mode
+
+    def is_enabled(self):
+        """
+        Return ``True`` unless the mode is ``"off"``.
+        """
+        return self.mode != 'off'
+
+    def get_cachedir(self):
+        return expanduser(awsfab_settings.EC2_INVENTORY_CACHE_DIR)
+
+    def get_cachefile(self, region):
+        """
+        Get the path to the cache file for ``region``.
+        """
+        access_key = awsfab_settings.AUTH.get('aws_access_key_id') or ''
+        accounthash = sha1(access_key.encode('utf-8')).hexdigest()[:12]
+        filename = 'ec2-inventory-{region}-{accounthash}.json'.format(**vars())
+        return join(self.get_cachedir(), filename)
+
+    def _load_data(self, region):
+        if self.mode != 'use':
+            return None
+        try:
+            with open(self.get_cachefile(region)) as cachefile:
+                data = json.load(cachefile)
+        except (IOError, OSError, ValueError):
+            return None
+        if time() - data.get('created', 0) > awsfab_settings.EC2_INVENTORY_CACHE_TTL:
+            return None
+        return data
+
+    def load(self, region):
+        """
+        Load the cached inventory of ``region``.
+
+        :return:
+            A list of dicts (see :func:`instance_to_dict`), or ``None`` if the
+            mode is not ``"use"``, or the inventory is missing, unreadable or
+            older than ``awsfab_settings.EC2_INVENTORY_CACHE_TTL`` seconds.
+        """
+        data = self._load_data(region)
+        return data and data['instances']
+
+    def load_missing(self, region):
+        """
+        Load the instance IDs and names that were looked up, but did not
+        exist, when the inventory of ``region`` was saved (see :meth:`save`).
+
+        :return:
+            A ``(instanceids, names)`` tuple of sets. Both are empty if
+            :meth:`load` would return ``None``.
+        """
+        data = self._load_data(region) or {}
+        return set(data.get('missing_instanceids', [])), set(data.get('missing_names', []))
+
+    def save(self, region, instances, missing_instanceids=(), missing_names=()):
+        """
+        Save the inventory of ``region``.
+
+        :param instances: Iterable of :class:`boto.ec2.instance.Instance` objects.
+        :param missing_instanceids:
+            Instance IDs looked up in the fetched inventory that do not
+            exist. Saved so a warm cache does not fetch the inventory again
+            each time they are looked up (see :meth:`load_missing`).
+        :param missing_names: Like ``missing_instanceids``, for Name-tags.
+        :return: The saved list of dicts (see :func:`instance_to_dict`).
+        """
+        instancedicts = [instance_to_dict(instance) for instance in instances]
+        cachedir = self.get_cachedir()
+        if not exists(cachedir):
+            try:
+                makedirs(cachedir)
+            except OSError:
+                if not exists(cachedir):
+                    raise
+        cachefile = self.get_cachefile(region)
+        tmpfile = '{0}.{1}.tmp'.format(cachefile, getpid())
+        with open(tmpfile, 'w') as outfile:
+            json.dump({'created': time(), 'region': region,
+                       'instances': instancedicts,
+                       'missing_instanceids': sorted(missing_instanceids),
+                       'missing_names': sorted(missing_names)}, outfile)
+        rename(tmpfile, cachefile)
+        return instancedicts
+
+    def invalidate(self, region):
+        """
+        Remove the cached inventory of ``region`` (if it exists).
+        """
+        cachefile = self.get_cachefile(region)
+        try:
+            remove(cachefile)
+        except OSError:
+            pass
+
+
+def invalidate_region(region):
+    """
+    Remove the cached inventory of ``region``. Use this after changing any
+    instance in the region.
+    """
+    Ec2InventoryCache().invalidate(region)
+
+def invalidate_instance(instancewrapper):
+    """
+    Remove the cached inventory of the region containing the instance
+    wrapped by the given :class:`awsfabrictasks.ec2.api.Ec2InstanceWrapper`.
+    """
+    region = getattr(instancewrapper.instance, 'region', None)
+    if region:
+        invalidate_region(region.name)
+    else:
+        invalidate_region(awsfab_settings.DEFAULT_REGION)
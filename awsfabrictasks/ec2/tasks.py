@@ -3,8 +3,8 @@ General tasks for AWS management.
 """
 from __future__ import print_function
 
+from os.path import join
 from pprint import pformat, pprint
-from boto.ec2 import connect_to_region
 from fabric.api import task, abort, local, env
 from fabric.contrib.console import confirm
 from textwrap import fill
@@ -12,7 +12,10 @@ from textwrap import fill
 from awsfabrictasks.conf import awsfab_settings
 from awsfabrictasks.utils import force_slashend
 from awsfabrictasks.utils import parse_bool
+from awsfabrictasks.utils import iter_parallel
+from awsfabrictasks.utils import format_local_command_summary
 from .api import Ec2InstanceWrapper
+from .api import parse_regionlist
 from .api import wait_for_stopped_state
 from .api import wait_for_running_state
 from .api import print_ec2_instance
@@ -21,6 +24,17 @@ from .api import ec2_rsync_upload
 from .api import ec2_rsync_upload_command
 from .api import ec2_rsync_download
 from .api import ec2_rsync_download_command
+from .api import ec2_rsync_upload_many
+from .api import ec2_rsync_download_many
+from .api import ec2_rsync_broadcast
+from .api import wait_for_ssh as wait_for_ssh_ready
+from .api import get_extra_ssh_args
+from .api import get_ssh_control_path
+from .api import close_ssh_control_master
+from .api import close_all_ssh_control_masters
+from .api import add_tags_to_instances
+from .api import remove_tags_from_instances
+from .api import invalidate_region_instances
 
 
 
@@ -28,13 +42,15 @@ __all__ = [
         'ec2_add_tag', 'ec2_set_tag', 'ec2_remove_tag',
         'ec2_launch_instance', 'ec2_start_instance', 'ec2_stop_instance',
         'ec2_list_instances', 'ec2_print_instance', 'ec2_login',
-        'ec2_rsync_download_dir', 'ec2_rsync_upload_dir'
+        'ec2_rsync_download_dir', 'ec2_rsync_upload_dir', 'ec2_rsync_broadcast_dir',
+        'ec2_close_ssh_connections'
         ]
 
 
 
 @task
-def ec2_rsync_download_dir(remote_dir, local_dir, rsync_args='-av', noconfirm=False):
+def ec2_rsync_download_dir(remote_dir, local_dir, rsync_args='-av', noconfirm=False,
+                           fanout=False, workers=None):
     """
     Sync the contents of ``remote_dir`` into ``local_dir``. E.g.: if ``remote_dir`` is
     ``/etc``, and ``local_dir`` is ``/tmp``, the ``/tmp/etc`` will be created on the local
@@ -46,10 +62,30 @@ def ec2_rsync_download_dir(remote_dir, local_dir, rsync_args='-av', noconfirm=Fa
     :param noconfirm:
         If this is ``True``, we will not ask for confirmation before
         proceeding with the operation. Defaults to ``False``.
+    :param fanout:
+        If this is ``True``, download from all the selected hosts
+        concurrently the first time the task runs, and do nothing for the
+        rest of the hosts. Each host is downloaded into
+        ``<local_dir>/<instance-id>/``. Output is prefixed with the host, and
+        a summary is printed at the end. When the task runs in parallel
+        (``-P``), each host process only downloads from its own host (still
+        into ``<local_dir>/<instance-id>/``). Defaults to ``False``.
+    :param workers:
+        Maximum number of concurrent rsync processes with ``fanout``.
+        Defaults to ``awsfab_settings.RSYNC_WORKERS``.
     """
     kwargs = dict(remote_dir=remote_dir,
                   local_dir=local_dir,
                   rsync_args=rsync_args)
+    if parse_bool(fanout):
+        instancewrappers = _get_instancewrappers_once('ec2_rsync_download_dir', fanout)
+        if instancewrappers:
+            _confirm_fanout(noconfirm, instancewrappers, ec2_rsync_download_command,
+                            dict(kwargs, local_dir=join(local_dir, '<instance-id>')))
+            _print_fanout_summary(ec2_rsync_download_many(instancewrappers,
+                                                          workers=workers and int(workers),
+                                                          **kwargs))
+        return
     if not parse_bool(noconfirm):
         instancewrapper = Ec2InstanceWrapper.get_from_host_string()
         print('Are you sure you want to run:')
@@ -59,7 +95,8 @@ def ec2_rsync_download_dir(remote_dir, local_dir, rsync_args='-av', noconfirm=Fa
     ec2_rsync_download(**kwargs)
 
 @task
-def ec2_rsync_upload_dir(local_dir, remote_dir, rsync_args='-av', noconfirm=False):
+def ec2_rsync_upload_dir(local_dir, remote_dir, rsync_args='-av', noconfirm=False,
+                         fanout=False, workers=None):
     """
     Sync the contents of ``local_dir`` into ``remote_dir`` on the EC2
     instance. E.g.: if ``local_dir`` is ``/etc``, and ``remote_dir`` is
@@ -72,10 +109,27 @@ def ec2_rsync_upload_dir(local_dir, remote_dir, rsync_args='-av', noconfirm=Fals
     :param noconfirm:
         If this is ``True``, we will not ask for confirmation before
         proceeding with the operation. Defaults to ``False``.
+    :param fanout:
+        If this is ``True``, upload to all the selected hosts concurrently
+        the first time the task runs, and do nothing for the rest of the
+        hosts. Output is prefixed with the host, and a summary is printed at
+        the end. When the task runs in parallel (``-P``), each host process
+        only uploads to its own host. Defaults to ``False``.
+    :param workers:
+        Maximum number of concurrent rsync processes with ``fanout``.
+        Defaults to ``awsfab_settings.RSYNC_WORKERS``.
     """
     kwargs = dict(local_dir=local_dir,
                   remote_dir=remote_dir,
                   rsync_args=rsync_args)
+    if parse_bool(fanout):
+        instancewrappers = _get_instancewrappers_once('ec2_rsync_upload_dir', fanout)
+        if instancewrappers:
+            _confirm_fanout(noconfirm, instancewrappers, ec2_rsync_upload_command, kwargs)
+            _print_fanout_summary(ec2_rsync_upload_many(instancewrappers,
+                                                        workers=workers and int(workers),
+                                                        **kwargs))
+        return
     if not parse_bool(noconfirm):
         instancewrapper = Ec2InstanceWrapper.get_from_host_string()
         print('Are you sure you want to run:')
@@ -85,47 +139,165 @@ def ec2_rsync_upload_dir(local_dir, remote_dir, rsync_args='-av', noconfirm=Fals
     ec2_rsync_upload(**kwargs)
 
 @task
-def ec2_add_tag(tagname, value=''):
+def ec2_rsync_broadcast_dir(local_dir, remote_dir, rsync_args='-av', noconfirm=False,
+                            fanout=2, workers=None):
+    """
+    Sync the contents of ``local_dir`` into ``remote_dir`` on all the selected
+    EC2 instances, while only uploading ``local_dir`` once from the local host
+    for each region/VPC. The instances copy the directory to each other over
+    their private IP addresses in a tree with ``fanout`` branches (see
+    :func:`awsfabrictasks.ec2.api.ec2_rsync_broadcast`). Runs once for all the
+    hosts, and does nothing for the rest of the hosts.
+
+    When the task runs in parallel (``-P``), the host processes can not share
+    a broadcast tree, so each process uploads ``local_dir`` directly to its
+    own host instead.
+
+    The local ssh agent is forwarded to the instances, so the keys for the
+    instances must be added to the agent with ``ssh-add``.
+
+    :param local_dir: The local directory to upload to the EC2 instances.
+    :param remote_dir: The remote directory to upload local_dir into.
+    :param rsync_args: Arguments for ``rsync``. Defaults to ``-av``.
+    :param noconfirm:
+        If this is ``True``, we will not ask for confirmation before
+        proceeding with the operation. Defaults to ``False``.
+    :param fanout:
+        Number of instances each instance copies to in each round. Defaults
+        to ``2``.
+    :param workers:
+        Maximum number of concurrent rsync processes. Defaults to
+        ``awsfab_settings.RSYNC_WORKERS``.
+    """
+    instancewrappers = _get_instancewrappers_once('ec2_rsync_broadcast_dir', True)
+    if not instancewrappers:
+        return
+    if not parse_bool(noconfirm):
+        print('Are you sure you want to broadcast {local_dir} into {remote_dir} on:'.format(**vars()))
+        for instancewrapper in instancewrappers:
+            print('   ', instancewrapper.prettyname())
+        if not confirm('Proceed?'):
+            abort('Aborted')
+    _print_fanout_summary(ec2_rsync_broadcast(instancewrappers, local_dir, remote_dir,
+                                              rsync_args=rsync_args, fanout=int(fanout),
+                                              workers=workers and int(workers)))
+
+def _confirm_fanout(noconfirm, instancewrappers, commandbuilder, kwargs):
+    if parse_bool(noconfirm):
+        return
+    print('Are you sure you want to run the following on {0} hosts:'.format(len(instancewrappers)))
+    for instancewrapper in instancewrappers:
+        print('   ', commandbuilder(instancewrapper, **kwargs))
+    if not confirm('Proceed?'):
+        abort('Aborted')
+
+def _print_fanout_summary(results):
+    print()
+    print('Summary:')
+    print(format_local_command_summary(results))
+    failed = [result.label for result in results if not result.succeeded()]
+    if failed:
+        abort('rsync failed for: {0}'.format(', '.join(failed)))
+
+def _get_instancewrappers_once(taskname, bulk):
+    """
+    Get the instances a task should work on for the current host.
+
+    Without ``bulk``, this is the instance for the current host. With
+    ``bulk``, this is all the EC2 instances selected for the awsfab run the
+    first time the task runs, and an empty list when it runs for the rest of
+    the hosts. This lets a task work on all the hosts with a single request
+    instead of one request per host.
+
+    Each time the task is executed (E.g.: ``awsfab task:a=1,bulk=true
+    task:b=2,bulk=true``) is handled separately. We detect that a new
+    execution has started when the task runs on a host it has already run on.
+
+    When the task runs in parallel (``awsfab -P`` or ``@parallel``), each host
+    runs in its own process, and the processes can not tell which of them
+    runs first. ``bulk`` is ignored in that case, and each process only works
+    on the instance for its own host, so no host is handled more than once.
+    """
+    if not parse_bool(bulk) or env.get('parallel'):
+        return [Ec2InstanceWrapper.get_from_host_string()]
+    hosts_done = env.setdefault('ec2_bulk_tasks_hosts_done', {})
+    done = hosts_done.get(taskname)
+    if done is not None and not env.host_string in done:
+        done.add(env.host_string)
+        return []
+    hosts_done[taskname] = set([env.host_string])
+    ec2instances = env.get('ec2instances', {})
+    for host in env.all_hosts:
+        if not host in ec2instances:
+            abort(('{taskname} can only work on all hosts at once if they are '
+                   'selected with --ec2ids, --ec2names, --ec2tags or --ec2filters. '
+                   'Not an EC2 instance: {host}').format(**vars()))
+    return [ec2instances[host] for host in env.all_hosts]
+
+@task
+def ec2_add_tag(tagname, value='', bulk=False):
     """
     Add tag to EC2 instance. Fails if tag already exists.
 
     :param tagname: Name of the tag to set (required).
     :param value: Value to set the tag to. Default to empty string.
+    :param bulk:
+        If this is ``True``, tag all the selected hosts with a single request
+        per region the first time the task runs, and do nothing for the rest
+        of the hosts. Fails without tagging any host if any of them already
+        has the tag. Ignored when the task runs in parallel (``-P``).
+        Defaults to ``False``.
     """
-    instancewrapper = Ec2InstanceWrapper.get_from_host_string()
-    if tagname in instancewrapper.instance.tags:
-        prettyname = instancewrapper.prettyname()
-        abort('{prettyname}: duplicate tag: {tagname}'.format(**vars()))
-    instancewrapper.instance.add_tag(tagname, value)
+    instancewrappers = _get_instancewrappers_once('ec2_add_tag', bulk)
+    for instancewrapper in instancewrappers:
+        if tagname in instancewrapper.instance.tags:
+            prettyname = instancewrapper.prettyname()
+            abort('{prettyname}: duplicate tag: {tagname}'.format(**vars()))
+    if instancewrappers:
+        add_tags_to_instances(instancewrappers, {tagname: value})
 
 @task
-def ec2_set_tag(tagname, value=''):
+def ec2_set_tag(tagname, value='', bulk=False):
     """
     Set tag on EC2 instance. Overwrites value if tag exists.
 
     :param tagname: Name of the tag to set (required).
     :param value: Value to set the tag to. Default to empty string.
+    :param bulk:
+        If this is ``True``, tag all the selected hosts with a single request
+        per region the first time the task runs, and do nothing for the rest
+        of the hosts. Ignored when the task runs in parallel (``-P``).
+        Defaults to ``False``.
     """
-    instancewrapper = Ec2InstanceWrapper.get_from_host_string()
-    instancewrapper.instance.add_tag(tagname, value)
+    instancewrappers = _get_instancewrappers_once('ec2_set_tag', bulk)
+    if instancewrappers:
+        add_tags_to_instances(instancewrappers, {tagname: value})
 
 @task
-def ec2_remove_tag(tagname):
+def ec2_remove_tag(tagname, bulk=False):
     """
     Remove tag from EC2 instance. Fails if tag does not exist.
 
     :param tagname: Name of the tag to remove (required).
+    :param bulk:
+        If this is ``True``, remove the tag from all the selected hosts with a
+        single request per region the first time the task runs, and do
+        nothing for the rest of the hosts. Fails without changing any host if
+        any of them does not have the tag. Ignored when the task runs in
+        parallel (``-P``). Defaults to ``False``.
     """
-    instancewrapper = Ec2InstanceWrapper.get_from_host_string()
-    if not tagname in instancewrapper.instance.tags:
-        prettyname = instancewrapper.prettyname()
-        abort('{prettyname} has no "{tagname}"-tag'.format(**vars()))
-    instancewrapper.instance.remove_tag(tagname)
+    instancewrappers = _get_instancewrappers_once('ec2_remove_tag', bulk)
+    for instancewrapper in instancewrappers:
+        if not tagname in instancewrapper.instance.tags:
+            prettyname = instancewrapper.prettyname()
+            abort('{prettyname} has no "{tagname}"-tag'.format(**vars()))
+    if instancewrappers:
+        remove_tags_from_instances(instancewrappers, [tagname])
 
 
 
 @task
-def ec2_launch_instance(name, configname=None):
+def ec2_launch_instance(name, configname=None, wait_for_ssh=False):
     """
     Launch new EC2 instance.
 
@@ -133,11 +305,17 @@ def ec2_launch_instance(name, configname=None):
     :param configname: Name of the configuration in
         ``awsfab_settings.EC2_LAUNCH_CONFIGS``. Prompts for input if not
         provided as an argument.
+    :param wait_for_ssh:
+        Wait until the instance accepts SSH connections after it is running,
+        so the instance is ready for other tasks when this task completes.
+        Defaults to ``False``.
     """
     launcher = Ec2LaunchInstance(extra_tags={'Name': name}, configname=configname)
     launcher.confirm()
-    instance = launcher.run_instance()
-    wait_for_running_state(instance.id)
+    launcher.run_instance()
+    instancewrapper = wait_for_running_state(launcher.get_instanceid_with_region())
+    if parse_bool(wait_for_ssh):
+        wait_for_ssh_ready([instancewrapper])
 
 
 @task
@@ -150,6 +328,7 @@ def ec2_start_instance(nowait=False):
     """
     instancewrapper = Ec2InstanceWrapper.get_from_host_string()
     instancewrapper.instance.start()
+    invalidate_region_instances(instancewrapper.get_region_name())
     if nowait:
         print(('Starting: {id}. This is an asynchronous operation. Use '
                 '``ec2_list_instances`` or the aws dashboard to check the status of '
@@ -167,6 +346,7 @@ def ec2_stop_instance(nowait=False):
     """
     instancewrapper = Ec2InstanceWrapper.get_from_host_string()
     instancewrapper.instance.stop()
+    invalidate_region_instances(instancewrapper.get_region_name())
     if nowait:
         print(('Stopping: {id}. This is an asynchronous operation. Use '
                 '``ec2_list_instances`` or the aws dashboard to check the status of '
@@ -190,19 +370,8 @@ def ec2_print_instance(full=False):
     print('Instance:', _get_instanceident(instancewrapper.instance))
     print_ec2_instance(instancewrapper.instance, full=full)
 
-@task
-def ec2_list_instances(region=awsfab_settings.DEFAULT_REGION, full=False):
-    """
-    List EC2 instances in a region (defaults to awsfab_settings.DEFAULT_REGION).
-
-    :param region: The region to list instances in. Defaults to
-        ``awsfab_settings.DEFAULT_REGION.
-    :param full: Print all attributes, or just the most useful ones? Defaults
-        to ``False``.
-    """
-    conn = connect_to_region(region_name=region, **awsfab_settings.AUTH)
-
-    for reservation in conn.get_all_instances():
+def _print_reservations(reservations, full=False):
+    for reservation in reservations:
         print()
         print('id:', reservation.id)
         print('   owner_id:', reservation.owner_id)
@@ -215,6 +384,45 @@ def ec2_list_instances(region=awsfab_settings.DEFAULT_REGION, full=False):
             print('      -', _get_instanceident(instance))
             print_ec2_instance(instance, full=full, indentspaces=11)
 
+@task
+def ec2_list_instances(region=awsfab_settings.DEFAULT_REGION, full=False):
+    """
+    List EC2 instances in one or more regions (defaults to awsfab_settings.DEFAULT_REGION).
+
+    :param region: The region to list instances in. Defaults to
+        ``awsfab_settings.DEFAULT_REGION``. Use a comma-separated list of
+        regions, or ``all`` for all regions, to list instances in many
+        regions. The regions are queried concurrently (at most
+        ``awsfab_settings.REGION_WORKERS`` at a time), and each region is
+        printed as soon as its instances are retrieved. A region that fails
+        does not stop the other regions from being listed.
+    :param full: Print all attributes, or just the most useful ones? Defaults
+        to ``False``.
+    """
+    regions = parse_regionlist(region)
+    if len(regions) == 1:
+        _print_reservations(Ec2InstanceWrapper.iter_reservations(region=regions[0]),
+                            full=full)
+        return
+
+    def get_reservations(region):
+        return list(Ec2InstanceWrapper.iter_reservations(region=region))
+    failed = []
+    for region, reservations, error in iter_parallel(get_reservations, regions,
+                                                     workers=awsfab_settings.REGION_WORKERS):
+        print()
+        print('=' * 80)
+        if error:
+            failed.append(region)
+            print('Region: {region} --- FAILED: {error}'.format(**vars()))
+            print('=' * 80)
+        else:
+            print('Region: {region} ({count} reservations)'.format(count=len(reservations), **vars()))
+            print('=' * 80)
+            _print_reservations(reservations, full=full)
+    if failed:
+        abort('Could not list instances in: {0}'.format(', '.join(sorted(failed))))
+
 
 @task
 def ec2_login():
@@ -228,6 +436,27 @@ def ec2_login():
     instancewrapper = Ec2InstanceWrapper.get_from_host_string()
     host = instancewrapper.get_ssh_uri()
     key_filename = instancewrapper.get_ssh_key_filename()
-    extra_ssh_args = awsfab_settings.EXTRA_SSH_ARGS
+    extra_ssh_args = get_extra_ssh_args(host)
     cmd = 'ssh -i {key_filename} {extra_ssh_args} {host}'.format(**vars())
     local(cmd)
+
+@task
+def ec2_close_ssh_connections(allhosts=False):
+    """
+    Close the shared SSH master connection (see
+    ``awsfab_settings.SSH_CONTROL_PERSIST``) used by ``ec2_login`` and the
+    rsync tasks for the current host.
+
+    :param allhosts:
+        Close all the shared connections instead of only the one for the
+        current host. Works without any hosts. Defaults to ``False``.
+    """
+    if parse_bool(allhosts) or not env.host_string:
+        if not 'ec2_ssh_connections_closed' in env:
+            env.ec2_ssh_connections_closed = True
+            print('Closed {0} shared SSH connections.'.format(close_all_ssh_control_masters()))
+        return
+    instancewrapper = Ec2InstanceWrapper.get_from_host_string()
+    ssh_uri = instancewrapper.get_ssh_uri()
+    if close_ssh_control_master(get_ssh_control_path(ssh_uri)):
+        print('Closed the shared SSH connection to {0}.'.format(ssh_uri))
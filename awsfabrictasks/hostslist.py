@@ -1,3 +1,7 @@
+from hashlib import sha256
+from base64 import b64encode
+from fabric.api import sudo, hide, execute, parallel
+
 from awsfabrictasks.utils import sudo_upload_string_to_file
 
 hostsfile_template = """
@@ -43,3 +47,68 @@ def create_hostsfile_from_ec2instancewrappers(instancewrappers):
 
 def upload_hostsfile(hostsfile_string):
     sudo_upload_string_to_file(hostsfile_string, '/etc/hosts')
+
+def get_hostsfile_checksum(hostsfile_string):
+    """
+    Get the sha256 hex digest of ``hostsfile_string`` (the same as
+    ``sha256sum`` gives for the uploaded file).
+    """
+    return sha256(hostsfile_string.encode('utf-8')).hexdigest()
+
+def get_upload_hostsfile_if_changed_command(hostsfile_string, remote_path='/etc/hosts'):
+    """
+    Get a shell command that compares the sha256 checksum of ``remote_path``
+    with the checksum of ``hostsfile_string``, and only writes
+    ``hostsfile_string`` to ``remote_path`` if they differ. The file is
+    written in place, so its owner and permissions are kept. Echos
+    ``awsfab-hostsfile:unchanged`` or ``awsfab-hostsfile:updated``.
+    """
+    checksum = get_hostsfile_checksum(hostsfile_string)
+    encoded = b64encode(hostsfile_string.encode('utf-8')).decode('ascii')
+    tmp_path = remote_path + '.awsfab'
+    return ('if [ "$(sha256sum < {remote_path} | cut -d" " -f1)" = "{checksum}" ]; then '
+            'echo awsfab-hostsfile:unchanged; '
+            'else echo {encoded} | base64 -d > {tmp_path} && cat {tmp_path} > {remote_path} '
+            '&& rm -f {tmp_path} && echo awsfab-hostsfile:updated; fi').format(**vars())
+
+def upload_hostsfile_if_changed(hostsfile_string, remote_path='/etc/hosts'):
+    """
+    Upload ``hostsfile_string`` to ``remote_path`` on the current host unless
+    it is already up to date. Uses a single sudo command (see
+    :func:`get_upload_hostsfile_if_changed_command`).
+
+    :return: ``True`` if the file was updated, ``False`` if it was up to date.
+    """
+    with hide('stdout'):
+        output = sudo(get_upload_hostsfile_if_changed_command(hostsfile_string, remote_path))
+    return 'awsfab-hostsfile:updated' in output
+
+def rollout_hostsfile(instancewrappers, hostsfile_string=None, pool_size=None):
+    """
+    Run :func:`upload_hostsfile_if_changed` on many EC2 instances in parallel
+    (using ``fabric.decorators.parallel``).
+
+    :param instancewrappers:
+        Iterable of :class:`awsfabrictasks.ec2.api.Ec2InstanceWrapper` objects.
+    :param hostsfile_string:
+        The hosts file. Defaults to
+        ``create_hostsfile_from_ec2instancewrappers(instancewrappers)``.
+    :param pool_size:
+        Maximum number of hosts updated at the same time. Defaults to all
+        of them.
+    :return:
+        Dict mapping the ssh URI of each instance to ``True`` if the file was
+        updated, and ``False`` if it was already up to date.
+    """
+    instancewrappers = list(instancewrappers)
+    if hostsfile_string is None:
+        hostsfile_string = create_hostsfile_from_ec2instancewrappers(instancewrappers)
+    for instancewrapper in instancewrappers:
+        instancewrapper.add_instance_to_env()
+    hosts = [instancewrapper.get_ssh_uri() for instancewrapper in instancewrappers]
+    if not hosts:
+        return {}
+    @parallel(pool_size=pool_size)
+    def upload():
+        return upload_hostsfile_if_changed(hostsfile_string)
+    return execute(upload, hosts=hosts)
@@ -1,7 +1,8 @@
 from os.path import join
 from fabric import tasks
 
-from .ec2.api import Ec2InstanceWrapper
+from .ec2.api import resolve_instances
+from .ec2.api import parse_filterlist
 
 
 def _splitnames(names):
@@ -14,25 +15,17 @@ def get_hosts_supporting_aws(self, arg_hosts, arg_roles, arg_exclude_hosts, env=
     hosts = tasks.Task.get_hosts(self, arg_hosts, arg_roles, arg_exclude_hosts, env)
 
     ids = _splitnames(env.ec2ids)
-    for instanceid in ids:
-        instance = Ec2InstanceWrapper.get_by_instanceid(instanceid)
-        instance.add_instance_to_env()
-        hosts.append(instance.get_ssh_uri())
-
     names = _splitnames(env.ec2names)
-    for name in names:
-        instance = Ec2InstanceWrapper.get_by_nametag(name)
-        instance.add_instance_to_env()
-        hosts.append(instance.get_ssh_uri())
-
-    tvps = env.ec2tags
-    tvps = tvps and tvps.split(',') or []
-    if tvps:
-        tvps = dict((tvp.split('=') for tvp in tvps))
-        instances = Ec2InstanceWrapper.get_by_tagvalue(tvps)
+    tvps = parse_filterlist(env.ec2tags)
+    filters = parse_filterlist(env.ec2filters)
+    if ids or names or tvps or filters:
+        instances = resolve_instances(instanceids=ids, names=names, tags=tvps,
+                                      filters=filters, cache=env.ec2_cache)
         for instance in instances:
             instance.add_instance_to_env()
-            hosts.append(instance.get_ssh_uri())
+            host = instance.get_ssh_uri()
+            if not host in hosts:
+                hosts.append(host)
 
     return hosts
 
@@ -58,7 +51,20 @@ def awsfab():
     state.env_options.append(
             make_option('-G', '--ec2tags',
                 default='',
-                help=('Comma-separated list of tag=value pairs.')
+                help=('Comma-separated list of tag=value pairs. Separate '
+                    'values with ``|`` to match any of them (e.g.: '
+                    'role=web|worker,env=prod).')
+                )
+            )
+    state.env_options.append(
+            make_option('--ec2filters',
+                default='',
+                help=('Comma-separated list of name=value EC2 filters '
+                    '(e.g.: instance-state-name=running,vpc-id=vpc-123abc). '
+                    'Separate values with ``|`` to match any of them. The '
+                    'filters are AND-ed with --ec2tags, and sent to AWS with '
+                    'the DescribeInstances request. Use without --ec2tags to '
+                    'select all instances matching the filters.')
                 )
             )
     state.env_options.append(
@@ -70,6 +76,19 @@ def awsfab():
                     'is awsfab_settings.DEFAULT_REGION.')
                 )
             )
+    state.env_options.append(
+            make_option('--ec2-cache',
+                dest='ec2_cache',
+                type='choice',
+                choices=['off', 'use', 'refresh'],
+                default='off',
+                help=('Use the on-disk EC2 inventory cache to resolve '
+                    '--ec2ids, --ec2names and --ec2tags. One of: off, use, '
+                    'refresh. With ``use``, a cached region inventory younger '
+                    'than awsfab_settings.EC2_INVENTORY_CACHE_TTL seconds is '
+                    'used without any requests to AWS. Defaults to ``off``.')
+                )
+            )
     state.env_options.append(
             make_option('--awsfab-settings',
                 dest='awsfab_settings_module',
@@ -1,9 +1,9 @@
 from __future__ import print_function
 
 from pprint import pformat
-from boto.rds import connect_to_region
 
 from awsfabrictasks.conf import awsfab_settings
+from awsfabrictasks.connections import get_region_connection
 
 
 class RdsRegionConnectionError(Exception):
@@ -40,13 +40,15 @@ class RdsInstanceWrapper(object):
     @classmethod
     def get_connection(cls, region=None):
         """
-        Connect to the given region, and return the connection.
+        Connect to the given region, and return the connection. The
+        connection is reused for later calls (see
+        :mod:`awsfabrictasks.connections`).
 
         :param region:
             Defaults to ``awsfab_settings.DEFAULT_REGION`` if ``None``.
         """
         region = region is None and awsfab_settings.DEFAULT_REGION or region
-        connection = connect_to_region(region_name=region, **awsfab_settings.AUTH)
+        connection = get_region_connection('rds', region)
         if not connection:
             raise RdsRegionConnectionError(region)
         return connection
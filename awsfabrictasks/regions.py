@@ -1,9 +1,10 @@
 from __future__ import print_function
 
 from fabric.api import task
-from boto.ec2 import regions, connect_to_region
+from boto.ec2 import regions
 
 from .conf import awsfab_settings
+from .ec2.api import Ec2InstanceWrapper
 
 
 
@@ -23,7 +24,7 @@ def list_zones(region=awsfab_settings.DEFAULT_REGION):
 
     :param region: Defaults to ``awsfab_settings.DEFAULT_REGION``.
     """
-    connection = connect_to_region(region_name=region, **awsfab_settings.AUTH)
+    connection = Ec2InstanceWrapper.get_connection(region)
     print('Zones in {region}:'.format(region=region))
     for zone in connection.get_all_zones():
         print('- {name} (state:{state})'.format(**zone.__dict__))
@@ -1,7 +1,17 @@
 #from pprint import pformat
 from fnmatch import fnmatchcase
-from os import walk, makedirs
-from os.path import join, abspath, exists, dirname
+from os import walk, makedirs, remove, rename
+from os.path import join, abspath, exists, dirname, getsize
+from copy import copy
+from hashlib import md5
+from mimetypes import guess_type
+from threading import Thread, Lock
+from threading import local as threading_local
+from time import time, sleep
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 from boto.s3.connection import S3Connection
 from boto.s3.prefix import Prefix
 from boto.s3.key import Key
@@ -11,6 +21,8 @@ from awsfabrictasks.utils import localpath_to_slashpath
 from awsfabrictasks.utils import slashpath_to_localpath
 from awsfabrictasks.conf import awsfab_settings
 from awsfabrictasks.utils import compute_localfile_md5sum
+from awsfabrictasks.utils import iter_parallel
+from awsfabrictasks.s3.checksumcache import get_filestat_key
 
 
 class S3ConnectionError(Exception):
@@ -62,7 +74,7 @@ class S3ConnectionWrapper(object):
         return cls.get_bucket(settingsformat_bucketname(bucketname))
 
     @classmethod
-    def get_bucket(cls, bucketname):
+    def get_bucket(cls, bucketname, validate=True):
         """
         Get the requested bucket.
 
@@ -71,9 +83,12 @@ class S3ConnectionWrapper(object):
             S3ConnectionWrapper.get_connection().connection.get_bucket(bucketname)
 
         :param bucketname: Name of an S3 bucket.
+        :param validate:
+            Check that the bucket exists (requires a request to S3).
+            Defaults to ``True``.
         """
         connectionwrapper = S3ConnectionWrapper.get_connection()
-        return connectionwrapper.connection.get_bucket(bucketname)
+        return connectionwrapper.connection.get_bucket(bucketname, validate=validate)
 
 
 
@@ -210,6 +225,176 @@ class S3FileNoInfo(S3FileErrorBase):
         return ('{0}: No info about the key. Use S3File.perform_headrequest(), '
                 'or initialize with head=True.').format(super(S3FileNoInfo, self).__str__())
 
+class S3MultipartUploadError(S3FileErrorBase):
+    """
+    Raised when a multipart upload fails. The upload is aborted before this
+    is raised, so no parts are left behind on S3.
+    """
+    def __init__(self, s3file, partnumber, error):
+        """
+        :param s3file: A :class:`S3File` object.
+        :param partnumber: The number of the part that failed.
+        :param error: The exception raised by the last try on the part.
+        """
+        super(S3MultipartUploadError, self).__init__(s3file)
+        self.partnumber = partnumber
+        self.error = error
+
+    def __str__(self):
+        return '{0}: Part {1} failed: {2}'.format(super(S3MultipartUploadError, self).__str__(),
+                                                 self.partnumber, self.error)
+
+class S3RangedDownloadError(S3FileErrorBase):
+    """
+    Raised when a ranged download (see
+    :meth:`S3File.ranged_download_to_filename`) fails or the downloaded file
+    does not match the key. The partially downloaded file is removed before
+    this is raised.
+    """
+    def __init__(self, s3file, msg):
+        super(S3RangedDownloadError, self).__init__(s3file)
+        self.msg = msg
+
+    def __str__(self):
+        return '{0}: {1}'.format(super(S3RangedDownloadError, self).__str__(), self.msg)
+
+
+
+#: S3 does not allow more than this number of parts in a multipart upload.
+S3_MULTIPART_MAX_PARTS = 10000
+
+#: S3 does not allow parts (except the last) smaller than this number of bytes.
+S3_MULTIPART_MIN_PARTSIZE = 5 * 1024 * 1024
+
+def get_multipart_parts(filesize, partsize):
+    """
+    Split a file of ``filesize`` bytes into parts for a multipart upload.
+    ``partsize`` is increased if the file would require more than
+    :obj:`S3_MULTIPART_MAX_PARTS` parts.
+
+    :return: List of ``(partnumber, offset, size)`` tuples. Part numbers start at 1.
+    """
+    partsize = max(partsize, -(-filesize // S3_MULTIPART_MAX_PARTS))
+    parts = []
+    for offset in range(0, filesize, partsize):
+        parts.append((len(parts) + 1, offset, min(partsize, filesize - offset)))
+    return parts
+
+#: Part sizes used by common S3 clients (the AWS CLI and SDKs, the S3 console,
+#: s3cmd, ...). Tried by :func:`get_multipart_partsize_candidates`.
+COMMON_MULTIPART_PARTSIZES = [8 * 1024 * 1024, 5 * 1024 * 1024, 16 * 1024 * 1024,
+                              15 * 1024 * 1024, 64 * 1024 * 1024, 100 * 1024 * 1024]
+
+def _get_multipart_etag_kind(partsize):
+    return 'multipart-etag-{0}'.format(partsize)
+
+def parse_multipart_etag(etag):
+    """
+    Parse an ETag of a key uploaded with multipart upload. These are
+    ``<md5 of the concatenated md5 digests of the parts>-<number of parts>``.
+
+    :return: ``(hexdigest, partcount)``, or ``None`` if ``etag`` is not a multipart ETag.
+    """
+    etag = etag.strip('"')
+    if not '-' in etag:
+        return None
+    hexdigest, partcount = etag.rsplit('-', 1)
+    try:
+        return hexdigest, int(partcount)
+    except ValueError:
+        return None
+
+def get_multipart_partsize_candidates(filesize, partcount):
+    """
+    Get the part sizes that could have been used to upload a file of
+    ``filesize`` bytes in ``partcount`` parts. Tries
+    ``awsfab_settings.S3_MULTIPART_PARTSIZE``, then the smallest whole number
+    of MB that gives ``partcount`` parts, and then :obj:`COMMON_MULTIPART_PARTSIZES`.
+
+    :return: List of part sizes, most likely first.
+    """
+    megabyte = 1024 * 1024
+    inferred = -(-filesize // partcount)
+    inferred = -(-inferred // megabyte) * megabyte
+    candidates = []
+    for partsize in [awsfab_settings.S3_MULTIPART_PARTSIZE, inferred] + COMMON_MULTIPART_PARTSIZES:
+        if partsize and not partsize in candidates \
+                and len(get_multipart_parts(filesize, partsize)) == partcount:
+            candidates.append(partsize)
+    return candidates
+
+def compute_localfile_checksums(localfile, partsizes, include_md5=False):
+    """
+    Compute the ETag S3 would give ``localfile`` if it was uploaded with
+    multipart upload for each of the ``partsizes`` (and optionally the md5
+    checksum of the file) in a single pass over the file.
+
+    :return:
+        Dict mapping each of the ``partsizes`` to a multipart ETag, and
+        ``"md5"`` to the md5 checksum if ``include_md5`` is ``True``.
+    """
+    filesize = getsize(localfile)
+    states = []
+    for partsize in partsizes:
+        # The same part size adjustment as get_multipart_parts()
+        effective = max(partsize, -(-filesize // S3_MULTIPART_MAX_PARTS))
+        states.append({'partsize': partsize, 'effective': effective, 'md5': md5(),
+                       'filled': 0, 'digests': []})
+    wholefile = md5() if include_md5 else None
+    blocksize = 1024 * 1024
+    with open(localfile, 'rb') as fp:
+        for block in iter(lambda: fp.read(blocksize), b''):
+            if wholefile:
+                wholefile.update(block)
+            view = memoryview(block)
+            for state in states:
+                offset = 0
+                while offset < len(block):
+                    take = min(state['effective'] - state['filled'], len(block) - offset)
+                    state['md5'].update(view[offset:offset + take])
+                    state['filled'] += take
+                    offset += take
+                    if state['filled'] == state['effective']:
+                        state['digests'].append(state['md5'].digest())
+                        state['md5'] = md5()
+                        state['filled'] = 0
+    checksums = {}
+    for state in states:
+        digests = state['digests']
+        if state['filled']:
+            digests.append(state['md5'].digest())
+        checksums[state['partsize']] = '{0}-{1}'.format(md5(b''.join(digests)).hexdigest(),
+                                                        len(digests))
+    if wholefile:
+        checksums['md5'] = wholefile.hexdigest()
+    return checksums
+
+def compute_localfile_multipart_etag(localfile, partsize):
+    """
+    Compute the ETag S3 would give ``localfile`` if it was uploaded with
+    multipart upload using ``partsize``.
+    """
+    return compute_localfile_checksums(localfile, [partsize])[partsize]
+
+_matched_partsizes_lock = Lock()
+_matched_partsizes = []
+
+def _remember_matched_partsize(partsize):
+    with _matched_partsizes_lock:
+        if partsize in _matched_partsizes:
+            _matched_partsizes.remove(partsize)
+        _matched_partsizes.insert(0, partsize)
+        del _matched_partsizes[4:]
+
+def get_matched_partsizes():
+    """
+    Get the part sizes (most recent first) that matched the multipart ETag of
+    a key in :meth:`S3File.multipart_etag_matches_localfile`. Keys in the same
+    bucket are usually uploaded by the same client, so these are tried before
+    the other candidates.
+    """
+    with _matched_partsizes_lock:
+        return list(_matched_partsizes)
 
 class S3File(object):
     """
@@ -229,6 +414,19 @@ class S3File(object):
     def __init__(self, bucket, key):
         self.bucket = bucket
         self.key = key
+        self._has_headinfo = False
+
+    def with_bucket(self, bucket):
+        """
+        Get a copy of this S3File using ``bucket`` (typically the same bucket
+        from another connection). The metadata of the key, like the etag, is
+        kept.
+        """
+        key = copy(self.key)
+        key.bucket = bucket
+        s3file = self.__class__(bucket, key)
+        s3file._has_headinfo = self._has_headinfo
+        return s3file
 
     def _overwrite_check(self, overwrite):
         if not overwrite and self.key.exists():
@@ -238,11 +436,30 @@ class S3File(object):
         if self.key.etag == None or self.key.is_latest == None:
             raise S3FileNoInfo(self)
 
+    def perform_headrequest(self):
+        """
+        Replace :obj:`.key` with a key loaded with a HEAD request, which
+        includes metadata, size and etag.
+
+        :raise S3FileDoesNotExist:
+            If the key does not exist in the bucket.
+        """
+        key = self.bucket.get_key(self.key.name)
+        if key is None:
+            raise S3FileDoesNotExist(self)
+        self.key = key
+        self._has_headinfo = True
+
     def get_metadata(self, metadata_name):
         self._has_info_check()
         return self.key.get_metadata(metadata_name)
 
     def get_checksum(self):
+        """
+        Get the md5 checksum stored in the ``awsfabchecksum`` metadata when
+        the file was uploaded with :meth:`.multipart_upload_from_filename`.
+        Returns ``None`` if the metadata is not set.
+        """
         return self.get_metadata('awsfabchecksum')
 
     def exists(self):
@@ -258,12 +475,110 @@ class S3File(object):
         self._has_info_check()
         return self.key.etag.strip('"')
 
-    def etag_matches_localfile(self, localfile):
+    def _get_localfile_checksum(self, localfile, kind, compute, checksumcache):
+        if checksumcache is not None:
+            return checksumcache.get_checksum(localfile, kind, compute)
+        return compute(localfile)
+
+    def _get_localfile_md5sum(self, localfile, checksumcache):
+        return self._get_localfile_checksum(localfile, 'md5', compute_localfile_md5sum,
+                                            checksumcache)
+
+    def multipart_etag_matches_localfile(self, localfile, checksumcache=None):
+        """
+        Check if ``localfile`` matches this S3 key when the key was uploaded
+        with multipart upload (see :func:`parse_multipart_etag`).
+
+        First, the multipart ETag of ``localfile`` is computed for each of the
+        part sizes that gives the same number of parts as the key (see
+        :func:`get_multipart_partsize_candidates`). If none of them match, we
+        fall back to comparing the md5 checksum of ``localfile`` with
+        :meth:`.get_checksum` (this requires a HEAD request unless one has
+        been performed already).
+
+        :param checksumcache: See :meth:`.etag_matches_localfile`.
+        :return:
+            ``True`` or ``False``, or ``None`` if we can not tell (no part
+            size matches, and the key has no ``awsfabchecksum`` metadata).
+        """
+        etag = self.get_etag()
+        parsed = parse_multipart_etag(etag)
+        if not parsed:
+            return etag == self._get_localfile_md5sum(localfile, checksumcache)
+        partcount = parsed[1]
+        filesize = getsize(localfile)
+        if filesize != self.key.size and self.key.size is not None:
+            return False
+        filestat_key = get_filestat_key(abspath(localfile))
+        candidates = get_multipart_partsize_candidates(filesize, partcount)
+        checksums = {}
+        if checksumcache is not None:
+            for kind in [_get_multipart_etag_kind(partsize) for partsize in candidates] + ['md5']:
+                checksum = checksumcache.lookup(localfile, kind, filestat_key)
+                if checksum is not None:
+                    checksums[kind] = checksum
+
+        def compute(partsizes, include_md5):
+            computed = compute_localfile_checksums(localfile, partsizes, include_md5)
+            for partsize_or_md5, checksum in computed.items():
+                kind = partsize_or_md5
+                if partsize_or_md5 != 'md5':
+                    kind = _get_multipart_etag_kind(partsize_or_md5)
+                checksums[kind] = checksum
+                if checksumcache is not None:
+                    checksumcache.store(localfile, kind, checksum, filestat_key)
+
+        def find_match():
+            for partsize in candidates:
+                if checksums.get(_get_multipart_etag_kind(partsize)) == etag:
+                    _remember_matched_partsize(partsize)
+                    return True
+            return False
+
+        if find_match():
+            return True
+        missing = [partsize for partsize in candidates
+                   if not _get_multipart_etag_kind(partsize) in checksums]
+
+        # Try the part sizes that matched other keys first. Usually only
+        # a single checksum has to be computed.
+        recent = [partsize for partsize in get_matched_partsizes() if partsize in missing]
+        if recent:
+            compute(recent[:1], False)
+            if find_match():
+                return True
+            missing.remove(recent[0])
+
+        # Compute the rest of the candidates and the md5 checksum (for the
+        # awsfabchecksum fallback) in a single pass
+        if missing or not 'md5' in checksums:
+            compute(missing, not 'md5' in checksums)
+            if find_match():
+                return True
+        if not self._has_headinfo:
+            self.perform_headrequest()
+        checksum = self.get_checksum()
+        if checksum is None:
+            return None
+        return checksum == checksums['md5']
+
+    def etag_matches_localfile(self, localfile, checksumcache=None):
         """
         Return ``True`` if the file at the path given in ``localfile`` has an
         md5 hex-digested checksum matching the etag of this S3 key.
+
+        Keys uploaded with multipart upload do not have the md5 checksum as
+        etag. These are compared using :meth:`.multipart_etag_matches_localfile`,
+        and are considered different if we can not tell if they match.
+
+        :param checksumcache:
+            A :class:`awsfabrictasks.s3.checksumcache.ChecksumCache` used to
+            avoid reading files that have not changed since they were last
+            hashed. Optional.
         """
-        return self.get_etag() == compute_localfile_md5sum(localfile)
+        if parse_multipart_etag(self.get_etag()):
+            return bool(self.multipart_etag_matches_localfile(localfile, checksumcache))
+        return self.get_etag() == self._get_localfile_md5sum(localfile, checksumcache)
 
     def delete(self):
         """
@@ -288,17 +603,97 @@ class S3File(object):
         self._overwrite_check(overwrite)
         self.key.set_contents_from_string(data)
 
-    def set_contents_from_filename(self, localfile, overwrite=False):
+    def set_contents_from_filename(self, localfile, overwrite=False, multipart=None):
         """
         Upload ``localfile``.
 
         :param overwrite:
             If ``True``, overwrite if the key/file exists.
+        :param multipart:
+            Use :meth:`.multipart_upload_from_filename`? Defaults to ``None``,
+            which uses multipart upload if ``localfile`` is larger than
+            ``awsfab_settings.S3_MULTIPART_THRESHOLD``.
         :raise S3FileExistsError:
             If ``overwrite==True`` and the key exists in the bucket.
+        :raise S3MultipartUploadError: If the multipart upload fails.
         """
         self._overwrite_check(overwrite)
-        self.key.set_contents_from_filename(localfile)
+        if multipart is None:
+            threshold = awsfab_settings.S3_MULTIPART_THRESHOLD
+            multipart = threshold is not None and getsize(localfile) > threshold
+        if multipart:
+            self.multipart_upload_from_filename(localfile)
+        else:
+            self.key.set_contents_from_filename(localfile)
+
+    def multipart_upload_from_filename(self, localfile, partsize=None, workers=None,
+                                       retries=None, get_bucket=None):
+        """
+        Upload ``localfile`` in parts using S3 multipart upload. Does not check
+        if the key exists (use :meth:`.set_contents_from_filename` for that).
+
+        The parts are uploaded concurrently, each worker thread using its own
+        S3 connection. A part that fails is retried, and if it fails too many
+        times, the upload is aborted.
+
+        The ETag of a multipart upload is not the md5 checksum of the file, so
+        the md5 checksum is stored in the ``awsfabchecksum`` metadata (see
+        :meth:`.get_checksum`).
+
+        :param partsize:
+            Defaults to ``awsfab_settings.S3_MULTIPART_PARTSIZE``. Increased
+            to :obj:`S3_MULTIPART_MIN_PARTSIZE` if smaller.
+        :param workers: Defaults to ``awsfab_settings.S3_MULTIPART_WORKERS``.
+        :param retries: Defaults to ``awsfab_settings.S3_MULTIPART_RETRIES``.
+        :param get_bucket:
+            Callable returning a new bucket object for a worker. Defaults to
+            getting :obj:`.bucket` from a new connection.
+        :raise S3MultipartUploadError: If any of the parts fails.
+        """
+        partsize = max(int(partsize or awsfab_settings.S3_MULTIPART_PARTSIZE),
+                       S3_MULTIPART_MIN_PARTSIZE)
+        workers = int(workers or awsfab_settings.S3_MULTIPART_WORKERS)
+        if retries is None:
+            retries = awsfab_settings.S3_MULTIPART_RETRIES
+        get_bucket = get_bucket or (lambda: S3ConnectionWrapper.get_bucket(self.bucket.name,
+                                                                           validate=False))
+        parts = get_multipart_parts(getsize(localfile), partsize)
+        if not parts:
+            # S3 does not accept multipart uploads without any parts
+            self.key.set_contents_from_filename(localfile)
+            return
+        headers = {'Content-Type': guess_type(localfile)[0] or 'application/octet-stream'}
+        metadata = {'awsfabchecksum': compute_localfile_md5sum(localfile)}
+        upload = self.bucket.initiate_multipart_upload(self.key.name, headers=headers,
+                                                       metadata=metadata)
+        workerstate = threading_local()
+
+        def upload_part(part):
+            partnumber, offset, size = part
+            if not hasattr(workerstate, 'upload'):
+                workerstate.upload = copy(upload)
+                workerstate.upload.bucket = get_bucket()
+            for attempt in range(retries + 1):
+                try:
+                    with open(localfile, 'rb') as fp:
+                        fp.seek(offset)
+                        workerstate.upload.upload_part_from_file(fp, partnumber, size=size)
+                    return size
+                except Exception:
+                    if attempt == retries:
+                        raise
+                    sleep(min(2 ** attempt, 10))
+
+        try:
+            for part, size, error in iter_parallel(upload_part, parts, workers=workers):
+                if error:
+                    raise S3MultipartUploadError(self, part[0], error)
+            upload.complete_upload()
+        except BaseException:
+            # Uploaded parts of an upload that is not completed are stored
+            # (and billed) until the upload is cancelled
+            upload.cancel_upload()
+            raise
 
     def get_contents_as_string(self):
         """
@@ -306,11 +701,112 @@ class S3File(object):
         """
         return self.key.get_contents_as_string()
 
-    def get_contents_to_filename(self, localfile):
+    def get_contents_to_filename(self, localfile, ranged=None):
         """
         Download the file to the given ``localfile``.
+
+        :param ranged:
+            Use :meth:`.ranged_download_to_filename`? Defaults to ``None``,
+            which uses a ranged download if the key is larger than
+            ``awsfab_settings.S3_RANGED_DOWNLOAD_THRESHOLD``. If the size of
+            the key is not known, the plain GET is started to get the size
+            from the response (without an extra HEAD request), and it is
+            only abandoned for a ranged download if the key is too large.
+        :raise S3RangedDownloadError: If the ranged download fails.
+        """
+        if ranged is None:
+            threshold = awsfab_settings.S3_RANGED_DOWNLOAD_THRESHOLD
+            if threshold is None:
+                ranged = False
+            elif self.key.size is None:
+                self.key.open_read()
+                ranged = self.key.size > threshold
+                if ranged:
+                    self.key.close(fast=True)
+            else:
+                ranged = self.key.size > threshold
+        if ranged:
+            self.ranged_download_to_filename(localfile)
+        else:
+            self.key.get_contents_to_filename(localfile)
+
+    def ranged_download_to_filename(self, localfile, partsize=None, workers=None,
+                                    retries=None, get_bucket=None):
         """
-        self.key.get_contents_to_filename(localfile)
+        Download the file to ``localfile`` in byte ranges fetched concurrently
+        (using HTTP Range requests), each worker thread using its own S3
+        connection. A range that fails is retried.
+
+        The ranges are written at their offset in a preallocated temporary
+        file next to ``localfile``, which replaces ``localfile`` when the
+        download is complete, and the size and etag of the downloaded file
+        matches the key.
+
+        :param partsize: Defaults to ``awsfab_settings.S3_RANGED_DOWNLOAD_PARTSIZE``.
+        :param workers: Defaults to ``awsfab_settings.S3_RANGED_DOWNLOAD_WORKERS``.
+        :param retries: Defaults to ``awsfab_settings.S3_RANGED_DOWNLOAD_RETRIES``.
+        :param get_bucket:
+            Callable returning a new bucket object for a worker. Defaults to
+            getting :obj:`.bucket` from a new connection.
+        :raise S3RangedDownloadError:
+            If any of the ranges fails, or the downloaded file does not match
+            the size or etag of the key.
+        """
+        partsize = int(partsize or awsfab_settings.S3_RANGED_DOWNLOAD_PARTSIZE)
+        workers = int(workers or awsfab_settings.S3_RANGED_DOWNLOAD_WORKERS)
+        if retries is None:
+            retries = awsfab_settings.S3_RANGED_DOWNLOAD_RETRIES
+        get_bucket = get_bucket or (lambda: S3ConnectionWrapper.get_bucket(self.bucket.name,
+                                                                           validate=False))
+        if self.key.size is None or self.key.etag is None:
+            self.perform_headrequest()
+        size = self.key.size
+        tmpfile = '{0}.awsfab-download'.format(localfile)
+        with open(tmpfile, 'wb') as fp:
+            fp.truncate(size)
+        workerstate = threading_local()
+
+        def download_range(part):
+            partnumber, offset, length = part
+            if not hasattr(workerstate, 'bucket'):
+                workerstate.bucket = get_bucket()
+            for attempt in range(retries + 1):
+                key = copy(self.key)
+                key.bucket = workerstate.bucket
+                try:
+                    with open(tmpfile, 'r+b') as fp:
+                        fp.seek(offset)
+                        key.get_file(fp, headers={'Range': 'bytes={0}-{1}'.format(
+                            offset, offset + length - 1)})
+                        if fp.tell() != offset + length:
+                            raise IOError('Got {0} bytes, expected {1}'.format(
+                                fp.tell() - offset, length))
+                    return length
+                except Exception:
+                    if attempt == retries:
+                        raise
+                    sleep(min(2 ** attempt, 10))
+
+        try:
+            ranges = get_multipart_parts(size, partsize)
+            for part, length, error in iter_parallel(download_range, ranges, workers=workers):
+                if error:
+                    raise S3RangedDownloadError(self, 'Range {0}-{1} failed: {2}'.format(
+                        part[1], part[1] + part[2] - 1, error))
+            if getsize(tmpfile) != size:
+                raise S3RangedDownloadError(self, 'Downloaded {0} bytes, expected {1}'.format(
+                    getsize(tmpfile), size))
+            if parse_multipart_etag(self.get_etag()):
+                # None means that we can not tell, so we only fail on a mismatch
+                matches = self.multipart_etag_matches_localfile(tmpfile) is not False
+            else:
+                matches = self.etag_matches_localfile(tmpfile)
+            if not matches:
+                raise S3RangedDownloadError(self, 'The downloaded file does not match the etag')
+        except BaseException:
+            remove(tmpfile)
+            raise
+        rename(tmpfile, localfile)
 
     def __str__(self):
         return '{classname}({bucket}, {name})'.format(classname=self.__class__.__name__,
@@ -343,6 +839,9 @@ class S3SyncIterFile(object):
         #: S3 file exists?
         self.s3exists = False
 
+        #: A :class:`awsfabrictasks.s3.checksumcache.ChecksumCache` or ``None``.
+        self.checksumcache = None
+
     def __str__(self):
         return ('S3SyncIterFile(localpath={localpath}, '
                 'localexists={localexists}, s3path={s3path}, s3file={s3file}, '
@@ -358,9 +857,9 @@ class S3SyncIterFile(object):
         """
         Shortcut for::
 
-            self.s3file.etag_matches_localfile(self.localpath)
+            self.s3file.etag_matches_localfile(self.localpath, self.checksumcache)
         """
-        return self.s3file.etag_matches_localfile(self.localpath)
+        return self.s3file.etag_matches_localfile(self.localpath, self.checksumcache)
 
     def create_localdir(self):
         """
@@ -368,7 +867,12 @@ class S3SyncIterFile(object):
         """
         dname = dirname(self.localpath)
         if not exists(dname):
-            makedirs(dname)
+            try:
+                makedirs(dname)
+            except OSError:
+                # Another sync worker may have created it
+                if not exists(dname):
+                    raise
 
     def download_s3file_to_localfile(self):
         """
@@ -386,15 +890,19 @@ class S3Sync(object):
 
     A good example is the sourcecode for :func:`awsfabrictasks.s3.tasks.s3_syncupload_dir`.
     """
-    def __init__(self, bucket, local_dir, s3prefix):
+    def __init__(self, bucket, local_dir, s3prefix, checksumcache=None):
         """
         :param bucket: A :class:`boto.rds.bucket.DBInstance` object.
         :param local_dir: The local directory.
         :param local_dir: The S3 key prefix that corresponds to ``local_dir``.
+        :param checksumcache:
+            A :class:`awsfabrictasks.s3.checksumcache.ChecksumCache` added to
+            each of the yielded :class:`S3SyncIterFile` objects. Optional.
         """
         self.bucket = bucket
         self.local_dir = local_dir
         self.s3prefix = force_slashend(s3prefix)
+        self.checksumcache = checksumcache
 
     def _get_localfiles_set(self):
         return dirlist_absfilenames(self.local_dir)
@@ -420,6 +928,7 @@ class S3Sync(object):
         # Handle files that are locally, and possibly also on S3
         for localpath in localfiles_set:
             syncfile = S3SyncIterFile()
+            syncfile.checksumcache = self.checksumcache
             syncfile.localpath = localpath
             syncfile.localexists = True
             syncfile.s3path = localpath_to_s3path(self.local_dir, localpath, self.s3prefix)
@@ -436,9 +945,158 @@ class S3Sync(object):
         for s3path in only_remote_keys:
             s3file = S3File.raw(self.bucket, s3path)
             syncfile = S3SyncIterFile()
+            syncfile.checksumcache = self.checksumcache
             syncfile.s3path = s3path
             syncfile.s3file = s3filedict[syncfile.s3path]
             syncfile.s3exists = True
             syncfile.localexists = False
             syncfile.localpath = s3path_to_localpath(self.s3prefix, s3path, self.local_dir)
             yield syncfile
+
+
+class S3SyncError(S3ErrorBase):
+    """
+    Raised by :func:`run_sync_workers` when syncing any of the files failed.
+    """
+    def __init__(self, errors):
+        """
+        :param errors: List of ``(syncfile, exception)`` tuples.
+        """
+        self.errors = errors
+
+    def __str__(self):
+        return 'Failed to sync {0} file(s): {1}'.format(
+            len(self.errors),
+            ', '.join('{0} ({1})'.format(syncfile.s3path, error) for syncfile, error in self.errors))
+
+
+class S3SyncStats(object):
+    """
+    Counts the actions and bytes transferred by :func:`run_sync_workers`.
+    Thread-safe.
+    """
+    def __init__(self, clock=time):
+        self.clock = clock
+        self.started = clock()
+        self.finished = None
+
+        #: Dict mapping each action returned by the handler (E.g.:
+        #: ``"CREATED"``) to the number of files.
+        self.actions = {}
+
+        #: Total number of bytes transferred.
+        self.bytecount = 0
+
+        #: List of ``(syncfile, exception)`` tuples.
+        self.errors = []
+        self._lock = Lock()
+
+    def add(self, action, bytecount=0):
+        with self._lock:
+            self.actions[action] = self.actions.get(action, 0) + 1
+            self.bytecount += bytecount
+
+    def add_error(self, syncfile, error):
+        with self._lock:
+            self.errors.append((syncfile, error))
+
+    def has_errors(self):
+        return bool(self.errors)
+
+    def finish(self):
+        self.finished = self.clock()
+
+    def get_filecount(self):
+        return sum(self.actions.values())
+
+    def get_elapsed(self):
+        return (self.finished or self.clock()) - self.started
+
+    def format_summary(self):
+        """
+        Format the counts and the throughput as a single line.
+        """
+        elapsed = max(self.get_elapsed(), 0.001)
+        filecount = self.get_filecount()
+        actions = ', '.join('{0}={1}'.format(action.lower(), count)
+                            for action, count in sorted(self.actions.items()))
+        return ('{filecount} file(s) ({actions}) in {elapsed:.1f}s: '
+                '{filespersec:.1f} files/s, {megabytes:.1f} MB transferred '
+                '({mbpersec:.2f} MB/s)').format(filecount=filecount,
+                                                actions=actions or 'none',
+                                                elapsed=elapsed,
+                                                filespersec=filecount / elapsed,
+                                                megabytes=self.bytecount / 1048576.0,
+                                                mbpersec=self.bytecount / 1048576.0 / elapsed)
+
+
+def run_sync_workers(bucket, syncfiles, handler, workers=None, get_bucket=None):
+    """
+    Run ``handler(syncfile)`` for each of the ``syncfiles`` in a pool of
+    worker threads.
+
+    Each worker connects to S3 on its own (boto connections can not be shared
+    between threads), and :obj:`S3SyncIterFile.s3file` is moved to that
+    connection (see :meth:`S3File.with_bucket`) before the handler is called.
+    The syncfiles are fed to the workers through a bounded queue, so only a
+    few of them are in memory at once when ``syncfiles`` is a generator (like
+    :meth:`S3Sync.iterfiles`).
+
+    When a handler fails, no more syncfiles are handed out, and the handlers
+    that are running are allowed to finish.
+
+    :param bucket: A :class:`boto.s3.bucket.Bucket` object.
+    :param syncfiles: Iterable of :class:`S3SyncIterFile` objects.
+    :param handler:
+        Callable taking a :class:`S3SyncIterFile` and returning an
+        ``(action, bytecount)`` tuple, where action is a string (E.g.:
+        ``"UPDATED"``), and bytecount is the number of bytes transferred.
+    :param workers:
+        Number of worker threads. Defaults to ``awsfab_settings.S3_SYNC_WORKERS``.
+    :param get_bucket:
+        Callable returning a new bucket object for a worker. Defaults to
+        getting ``bucket`` from a new connection.
+    :raise S3SyncError: If any of the handlers failed.
+    :return: A :class:`S3SyncStats` object.
+    """
+    workers = max(1, int(workers or awsfab_settings.S3_SYNC_WORKERS))
+    get_bucket = get_bucket or (lambda: S3ConnectionWrapper.get_bucket(bucket.name, validate=False))
+    stats = S3SyncStats()
+    jobs = Queue(maxsize=workers * 4)
+
+    def work():
+        workerbucket = None
+        while True:
+            syncfile = jobs.get()
+            if syncfile is None:
+                return
+            if stats.has_errors():
+                continue # Drain the queue
+            try:
+                if workerbucket is None:
+                    workerbucket = get_bucket()
+                syncfile.s3file = syncfile.s3file.with_bucket(workerbucket)
+                action, bytecount = handler(syncfile)
+            except Exception as e:
+                stats.add_error(syncfile, e)
+            else:
+                stats.add(action, bytecount)
+
+    threads = [Thread(target=work) for index in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for syncfile in syncfiles:
+            if stats.has_errors():
+                break
+            jobs.put(syncfile)
+    finally:
+        for thread in threads:
+            jobs.put(None)
+        for thread in threads:
+            thread.join()
+        stats.finish()
+    if stats.errors:
+        raise S3SyncError(stats.errors)
+    return stats
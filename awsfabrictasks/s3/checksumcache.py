@@ -0,0 +1,270 @@
+"""
+Persistent cache of the checksums of local files.
+
+Comparing a local directory with S3 requires the md5 checksum of every file
+that exists in both places. The :class:`ChecksumCache` stores the checksums in
+a SQLite database (``awsfab_settings.S3_CHECKSUM_CACHE``) keyed by the path,
+size, modification time and inode of the file, so files that have not changed
+since the last sync are not read again.
+
+Entries for a path are replaced when the file changes, and entries not used
+for ``awsfab_settings.S3_CHECKSUM_CACHE_MAX_AGE`` seconds are evicted when the
+cache is opened.
+
+Many processes (E.g.: two syncs running at the same time) can use the cache at
+once. Lookups only read from the database, and new checksums and last-used
+times are kept in memory and written in short, batched transactions, so a
+process never holds the write lock while it works. The database uses
+write-ahead logging, so readers are not blocked by those writes either.
+"""
+from os import makedirs, stat
+from os.path import abspath, dirname, exists, expanduser
+from threading import Lock
+from time import time
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from awsfabrictasks.conf import awsfab_settings
+from awsfabrictasks.utils import compute_localfile_md5sum
+
+
+def get_filestat_key(path):
+    """
+    Get the ``(size, mtime_ns, inode)`` tuple identifying the current
+    contents of the file at ``path``.
+    """
+    st = stat(path)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return st.st_size, mtime_ns, st.st_ino
+
+
+class ChecksumCache(object):
+    """
+    SQLite backed checksum cache. Safe to use from many threads.
+
+    Example::
+
+        cache = ChecksumCache.open()
+        try:
+            md5sum = cache.get_md5sum('/path/to/file')
+        finally:
+            cache.close()
+    """
+
+    #: Number of changes kept in memory before they are written to the
+    #: database.
+    COMMIT_INTERVAL = 50
+
+    #: Seconds changes are kept in memory before they are written to the
+    #: database.
+    COMMIT_SECONDS = 2
+
+    #: Seconds to wait for a database locked by another process before
+    #: giving up on the cache for a single lookup.
+    LOCK_TIMEOUT = 1
+
+    def __init__(self, dbpath, rehash=False, max_age=None, clock=time):
+        """
+        :param dbpath: Path to the SQLite database (created if missing).
+        :param rehash:
+            Ignore the cached checksums, and compute all checksums again
+            (the new checksums are stored in the cache).
+        :param max_age:
+            Evict entries not used for this number of seconds. Defaults to
+            ``awsfab_settings.S3_CHECKSUM_CACHE_MAX_AGE``.
+        :param clock: Callable returning the current time in seconds.
+        """
+        self.dbpath = dbpath
+        self.rehash = rehash
+        self.clock = clock
+        if max_age is None:
+            max_age = awsfab_settings.S3_CHECKSUM_CACHE_MAX_AGE
+        self._lock = Lock()
+        self._pending = {} # (path, kind) -> (size, mtime_ns, inode, checksum, last_used)
+        self._used = {} # (path, kind) -> last_used
+        self._last_commit = clock()
+        dbdir = dirname(abspath(dbpath))
+        if not exists(dbdir):
+            try:
+                makedirs(dbdir)
+            except OSError:
+                if not exists(dbdir):
+                    raise
+        self._connection = sqlite3.connect(dbpath, timeout=self.LOCK_TIMEOUT,
+                                           check_same_thread=False)
+        try:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.OperationalError:
+            pass # Locked by another process, which has already enabled WAL.
+        self._connection.execute('CREATE TABLE IF NOT EXISTS checksums ('
+                                 'path TEXT NOT NULL, kind TEXT NOT NULL, '
+                                 'size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+                                 'inode INTEGER NOT NULL, checksum TEXT NOT NULL, '
+                                 'last_used REAL NOT NULL, PRIMARY KEY (path, kind))')
+        self.evict(max_age)
+
+    @classmethod
+    def open(cls, rehash=False):
+        """
+        Open the cache in ``awsfab_settings.S3_CHECKSUM_CACHE``.
+
+        :return:
+            A :class:`ChecksumCache`, or ``None`` if the cache is disabled,
+            or the ``sqlite3`` module is not available.
+        """
+        dbpath = awsfab_settings.S3_CHECKSUM_CACHE
+        if not dbpath or sqlite3 is None:
+            return None
+        return cls(expanduser(dbpath), rehash=rehash)
+
+    def _changed(self):
+        if (len(self._pending) + len(self._used) >= self.COMMIT_INTERVAL
+                or self.clock() - self._last_commit >= self.COMMIT_SECONDS):
+            self._flush()
+
+    def _flush(self):
+        # Write the pending changes in a single short transaction. Must be
+        # called with self._lock held.
+        self._last_commit = self.clock()
+        if not (self._pending or self._used):
+            return
+        try:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO checksums '
+                '(path, kind, size, mtime_ns, inode, checksum, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [key + value for key, value in self._pending.items()])
+            self._connection.executemany(
+                'UPDATE checksums SET last_used=? WHERE path=? AND kind=?',
+                [(last_used,) + key for key, last_used in self._used.items()])
+            self._connection.commit()
+        except sqlite3.OperationalError:
+            # Locked by another process. Keep the changes for the next flush.
+            self._connection.rollback()
+            return
+        self._pending = {}
+        self._used = {}
+
+    def evict(self, max_age):
+        """
+        Remove all entries not used for ``max_age`` seconds.
+
+        :return: The number of removed entries.
+        """
+        with self._lock:
+            try:
+                cursor = self._connection.execute('DELETE FROM checksums WHERE last_used < ?',
+                                                  (self.clock() - max_age,))
+                self._connection.commit()
+            except sqlite3.OperationalError:
+                self._connection.rollback()
+                return 0 # Locked by another process. Evict on the next run.
+            return cursor.rowcount
+
+    def lookup(self, path, kind, filestat_key=None):
+        """
+        Get a cached checksum of the file at ``path``.
+
+        :param path: Path to a local file.
+        :param kind:
+            The kind of checksum (E.g.: ``"md5"``). Each kind is cached
+            separately.
+        :param filestat_key:
+            The :func:`get_filestat_key` of ``path``. Looked up if ``None``.
+        :return:
+            The checksum, or ``None`` if it is not in the cache, the file has
+            changed, or :obj:`.rehash` is ``True``.
+        """
+        if self.rehash:
+            return None
+        path = abspath(path)
+        filestat_key = tuple(filestat_key or get_filestat_key(path))
+        with self._lock:
+            pending = self._pending.get((path, kind))
+            if pending:
+                if pending[:3] == filestat_key:
+                    return pending[3]
+                return None
+            try:
+                row = self._connection.execute(
+                    'SELECT checksum FROM checksums WHERE path=? AND kind=? AND size=? '
+                    'AND mtime_ns=? AND inode=?', (path, kind) + filestat_key).fetchone()
+            except sqlite3.OperationalError:
+                return None # Locked by another process. Works just like a cache miss.
+            if row:
+                self._used[(path, kind)] = self.clock()
+                self._changed()
+                return row[0]
+        return None
+
+    def store(self, path, kind, checksum, filestat_key=None):
+        """
+        Cache the ``checksum`` of the file at ``path``.
+
+        :param filestat_key:
+            The :func:`get_filestat_key` of ``path`` from before the checksum
+            was computed (so changes made while computing the checksum are
+            detected). Looked up if ``None``.
+        """
+        path = abspath(path)
+        filestat_key = tuple(filestat_key or get_filestat_key(path))
+        with self._lock:
+            self._used.pop((path, kind), None)
+            self._pending[(path, kind)] = filestat_key + (checksum, self.clock())
+            self._changed()
+
+    def get_checksum(self, path, kind, compute):
+        """
+        Get the checksum of the file at ``path`` from the cache (see
+        :meth:`.lookup`), or compute and cache it (see :meth:`.store`).
+
+        :param path: Path to a local file.
+        :param kind: See :meth:`.lookup`.
+        :param compute:
+            Callable taking ``path`` and returning the checksum as a string.
+            Only called if the checksum is not in the cache, the file has
+            changed, or :obj:`.rehash` is ``True``.
+        """
+        filestat_key = get_filestat_key(abspath(path))
+        checksum = self.lookup(path, kind, filestat_key)
+        if checksum is None:
+            checksum = compute(path)
+            self.store(path, kind, checksum, filestat_key)
+        return checksum
+
+    def get_md5sum(self, path):
+        """
+        Get the md5 checksum of the file at ``path`` (see
+        :func:`awsfabrictasks.utils.compute_localfile_md5sum`).
+        """
+        return self.get_checksum(path, 'md5', compute_localfile_md5sum)
+
+    def commit(self):
+        """
+        Write the changes kept in memory to the database. Changes that can
+        not be written because the database is locked by another process are
+        kept for the next commit.
+        """
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """
+        Commit the changes and close the database. Changes that can not be
+        written because the database is locked are lost, which is harmless.
+        """
+        with self._lock:
+            self._flush()
+            self._connection.close()
+
+    def count(self):
+        """
+        Get the number of cached checksums (commits the changes first).
+        """
+        with self._lock:
+            self._flush()
+            return self._connection.execute('SELECT COUNT(*) FROM checksums').fetchone()[0]
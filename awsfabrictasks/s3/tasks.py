@@ -3,7 +3,7 @@ from __future__ import print_function
 from fabric.api import task, abort
 from fabric.contrib.console import confirm
 from os import linesep, remove
-from os.path import exists, expanduser, abspath
+from os.path import exists, expanduser, abspath, getsize
 
 from awsfabrictasks.utils import parse_bool
 from awsfabrictasks.utils import configureStreamLoggerForTask
@@ -12,7 +12,12 @@ from .api import S3ConnectionWrapper
 from .api import iter_bucketcontents
 from .api import S3File
 from .api import S3FileExistsError
+from .api import S3FileDoesNotExist
+from .api import S3RangedDownloadError
 from .api import S3Sync
+from .api import S3SyncError
+from .api import run_sync_workers
+from .checksumcache import ChecksumCache
 
 
 __all__ = ['s3_ls', 's3_listbuckets', 's3_createfile', 's3_uploadfile',
@@ -117,7 +122,9 @@ def s3_createfile(bucketname, keyname, contents, overwrite=False):
 @task
 def s3_uploadfile(bucketname, keyname, localfile, overwrite=False):
     """
-    Upload a local file.
+    Upload a local file. Files larger than
+    ``awsfab_settings.S3_MULTIPART_THRESHOLD`` are uploaded in parts
+    concurrently (see :meth:`awsfabrictasks.s3.api.S3File.multipart_upload_from_filename`).
 
     :param bucketname: Name of an S3 bucket.
     :param keyname: The key to create/overwrite (In filesystem terms: absolute file path).
@@ -147,7 +154,9 @@ def s3_printfile(bucketname, keyname):
 @task
 def s3_downloadfile(bucketname, keyname, localfile, overwrite=False):
     """
-    Print the contents of the given key/file to stdout.
+    Download the given key/file to ``localfile``. Keys larger than
+    ``awsfab_settings.S3_RANGED_DOWNLOAD_THRESHOLD`` are downloaded in byte
+    ranges concurrently (see :meth:`awsfabrictasks.s3.api.S3File.ranged_download_to_filename`).
 
     :param bucketname: Name of an S3 bucket.
     :param keyname: The key to download (In filesystem terms: absolute file path).
@@ -159,7 +168,10 @@ def s3_downloadfile(bucketname, keyname, localfile, overwrite=False):
         abort('Local file exists: {0}'.format(localfile))
     bucket = S3ConnectionWrapper.get_bucket_using_pattern(bucketname)
     s3file = S3File.raw(bucket, keyname)
-    print(s3file.get_contents_to_filename())
+    try:
+        s3file.get_contents_to_filename(localfile)
+    except (S3FileDoesNotExist, S3RangedDownloadError) as e:
+        abort(str(e))
 
 @task
 def s3_delete(bucketname, keyname, noconfirm=False):
@@ -181,7 +193,7 @@ def s3_delete(bucketname, keyname, noconfirm=False):
 
 
 @task
-def s3_is_same_file(bucketname, keyname, localfile):
+def s3_is_same_file(bucketname, keyname, localfile, rehash=False):
     """
     Check if the ``keyname`` in the given ``bucketname`` has the same etag as
     the md5 checksum of the given ``localfile``. Files with the same md5sum are
@@ -189,16 +201,40 @@ def s3_is_same_file(bucketname, keyname, localfile):
 
     Files matching as the same file by this task is considered the same file by
     :func:`s3_upload_dir`.
+
+    :param rehash:
+        Read ``localfile`` even if its checksum is in
+        ``awsfab_settings.S3_CHECKSUM_CACHE``. Defaults to ``False``.
     """
     localfile = expanduser(localfile)
     bucket = S3ConnectionWrapper.get_bucket_using_pattern(bucketname)
     s3file = S3File.from_head(bucket, keyname)
-    print(s3file.etag_matches_localfile(localfile))
+    checksumcache = ChecksumCache.open(rehash=parse_bool(rehash))
+    try:
+        print(s3file.etag_matches_localfile(localfile, checksumcache))
+    finally:
+        if checksumcache is not None:
+            checksumcache.close()
+
+
+def _run_sync(log, bucket, local_dir, s3prefix, handler, workers, rehash):
+    checksumcache = ChecksumCache.open(rehash=parse_bool(rehash))
+    try:
+        syncfiles = S3Sync(bucket, local_dir, s3prefix, checksumcache=checksumcache).iterfiles()
+        stats = run_sync_workers(bucket, syncfiles, handler, workers=workers)
+    except S3SyncError as e:
+        for syncfile, error in e.errors:
+            log.error('FAILED %s: %s', syncfile.s3path, error)
+        abort(str(e))
+    finally:
+        if checksumcache is not None:
+            checksumcache.close()
+    log.info('Summary: %s', stats.format_summary())
 
 
 @task
 def s3_syncupload_dir(bucketname, local_dir, s3prefix, loglevel='INFO', delete=False,
-                      pretend=False):
+                      pretend=False, workers=None, rehash=False):
     """
     Sync a local directory into a S3 bucket. Uses the same method as the
     :func:`s3_is_same_file` task to determine if a local file differs from a
@@ -211,7 +247,7 @@ def s3_syncupload_dir(bucketname, local_dir, s3prefix, loglevel='INFO', delete=F
         Controls the amount of output:
 
             QUIET --- No output.
-            INFO --- Only produce output for changes.
+            INFO --- Only produce output for changes, and a summary.
             DEBUG --- One line of output for each file.
 
         Defaults to "INFO".
@@ -220,6 +256,12 @@ def s3_syncupload_dir(bucketname, local_dir, s3prefix, loglevel='INFO', delete=F
     :param pretend:
         Do not change anything. With ``verbosity=2``, this gives a good
         overview of the changes applied by running the task.
+    :param workers:
+        Number of files to compare and upload concurrently. Defaults to
+        ``awsfab_settings.S3_SYNC_WORKERS``.
+    :param rehash:
+        Read all local files to compare them with S3, even if their checksums
+        are in ``awsfab_settings.S3_CHECKSUM_CACHE``. Defaults to ``False``.
     """
     log = configureStreamLoggerForTask(__name__, 's3_syncupload_dir',
                                        getLoglevelFromString(loglevel))
@@ -229,33 +271,41 @@ def s3_syncupload_dir(bucketname, local_dir, s3prefix, loglevel='INFO', delete=F
     bucket = S3ConnectionWrapper.get_bucket_using_pattern(bucketname)
     if pretend:
         log.info('Running in pretend mode. No changes are made.')
-    for syncfile in S3Sync(bucket, local_dir, s3prefix).iterfiles():
+
+    def upload(syncfile):
         logname = '{0}:{1}'.format(bucket.name, syncfile.s3path)
         if syncfile.both_exists():
             if syncfile.etag_matches_localfile():
                 log.debug('UNCHANGED %s', logname)
+                return 'UNCHANGED', 0
             else:
                 if not pretend:
                     log.debug('Uploading %s', logname)
                     syncfile.s3file.set_contents_from_filename(syncfile.localpath, overwrite=True)
                 log.info('UPDATED %s', logname)
+                return 'UPDATED', 0 if pretend else getsize(syncfile.localpath)
         elif syncfile.localexists:
             if not pretend:
                 log.debug('Uploading %s', logname)
                 syncfile.s3file.set_contents_from_filename(syncfile.localpath)
             log.info('CREATED %s', logname)
+            return 'CREATED', 0 if pretend else getsize(syncfile.localpath)
         else:
             if delete:
                 if not pretend:
                     syncfile.s3file.delete()
                 log.info('DELETED %s', logname)
+                return 'DELETED', 0
             else:
                 log.debug('NOT DELETED %s (it does not exist locally)', logname)
+                return 'NOT DELETED', 0
+
+    _run_sync(log, bucket, local_dir, s3prefix, upload, workers, rehash)
 
 
 @task
 def s3_syncdownload_dir(bucketname, s3prefix, local_dir, loglevel='INFO', delete=False,
-                        pretend=False):
+                        pretend=False, workers=None, rehash=False):
     """
     Sync a S3 prefix from a S3 bucket into a local directory. Uses the same
     method as the :func:`s3_is_same_file` task to determine if a local file
@@ -268,7 +318,7 @@ def s3_syncdownload_dir(bucketname, s3prefix, local_dir, loglevel='INFO', delete
         Controls the amount of output:
 
             QUIET --- No output.
-            INFO --- Only produce output for changes.
+            INFO --- Only produce output for changes, and a summary.
             DEBUG --- One line of output for each file.
 
         Defaults to "INFO".
@@ -277,6 +327,12 @@ def s3_syncdownload_dir(bucketname, s3prefix, local_dir, loglevel='INFO', delete
     :param pretend:
         Do not change anything. With ``verbosity=2``, this gives a good
         overview of the changes applied by running the task.
+    :param workers:
+        Number of files to compare and download concurrently. Defaults to
+        ``awsfab_settings.S3_SYNC_WORKERS``.
+    :param rehash:
+        Read all local files to compare them with S3, even if their checksums
+        are in ``awsfab_settings.S3_CHECKSUM_CACHE``. Defaults to ``False``.
     """
     log = configureStreamLoggerForTask(__name__, 's3_syncupload_dir',
                                        getLoglevelFromString(loglevel))
@@ -286,25 +342,33 @@ def s3_syncdownload_dir(bucketname, s3prefix, local_dir, loglevel='INFO', delete
     bucket = S3ConnectionWrapper.get_bucket_using_pattern(bucketname)
     if pretend:
         log.info('Running in pretend mode. No changes are made.')
-    for syncfile in S3Sync(bucket, local_dir, s3prefix).iterfiles():
+
+    def download(syncfile):
         logname = 'LocalFS:{0}'.format(syncfile.localpath)
         if syncfile.both_exists():
             if syncfile.etag_matches_localfile():
                 log.debug('UNCHANGED %s', logname)
+                return 'UNCHANGED', 0
             else:
                 if not pretend:
                     log.debug('Downloading %s', logname)
                     syncfile.download_s3file_to_localfile()
                 log.info('UPDATED %s', logname)
+                return 'UPDATED', 0 if pretend else (syncfile.s3file.key.size or 0)
         elif syncfile.s3exists:
             if not pretend:
                 log.debug('Downloading %s', logname)
                 syncfile.download_s3file_to_localfile()
             log.info('CREATED %s', logname)
+            return 'CREATED', 0 if pretend else (syncfile.s3file.key.size or 0)
         else:
             if delete:
                 if not pretend:
                     remove(syncfile.localpath)
                 log.info('DELETED %s', logname)
+                return 'DELETED', 0
             else:
                 log.debug('NOT DELETED %s (it does not exist on S3)', syncfile.localpath)
+                return 'NOT DELETED', 0
+
+    _run_sync(log, bucket, local_dir, s3prefix, download, workers, rehash)
@@ -1,9 +1,38 @@
 from unittest import TestCase
+import warnings
+from shutil import rmtree
+from tempfile import mkdtemp
+from os.path import join, dirname, isdir
+from threading import Thread
+import socket
 
 from awsfabrictasks.ec2.api import ec2_rsync_download_command
 from awsfabrictasks.ec2.api import ec2_rsync_upload_command
+from awsfabrictasks.ec2.api import get_ssh_control_path
+from awsfabrictasks.ec2.api import ec2_rsync_peer_command
+from awsfabrictasks.ec2.api import ec2_rsync_broadcast
+from awsfabrictasks.ec2.api import plan_broadcast_round
+from awsfabrictasks.utils import LocalCommandResult
+import awsfabrictasks.ec2.api
 from awsfabrictasks.ec2.api import Ec2LaunchInstance
+from awsfabrictasks.ec2.api import Ec2InstanceWrapper
+from awsfabrictasks.ec2.api import NoInstanceWithNameFound
+from awsfabrictasks.ec2.api import MultipleInstancesWithSameNameError
 from awsfabrictasks.ec2.api import zipit
+from awsfabrictasks.ec2.api import parse_regionlist
+from awsfabrictasks.ec2.api import parse_filterlist
+from awsfabrictasks.ec2.api import wait_for_states
+from awsfabrictasks.ec2.api import wait_for_state
+from awsfabrictasks.ec2.api import WaitForStateError
+from awsfabrictasks.ec2.api import WaitForSshError
+from awsfabrictasks.ec2.api import probe_ssh
+from awsfabrictasks.ec2.api import iter_ssh_ready
+from awsfabrictasks.ec2.api import wait_for_ssh
+from awsfabrictasks.ec2.api import PollingPolicy
+from awsfabrictasks.ec2.api import FixedPollingPolicy
+from awsfabrictasks.ec2.api import create_tags
+from awsfabrictasks.ec2.api import add_tags_to_instances
+from awsfabrictasks.ec2.api import remove_tags_from_instances
 from awsfabrictasks.conf import awsfab_settings
 
 
@@ -16,7 +45,14 @@ class TestRsync(TestCase):
 
     def setUp(self):
         self.instancewrapper = TestRsync.MockEc2InstanceWrapper()
+        self.orig_settings = dict((name, getattr(awsfab_settings, name, None))
+                                  for name in ('EXTRA_SSH_ARGS', 'SSH_CONTROL_PERSIST', 'SSH_CONTROL_DIR'))
         awsfab_settings.EXTRA_SSH_ARGS = ''
+        awsfab_settings.SSH_CONTROL_PERSIST = None
+
+    def tearDown(self):
+        for name, value in self.orig_settings.items():
+            setattr(awsfab_settings, name, value)
 
     def test_ec2_rsync_download_command(self):
         self.assertEquals(ec2_rsync_download_command(self.instancewrapper, '/etc', '/tmp/etc'),
@@ -48,16 +84,40 @@ class TestRsync(TestCase):
         self.assertEquals(ec2_rsync_upload_command(self.instancewrapper, '/tmp/etc', '/etc'),
                           'rsync -av -e "ssh -i /path/to/key.pem TEST" /tmp/etc test@example.com:/etc')
 
+    def test_ec2_rsync_upload_command_control_master(self):
+        tempdir = mkdtemp()
+        try:
+            awsfab_settings.EXTRA_SSH_ARGS = 'TEST'
+            awsfab_settings.SSH_CONTROL_PERSIST = '10m'
+            awsfab_settings.SSH_CONTROL_DIR = join(tempdir, 'control')
+            controlpath = get_ssh_control_path('test@example.com')
+            self.assertEquals(dirname(controlpath), join(tempdir, 'control'))
+            self.assertEquals(ec2_rsync_upload_command(self.instancewrapper, '/tmp/etc', '/etc'),
+                              ('rsync -av -e "ssh -i /path/to/key.pem -o ControlMaster=auto '
+                               '-o ControlPath={0} -o ControlPersist=10m TEST" '
+                               '/tmp/etc test@example.com:/etc').format(controlpath))
+            self.assertTrue(isdir(join(tempdir, 'control')))
+        finally:
+            rmtree(tempdir)
 
+    def test_control_master_disabled_by_default(self):
+        from awsfabrictasks import default_settings
+        self.assertEquals(default_settings.SSH_CONTROL_PERSIST, None)
 
+    def test_get_ssh_control_path(self):
+        awsfab_settings.SSH_CONTROL_DIR = '/tmp/control'
+        self.assertEquals(get_ssh_control_path('a@example.com'), get_ssh_control_path('a@example.com'))
+        self.assertNotEquals(get_ssh_control_path('a@example.com'), get_ssh_control_path('b@example.com'))
 
 
 class TestEc2LaunchInstance(TestCase):
     class Ec2LaunchInstanceMock(Ec2LaunchInstance):
         def _ask_for_configname(self):
             return 'ASKED'
-        def check_if_name_exists(self):
-            self.NAME_EXISTS_CHECKED = True
+        @classmethod
+        def check_if_names_exist(cls, launchers):
+            for launcher in launchers:
+                launcher.NAME_EXISTS_CHECKED = getattr(launcher, 'NAME_EXISTS_CHECKED', 0) + 1
 
 
     def setUp(self):
@@ -65,7 +125,11 @@ class TestEc2LaunchInstance(TestCase):
                      'key_name': 'awstestkey',
                      'security_groups': ['testgroup'],
                      'extrastuff': 'test'}
+        self.orig_confirm = Ec2LaunchInstance.__dict__['_confirm']
+        Ec2LaunchInstance._confirm = staticmethod(lambda question: None)
 
+    def tearDown(self):
+        Ec2LaunchInstance._confirm = self.orig_confirm
 
     def _create_launcher(self, settings={}, launcher_kw={}):
         awsfab_settings.reset_settings(**settings)
@@ -82,7 +146,22 @@ class TestEc2LaunchInstance(TestCase):
                                         'key_name': 'awstestkey',
                                         'security_groups': ['testgroup']})
         self.assertEquals(launcher.instance, None)
-        self.assertEquals(launcher.NAME_EXISTS_CHECKED, True)
+        self.assertEquals(launcher.duplicate_name_protection, True)
+        # The name is checked when confirming or launching, not in __init__
+        self.assertFalse(hasattr(launcher, 'NAME_EXISTS_CHECKED'))
+
+    def test_confirm_checks_name_once(self):
+        launcher = self._create_launcher(settings={'EC2_LAUNCH_CONFIGS': {'ASKED': self.conf}})
+        launcher.confirm()
+        launcher.confirm()
+        self.assertEquals(launcher.NAME_EXISTS_CHECKED, 1)
+
+    def test_confirm_without_duplicate_name_protection(self):
+        launcher = self._create_launcher(settings={'EC2_LAUNCH_CONFIGS': {'ASKED': self.conf}},
+                                         launcher_kw={'duplicate_name_protection': False})
+        launcher.confirm()
+        self.Ec2LaunchInstanceMock.confirm_many([launcher])
+        self.assertFalse(hasattr(launcher, 'NAME_EXISTS_CHECKED'))
 
     def test_userdata(self):
         self.conf['user_data'] = 'testing'
@@ -109,3 +188,697 @@ class TestEc2LaunchInstance(TestCase):
         launcher = self._create_launcher(settings={'EC2_LAUNCH_CONFIGS': {'ASKED': self.conf}},
                                          launcher_kw={'extra_tags': {'port': '15010'}})
         self.assertEquals(launcher.get_all_tags(), {'sshuser': 'test', 'port': '15010'})
+
+
+
+class TestParseRegionlist(TestCase):
+    def setUp(self):
+        awsfab_settings.reset_settings(AUTH={})
+
+    def test_parse_regionlist(self):
+        self.assertEquals(parse_regionlist('eu-west-1'), ['eu-west-1'])
+        self.assertEquals(parse_regionlist('eu-west-1, us-east-1,'), ['eu-west-1', 'us-east-1'])
+
+    def test_parse_regionlist_all(self):
+        regions = parse_regionlist('all')
+        self.assertTrue('eu-west-1' in regions)
+        self.assertTrue('us-east-1' in regions)
+
+
+class TestParseFilterlist(TestCase):
+    def test_parse_filterlist(self):
+        self.assertEquals(parse_filterlist('instance-state-name=running, vpc-id=vpc-1'),
+                          {'instance-state-name': 'running', 'vpc-id': 'vpc-1'})
+        self.assertEquals(parse_filterlist(''), {})
+        self.assertEquals(parse_filterlist(None), {})
+
+    def test_parse_filterlist_or(self):
+        self.assertEquals(parse_filterlist('role=web|worker,env=prod', nameprefix='tag:'),
+                          {'tag:role': ['web', 'worker'], 'tag:env': 'prod'})
+
+    def test_parse_filterlist_invalid(self):
+        self.assertRaises(ValueError, parse_filterlist, 'role')
+        self.assertRaises(ValueError, parse_filterlist, '=web')
+
+    def test_parse_filterlist_empty_value(self):
+        self.assertEquals(parse_filterlist('role=', nameprefix='tag:'), {'tag:role': ''})
+        self.assertEquals(parse_filterlist('role=web|', nameprefix='tag:'), {'tag:role': ['web', '']})
+
+
+class MockInstance(object):
+    def __init__(self, id, tags={}, state='running'):
+        self.id = id
+        self.tags = dict(tags)
+        self.state = state
+
+class MockReservation(object):
+    def __init__(self, instances):
+        self.instances = instances
+
+class MockResultSet(list):
+    next_token = None
+
+class MockConnection(object):
+    def __init__(self, instances):
+        self.instances = instances
+        self.requests = []
+
+    def _matches(self, instance, filters):
+        for name, values in filters.items():
+            if not isinstance(values, list):
+                values = [values]
+            if name == 'instance-id':
+                value = instance.id
+            elif name == 'instance-state-name':
+                value = instance.state
+            elif name.startswith('tag:'):
+                value = instance.tags.get(name[4:])
+            else:
+                value = getattr(instance, name.replace('-', '_'), None)
+            if not value in values:
+                return False
+        return True
+
+    def get_all_instances(self, instance_ids=None, filters={}):
+        self.requests.append(filters)
+        return [MockReservation([instance]) for instance in self.instances
+                if self._matches(instance, filters)]
+
+    def get_all_reservations(self, instance_ids=None, filters=None,
+                             max_results=None, next_token=None):
+        filters = filters or {}
+        if not next_token:
+            self.requests.append(filters)
+        matching = [MockReservation([instance]) for instance in self.instances
+                    if self._matches(instance, filters)]
+        start = int(next_token or 0)
+        end = max_results and start + max_results or len(matching)
+        page = MockResultSet(matching[start:end])
+        if end < len(matching):
+            page.next_token = str(end)
+        return page
+
+
+class TestEc2InstanceWrapperGetMany(TestCase):
+    def setUp(self):
+        awsfab_settings.reset_settings(DEFAULT_REGION='eu-west-1', REGION_WORKERS=4, AUTH={},
+                                       EC2_PAGE_SIZE=500)
+        connections = {
+            'eu-west-1': MockConnection([MockInstance('i-a', {'Name': 'a', 'role': 'web'}),
+                                         MockInstance('i-b', {'Name': 'b', 'role': 'web'}),
+                                         MockInstance('i-c', {'Name': 'dup'}),
+                                         MockInstance('i-d', {'Name': 'dup'})]),
+            'us-east-1': MockConnection([MockInstance('i-x', {'Name': 'x'})])
+        }
+        self.connections = connections
+        class MockEc2InstanceWrapper(Ec2InstanceWrapper):
+            @classmethod
+            def get_connection(cls, region=None):
+                return connections[region]
+        self.wrapperclass = MockEc2InstanceWrapper
+
+    def _ids(self, instancewrappers):
+        return [instancewrapper['id'] for instancewrapper in instancewrappers]
+
+    def test_get_many(self):
+        instancewrappers = self.wrapperclass.get_many(instanceids=['i-a', 'us-east-1:i-x'],
+                                                      names=['b', 'us-east-1:x'])
+        self.assertEquals(self._ids(instancewrappers), ['i-a', 'i-x', 'i-b'])
+
+    def test_get_many_single_request_per_lookup(self):
+        self.wrapperclass.get_many(instanceids=['i-a', 'i-b'], names=['a', 'b'])
+        self.assertEquals(self.connections['eu-west-1'].requests,
+                          [{'instance-id': ['i-a', 'i-b']},
+                           {'tag:Name': ['a', 'b']}])
+        self.assertEquals(self.connections['us-east-1'].requests, [])
+
+    def test_get_many_tags(self):
+        instancewrappers = self.wrapperclass.get_many(names=['a'], tags={'role': 'web'})
+        self.assertEquals(self._ids(instancewrappers), ['i-a', 'i-b'])
+
+    def test_get_many_filters(self):
+        self.connections['eu-west-1'].instances[1].state = 'stopped'
+        instancewrappers = self.wrapperclass.get_many(
+            tags={'role': ['web', 'worker']},
+            filters={'instance-state-name': 'running'})
+        self.assertEquals(self._ids(instancewrappers), ['i-a'])
+        self.assertEquals(self.connections['eu-west-1'].requests,
+                          [{'tag:role': ['web', 'worker'], 'instance-state-name': 'running'}])
+
+    def test_get_many_filters_without_tags(self):
+        instancewrappers = self.wrapperclass.get_many(filters={'instance-id': ['i-c', 'i-d']})
+        self.assertEquals(self._ids(instancewrappers), ['i-c', 'i-d'])
+
+    def test_get_many_no_such_name(self):
+        self.assertRaises(NoInstanceWithNameFound, self.wrapperclass.get_many,
+                          names=['a', 'doesnotexist'])
+
+    def test_get_many_duplicate_name(self):
+        self.assertRaises(MultipleInstancesWithSameNameError, self.wrapperclass.get_many,
+                          names=['dup'])
+
+    def test_get_many_no_such_instanceid(self):
+        self.assertRaises(LookupError, self.wrapperclass.get_many,
+                          instanceids=['us-east-1:i-a'])
+
+    def test_iter_instances_paginated(self):
+        connection = self.connections['eu-west-1']
+        pages = []
+        get_all_reservations = connection.get_all_reservations
+        def get_page(**kwargs):
+            pages.append((kwargs['max_results'], kwargs['next_token']))
+            return get_all_reservations(**kwargs)
+        connection.get_all_reservations = get_page
+        instancewrappers = self.wrapperclass.iter_instances(region='eu-west-1', page_size=3)
+        self.assertEquals(next(instancewrappers)['id'], 'i-a')
+        self.assertEquals(pages, [(3, None)])
+        self.assertEquals(self._ids(instancewrappers), ['i-b', 'i-c', 'i-d'])
+        self.assertEquals(pages, [(3, None), (3, '3')])
+
+    def test_iter_instances_filters(self):
+        filters = {'tag:role': 'web', 'instance-id': ['i-b', 'i-c']}
+        instancewrappers = self.wrapperclass.iter_instances(filters=filters, region='eu-west-1')
+        self.assertEquals(self._ids(instancewrappers), ['i-b'])
+
+    def test_get_by_tagvalue(self):
+        instancewrappers = self.wrapperclass.get_by_tagvalue({'role': 'web'}, region='eu-west-1')
+        self.assertEquals(self._ids(instancewrappers), ['i-a', 'i-b'])
+        self.assertEquals(self.connections['eu-west-1'].requests, [{'tag:role': 'web'}])
+
+
+class MockStateChangingConnection(MockConnection):
+    """
+    Each instance changes state to ``running`` after the number of requests
+    given in ``polls_until_running``.
+    """
+    def __init__(self, instances, polls_until_running):
+        super(MockStateChangingConnection, self).__init__(instances)
+        self.polls_until_running = polls_until_running
+
+    def get_all_reservations(self, instance_ids=None, filters=None,
+                             max_results=None, next_token=None):
+        for instance in self.instances:
+            if len(self.requests) >= self.polls_until_running[instance.id]:
+                instance.state = 'running'
+        return super(MockStateChangingConnection, self).get_all_reservations(
+            instance_ids, filters, max_results, next_token)
+
+
+class TestWaitForStates(TestCase):
+    def setUp(self):
+        awsfab_settings.reset_settings(DEFAULT_REGION='eu-west-1', REGION_WORKERS=4, AUTH={},
+                                       EC2_PAGE_SIZE=500)
+        self.connections = {
+            'eu-west-1': MockStateChangingConnection([MockInstance('i-a', state='pending'),
+                                                      MockInstance('i-b', state='pending')],
+                                                     {'i-a': 1, 'i-b': 3}),
+            'us-east-1': MockStateChangingConnection([MockInstance('i-x', state='pending')],
+                                                     {'i-x': 0})
+        }
+        self.orig_get_connection = Ec2InstanceWrapper.__dict__['get_connection']
+        Ec2InstanceWrapper.get_connection = classmethod(lambda cls, region=None: self.connections[region])
+
+    def tearDown(self):
+        Ec2InstanceWrapper.get_connection = self.orig_get_connection
+
+    def test_wait_for_states(self):
+        reached = wait_for_states(['i-a', 'i-b', 'us-east-1:i-x'], 'running',
+                                  policy=FixedPollingPolicy([0]))
+        self.assertEquals(sorted(reached.keys()), ['i-a', 'i-b', 'us-east-1:i-x'])
+        self.assertEquals(reached['i-b']['state'], 'running')
+        # One request per region per poll, and instances that are running are not polled again
+        self.assertEquals(self.connections['eu-west-1'].requests,
+                          [{'instance-id': ['i-a', 'i-b']},
+                           {'instance-id': ['i-a', 'i-b']},
+                           {'instance-id': ['i-b']},
+                           {'instance-id': ['i-b']}])
+        self.assertEquals(len(self.connections['us-east-1'].requests), 1)
+
+    def test_wait_for_states_same_instance_with_and_without_region(self):
+        reached = wait_for_states(['i-a', 'eu-west-1:i-a', 'i-a'], 'running',
+                                  policy=FixedPollingPolicy([0]))
+        self.assertEquals(sorted(reached.keys()), ['eu-west-1:i-a', 'i-a'])
+        self.assertTrue(reached['i-a'] is reached['eu-west-1:i-a'])
+        self.assertEquals(self.connections['eu-west-1'].requests,
+                          [{'instance-id': ['i-a']},
+                           {'instance-id': ['i-a']}])
+
+    def test_wait_for_state_reuses_connection(self):
+        from awsfabrictasks.connections import connection_registry
+        Ec2InstanceWrapper.get_connection = self.orig_get_connection
+        awsfab_settings.CONNECTION_MAX_IDLE = 60
+        connects = []
+        def connect(service):
+            def connect_to_region(region_name, **auth):
+                connects.append(region_name)
+                return self.connections[region_name]
+            return connect_to_region
+        orig_connect = connection_registry.connect
+        connection_registry.clear()
+        connection_registry.connect = connect
+        try:
+            wait_for_state('i-b', 'running', policy=FixedPollingPolicy([0]))
+        finally:
+            connection_registry.connect = orig_connect
+            connection_registry.clear()
+        self.assertEquals(len(self.connections['eu-west-1'].requests), 4)
+        self.assertEquals(connects, ['eu-west-1'])
+
+    def test_wait_for_states_timeout(self):
+        try:
+            wait_for_states(['i-a', 'i-b'], 'running', policy=FixedPollingPolicy([0], 1))
+        except WaitForStateError as e:
+            self.assertEquals(list(e.reached.keys()), ['i-a'])
+            self.assertEquals(e.pending, ['i-b'])
+        else:
+            self.fail('WaitForStateError not raised')
+
+    def test_wait_for_state(self):
+        instancewrapper = wait_for_state('us-east-1:i-x', 'running', policy=FixedPollingPolicy([0]))
+        self.assertEquals(instancewrapper['id'], 'i-x')
+
+    def test_wait_for_state_positional_sleep_intervals(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            instancewrapper = wait_for_state('us-east-1:i-x', 'running', [0], 1)
+        self.assertEquals(instancewrapper['id'], 'i-x')
+        self.assertTrue(DeprecationWarning in [warning.category for warning in caught])
+
+    def test_wait_for_state_default_policy(self):
+        awsfab_settings.EC2_WAIT_POLICY = {'timeout': 10, 'initial_interval': 0}
+        instancewrapper = wait_for_state('i-b', 'running')
+        self.assertEquals(instancewrapper['id'], 'i-b')
+
+
+class TestPollingPolicy(TestCase):
+    def _sleeps(self, policy, state_name=None, polls=100):
+        now = [0]
+        sleeps = []
+        for sleep_sec in policy.iter_sleeps(state_name, clock=lambda: now[0]):
+            sleeps.append(sleep_sec)
+            now[0] += sleep_sec
+            if len(sleeps) == polls:
+                break
+        return sleeps
+
+    def test_exponential_backoff(self):
+        policy = PollingPolicy(timeout=100, initial_interval=1, multiplier=2,
+                               max_interval=10, jitter=0)
+        self.assertEquals(self._sleeps(policy, polls=6), [1, 2, 4, 8, 10, 10])
+
+    def test_deadline(self):
+        policy = PollingPolicy(timeout=20, initial_interval=1, multiplier=2,
+                               max_interval=10, jitter=0)
+        sleeps = self._sleeps(policy)
+        self.assertEquals(sleeps, [1, 2, 4, 8, 5])
+        self.assertEquals(sum(sleeps), 20)
+
+    def test_jitter(self):
+        policy = PollingPolicy(timeout=100, initial_interval=4, multiplier=1,
+                               max_interval=10, jitter=0.5)
+        for sleep_sec in self._sleeps(policy, polls=20):
+            self.assertTrue(2 <= sleep_sec <= 6)
+
+    def test_state_hints(self):
+        policy = PollingPolicy(timeout=100, initial_interval=1, multiplier=2,
+                               max_interval=10, jitter=0, state_hints={'stopped': 20})
+        self.assertEquals(self._sleeps(policy, 'stopped', polls=5), [1, 2, 4, 5, 5])
+        self.assertEquals(self._sleeps(policy, 'running', polls=5), [1, 2, 4, 8, 10])
+
+    def test_from_settings(self):
+        awsfab_settings.reset_settings(EC2_WAIT_POLICY={'timeout': 30, 'jitter': 0})
+        policy = PollingPolicy.from_settings(timeout=10)
+        self.assertEquals(policy.timeout, 10)
+        self.assertEquals(policy.jitter, 0)
+
+    def test_fixed_polling_policy(self):
+        policy = FixedPollingPolicy([15, 5], 2)
+        self.assertEquals(list(policy.iter_sleeps()), [15, 5, 5, 5])
+        self.assertEquals(policy.timeout, 30)
+
+
+class MockLaunchConnection(object):
+    def __init__(self, region):
+        self.region = region
+        self.launched = []
+        self.tagged = []
+
+    def create_tags(self, resource_ids, tags):
+        self.tagged.append((sorted(resource_ids), tags))
+
+    def run_instances(self, ami, min_count=1, max_count=1, **kw):
+        self.launched.append((ami, min_count, max_count, kw))
+        instances = [MockInstance('{0}-{1}-{2}'.format(self.region, kw['instance_type'], index), {})
+                     for index in range(max_count)]
+        return MockReservation(instances)
+
+
+class TestEc2LaunchInstanceRunMany(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        conf = {'instance_type': 't1.micro',
+                'key_name': 'awstestkey',
+                'security_groups': ['testgroup'],
+                'ami': 'ami-1',
+                'region': 'eu-west-1',
+                'tags': {'role': 'web'}}
+        conf_us = dict(conf, region='us-east-1')
+        conf_large = dict(conf, instance_type='m1.large')
+        awsfab_settings.reset_settings(DEFAULT_REGION='eu-west-1', REGION_WORKERS=4, AUTH={},
+                                       EC2_INVENTORY_CACHE_DIR=self.tempdir,
+                                       EC2_LAUNCH_CONFIGS={'eu': conf, 'us': conf_us,
+                                                           'large': conf_large})
+        self.connections = {'eu-west-1': MockLaunchConnection('eu-west-1'),
+                            'us-east-1': MockLaunchConnection('us-east-1')}
+        self.orig_get_connection = Ec2InstanceWrapper.__dict__['get_connection']
+        Ec2InstanceWrapper.get_connection = classmethod(lambda cls, region=None: self.connections[region])
+
+    def tearDown(self):
+        Ec2InstanceWrapper.get_connection = self.orig_get_connection
+        rmtree(self.tempdir)
+
+    def _create_launcher(self, name, configname):
+        return Ec2LaunchInstance(extra_tags={'Name': name}, configname=configname,
+                                 duplicate_name_protection=False)
+
+    def test_run_many_instances(self):
+        launchers = [self._create_launcher('a', 'eu'),
+                     self._create_launcher('b', 'eu'),
+                     self._create_launcher('c', 'us'),
+                     self._create_launcher('d', 'large')]
+        Ec2LaunchInstance.run_many_instances(launchers)
+        eu_launched = sorted((kw['instance_type'], min_count, max_count)
+                             for ami, min_count, max_count, kw in self.connections['eu-west-1'].launched)
+        self.assertEquals(eu_launched, [('m1.large', 1, 1), ('t1.micro', 2, 2)])
+        self.assertEquals(len(self.connections['us-east-1'].launched), 1)
+        self.assertEquals([launcher.instance.tags['Name'] for launcher in launchers],
+                          ['a', 'b', 'c', 'd'])
+        self.assertEquals(len(set(launcher.instance.id for launcher in launchers)), 4)
+        self.assertEquals(launchers[0].instance.tags['role'], 'web')
+        self.assertEquals(launchers[2].get_instanceid_with_region(),
+                          'us-east-1:' + launchers[2].instance.id)
+
+    def test_get_launch_key_user_data(self):
+        awsfab_settings.EC2_LAUNCH_CONFIGS['eu']['user_data'] = '#!/bin/sh\necho hello'
+        first = self._create_launcher('a', 'eu')
+        first.kw['user_data'] = b'gzipped at another time'
+        second = self._create_launcher('b', 'eu')
+        self.assertEquals(first.get_launch_key(), second.get_launch_key())
+        awsfab_settings.EC2_LAUNCH_CONFIGS['large']['user_data'] = '#!/bin/sh\necho other'
+        self.assertNotEqual(first.get_launch_key(),
+                            self._create_launcher('c', 'large').get_launch_key())
+
+    def test_run_many_instances_bulk_tags(self):
+        launchers = [self._create_launcher('a', 'eu'),
+                     self._create_launcher('b', 'eu')]
+        Ec2LaunchInstance.run_many_instances(launchers)
+        ids = [launcher.instance.id for launcher in launchers]
+        self.assertEquals(sorted(self.connections['eu-west-1'].tagged),
+                          sorted([(sorted(ids), {'role': 'web'}),
+                                  ([ids[0]], {'Name': 'a'}),
+                                  ([ids[1]], {'Name': 'b'})]))
+
+    def test_run_instance(self):
+        launcher = self._create_launcher('a', 'eu')
+        instance = launcher.run_instance()
+        self.assertTrue(instance is launcher.instance)
+        self.assertEquals(instance.tags, {'Name': 'a', 'role': 'web'})
+
+
+class MockFlakyTaggingConnection(object):
+    def __init__(self, failures):
+        self.failures = failures
+        self.requests = []
+
+    def _request(self, *args):
+        from boto.exception import EC2ResponseError
+        self.requests.append(args)
+        if len(self.requests) <= self.failures:
+            raise EC2ResponseError(400, 'Bad Request')
+
+    def create_tags(self, resource_ids, tags):
+        self._request('create', resource_ids, tags)
+
+    def delete_tags(self, resource_ids, tagnames):
+        self._request('delete', resource_ids, tagnames)
+
+
+class TestBulkTagging(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        awsfab_settings.reset_settings(DEFAULT_REGION='eu-west-1', AUTH={},
+                                       EC2_INVENTORY_CACHE_DIR=self.tempdir)
+        self.connection = MockFlakyTaggingConnection(failures=0)
+        self.orig_get_connection = Ec2InstanceWrapper.__dict__['get_connection']
+        Ec2InstanceWrapper.get_connection = classmethod(lambda cls, region=None: self.connection)
+        self.instancewrappers = [Ec2InstanceWrapper(MockInstance('i-a', {'role': 'web'})),
+                                 Ec2InstanceWrapper(MockInstance('i-b', {'role': 'web'}))]
+
+    def tearDown(self):
+        Ec2InstanceWrapper.get_connection = self.orig_get_connection
+        rmtree(self.tempdir)
+
+    def test_add_tags_to_instances(self):
+        add_tags_to_instances(self.instancewrappers, {'env': 'prod'})
+        self.assertEquals(self.connection.requests, [('create', ['i-a', 'i-b'], {'env': 'prod'})])
+        self.assertEquals(self.instancewrappers[1]['tags'], {'role': 'web', 'env': 'prod'})
+
+    def test_remove_tags_from_instances(self):
+        remove_tags_from_instances(self.instancewrappers, ['role'])
+        self.assertEquals(self.connection.requests, [('delete', ['i-a', 'i-b'], ['role'])])
+        self.assertEquals(self.instancewrappers[0]['tags'], {})
+
+    def test_create_tags_retry(self):
+        self.connection.failures = 2
+        create_tags('eu-west-1', ['i-a'], {'env': 'prod'}, retry_sleep=0)
+        self.assertEquals(len(self.connection.requests), 3)
+
+    def test_create_tags_retry_gives_up(self):
+        from boto.exception import EC2ResponseError
+        self.connection.failures = 10
+        self.assertRaises(EC2ResponseError, create_tags, 'eu-west-1', ['i-a'], {'env': 'prod'},
+                          retry_count=2, retry_sleep=0)
+        self.assertEquals(len(self.connection.requests), 3)
+
+
+class TestEc2LaunchInstanceCheckIfNamesExist(TestCase):
+    def setUp(self):
+        conf = {'instance_type': 't1.micro',
+                'key_name': 'awstestkey',
+                'security_groups': ['testgroup'],
+                'ami': 'ami-1',
+                'region': 'eu-west-1'}
+        awsfab_settings.reset_settings(DEFAULT_REGION='eu-west-1', REGION_WORKERS=4, AUTH={}, EC2_PAGE_SIZE=500,
+                                       EC2_LAUNCH_CONFIGS={'eu': conf,
+                                                           'us': dict(conf, region='us-east-1')})
+        self.connections = {
+            'eu-west-1': MockConnection([MockInstance('i-a', {'Name': 'a'})]),
+            'us-east-1': MockConnection([MockInstance('i-b', {'Name': 'b'})])
+        }
+        self.orig_get_connection = Ec2InstanceWrapper.__dict__['get_connection']
+        Ec2InstanceWrapper.get_connection = classmethod(lambda cls, region=None: self.connections[region])
+
+    def tearDown(self):
+        Ec2InstanceWrapper.get_connection = self.orig_get_connection
+
+    def _create_launchers(self, *names_and_confignames):
+        return [Ec2LaunchInstance(extra_tags={'Name': name}, configname=configname,
+                                  duplicate_name_protection=False)
+                for name, configname in names_and_confignames]
+
+    def test_no_conflicts(self):
+        launchers = self._create_launchers(('b', 'eu'), ('c', 'eu'), ('a', 'us'))
+        Ec2LaunchInstance.check_if_names_exist(launchers)
+        self.assertEquals(self.connections['eu-west-1'].requests, [{'tag:Name': ['b', 'c']}])
+        self.assertEquals(self.connections['us-east-1'].requests, [{'tag:Name': ['a']}])
+
+    def test_conflicts(self):
+        launchers = self._create_launchers(('a', 'eu'), ('c', 'eu'), ('b', 'us'))
+        self.assertRaises(SystemExit, Ec2LaunchInstance.check_if_names_exist, launchers)
+
+    def test_confirm_many_checks_names_in_batch(self):
+        launchers = [Ec2LaunchInstance(extra_tags={'Name': name}, configname=configname)
+                     for name, configname in (('b', 'eu'), ('c', 'eu'), ('a', 'us'))]
+        self.assertEquals(self.connections['eu-west-1'].requests, [])
+        orig_confirm = Ec2LaunchInstance.__dict__['_confirm']
+        Ec2LaunchInstance._confirm = staticmethod(lambda question: None)
+        try:
+            Ec2LaunchInstance.confirm_many(launchers)
+        finally:
+            Ec2LaunchInstance._confirm = orig_confirm
+        self.assertEquals(self.connections['eu-west-1'].requests, [{'tag:Name': ['b', 'c']}])
+        self.assertEquals(self.connections['us-east-1'].requests, [{'tag:Name': ['a']}])
+        Ec2LaunchInstance._check_names_once(launchers)
+        self.assertEquals(len(self.connections['eu-west-1'].requests), 1)
+
+    def test_duplicate_launcher_names(self):
+        launchers = self._create_launchers(('c', 'eu'), ('c', 'eu'))
+        self.assertRaises(SystemExit, Ec2LaunchInstance.check_if_names_exist, launchers)
+
+
+class TestRsyncBroadcast(TestCase):
+    class MockEc2InstanceWrapper(Ec2InstanceWrapper):
+        def get_ssh_key_filename(self):
+            return '/path/to/key.pem'
+
+    def setUp(self):
+        awsfab_settings.reset_settings(DEFAULT_REGION='eu-west-1', AUTH={}, EXTRA_SSH_ARGS='',
+                                       SSH_CONTROL_PERSIST=None, RSYNC_WORKERS=4,
+                                       EC2_INSTANCE_DEFAULT_SSHUSER='root')
+        self.orig_run_local_commands = awsfabrictasks.ec2.api.run_local_commands
+        self.commands = []
+        self.failing = set()
+        def run_local_commands(commands, workers):
+            self.commands.append(commands)
+            return [LocalCommandResult(label, command, label in self.failing and 1 or 0, 0)
+                    for label, command in commands]
+        awsfabrictasks.ec2.api.run_local_commands = run_local_commands
+
+    def tearDown(self):
+        awsfabrictasks.ec2.api.run_local_commands = self.orig_run_local_commands
+
+    def _create_instancewrapper(self, index, vpc_id='vpc-1'):
+        instance = MockInstance('i-{0}'.format(index))
+        instance.public_dns_name = 'public{0}'.format(index)
+        instance.private_ip_address = '10.0.0.{0}'.format(index)
+        instance.vpc_id = vpc_id
+        return self.MockEc2InstanceWrapper(instance)
+
+    def test_plan_broadcast_round(self):
+        self.assertEquals(plan_broadcast_round(['a', 'b'], [1, 2, 3, 4, 5], 2),
+                          ([('a', 1), ('b', 2), ('a', 3), ('b', 4)], [5]))
+        self.assertEquals(plan_broadcast_round(['a'], [1], 2), ([('a', 1)], []))
+
+    def test_ec2_rsync_peer_command(self):
+        source = self._create_instancewrapper(1)
+        target = self._create_instancewrapper(2)
+        self.assertEquals(ec2_rsync_peer_command(source, target, '/srv/build'),
+                          ('ssh -A -i /path/to/key.pem  root@public1 '
+                           '\'rsync -av -e "ssh " /srv/build/ root@10.0.0.2:/srv/build\''))
+
+    def test_ec2_rsync_broadcast(self):
+        instancewrappers = [self._create_instancewrapper(index) for index in range(1, 8)]
+        results = ec2_rsync_broadcast(instancewrappers, '/tmp/build', '/srv', fanout=2)
+        self.assertEquals(sorted(result.label for result in results),
+                          sorted(w.get_ssh_uri() for w in instancewrappers))
+        self.assertEquals([len(commands) for commands in self.commands], [1, 2, 4])
+        self.assertTrue('/tmp/build root@public1:/srv' in self.commands[0][0][1])
+        self.assertTrue('/srv/build/ root@10.0.0.2:/srv/build' in self.commands[1][0][1])
+
+    def test_ec2_rsync_broadcast_failure(self):
+        instancewrappers = [self._create_instancewrapper(index) for index in range(1, 5)]
+        self.failing.add('root@public2')
+        results = ec2_rsync_broadcast(instancewrappers, '/tmp/build', '/srv', fanout=1)
+        self.assertEquals([result.label for result in results if not result.succeeded()],
+                          ['root@public2'])
+        self.assertEquals([len(commands) for commands in self.commands], [1, 1, 1, 1])
+
+    def test_ec2_rsync_broadcast_seed_per_vpc(self):
+        instancewrappers = [self._create_instancewrapper(1, 'vpc-1'),
+                            self._create_instancewrapper(2, 'vpc-2'),
+                            self._create_instancewrapper(3, 'vpc-1')]
+        ec2_rsync_broadcast(instancewrappers, '/tmp/build', '/srv')
+        self.assertEquals([label for label, command in self.commands[0]],
+                          ['root@public1', 'root@public2'])
+        self.assertEquals([label for label, command in self.commands[1]], ['root@public3'])
+
+
+class MockSshServer(Thread):
+    def __init__(self, banner=b'SSH-2.0-test\r\n'):
+        super(MockSshServer, self).__init__()
+        self.daemon = True
+        self.banner = banner
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                connection, address = self.listener.accept()
+            except socket.error:
+                return
+            connection.sendall(self.banner)
+            connection.close()
+
+    def stop(self):
+        self.listener.close()
+
+
+def get_closed_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestWaitForSsh(TestCase):
+    def setUp(self):
+        awsfab_settings.reset_settings(SSH_PROBE_WORKERS=4)
+        self.server = MockSshServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _create_instancewrapper(self, id, host):
+        instance = MockInstance(id)
+        instance.public_dns_name = host
+        instance.ip_address = None
+        return Ec2InstanceWrapper(instance)
+
+    def test_probe_ssh(self):
+        self.assertTrue(probe_ssh('127.0.0.1', self.server.port, timeout=1))
+        self.assertFalse(probe_ssh('127.0.0.1', get_closed_port(), timeout=1))
+
+    def test_probe_ssh_banner(self):
+        server = MockSshServer(banner=b'HTTP/1.1 400 Bad Request\r\n')
+        server.start()
+        try:
+            self.assertFalse(probe_ssh('127.0.0.1', server.port, timeout=1))
+            self.assertTrue(probe_ssh('127.0.0.1', server.port, timeout=1, check_banner=False))
+        finally:
+            server.stop()
+
+    def test_wait_for_ssh(self):
+        instancewrappers = [self._create_instancewrapper('i-a', '127.0.0.1'),
+                            self._create_instancewrapper('i-b', '127.0.0.1')]
+        ready = wait_for_ssh(instancewrappers, port=self.server.port,
+                             policy=FixedPollingPolicy([0], 1), probe_timeout=1)
+        self.assertEquals(sorted(instancewrapper['id'] for instancewrapper in ready),
+                          ['i-a', 'i-b'])
+
+    def test_wait_for_ssh_reuses_pool(self):
+        from threading import current_thread
+        calls = []
+        def is_ssh_ready(instancewrapper, *args):
+            calls.append(current_thread())
+            return len(calls) > 6
+        orig_is_ssh_ready = awsfabrictasks.ec2.api._is_ssh_ready
+        awsfabrictasks.ec2.api._is_ssh_ready = is_ssh_ready
+        try:
+            instancewrappers = [self._create_instancewrapper(id, '127.0.0.1')
+                                for id in ('i-a', 'i-b', 'i-c')]
+            wait_for_ssh(instancewrappers, policy=FixedPollingPolicy([0], 3))
+        finally:
+            awsfabrictasks.ec2.api._is_ssh_ready = orig_is_ssh_ready
+        self.assertEquals(len(calls), 9)
+        self.assertTrue(len(set(calls)) <= 3)
+
+    def test_wait_for_ssh_timeout(self):
+        instancewrappers = [self._create_instancewrapper('i-a', '127.0.0.1'),
+                            self._create_instancewrapper('i-b', None)]
+        ready = []
+        try:
+            for instancewrapper in iter_ssh_ready(instancewrappers, port=self.server.port,
+                                                  policy=FixedPollingPolicy([0], 1),
+                                                  probe_timeout=1):
+                ready.append(instancewrapper['id'])
+        except WaitForSshError as e:
+            self.assertEquals(ready, ['i-a'])
+            self.assertEquals(list(e.reached.keys()), ['i-a'])
+            self.assertEquals(e.pending, ['i-b'])
+        else:
+            self.fail('WaitForSshError not raised')
@@ -0,0 +1,133 @@
+from unittest import TestCase
+from shutil import rmtree
+from tempfile import mkdtemp
+from os.path import exists
+
+from awsfabrictasks.conf import awsfab_settings
+from awsfabrictasks.ec2.api import Ec2InstanceWrapper
+from awsfabrictasks.ec2.api import NoInstanceWithNameFound
+from awsfabrictasks.ec2.inventory import Ec2InventoryCache
+from awsfabrictasks.ec2.inventory import InvalidCacheMode
+from awsfabrictasks.ec2.inventory import instance_to_dict
+from awsfabrictasks.ec2.inventory import instance_from_dict
+from awsfabrictasks.ec2.inventory import invalidate_region
+from .test_api import MockInstance
+from .test_api import MockConnection
+
+
+class TestEc2InventoryCache(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        awsfab_settings.reset_settings(DEFAULT_REGION='eu-west-1', REGION_WORKERS=4,
+                                       AUTH={'aws_access_key_id': 'test'},
+                                       EC2_INVENTORY_CACHE_DIR=self.tempdir,
+                                       EC2_INVENTORY_CACHE_TTL=60, EC2_PAGE_SIZE=500)
+        connection = MockConnection([MockInstance('i-a', {'Name': 'a', 'role': 'web'}),
+                                     MockInstance('i-b', {'Name': 'b', 'role': 'web'})])
+        self.connection = connection
+        class MockEc2InstanceWrapper(Ec2InstanceWrapper):
+            @classmethod
+            def get_connection(cls, region=None):
+                return connection
+        self.wrapperclass = MockEc2InstanceWrapper
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_invalid_mode(self):
+        self.assertRaises(InvalidCacheMode, Ec2InventoryCache, 'invalid')
+
+    def test_instance_dict_roundtrip(self):
+        instance = instance_from_dict(instance_to_dict(MockInstance('i-a', {'Name': 'a'}, state='stopped')))
+        self.assertEquals(instance.id, 'i-a')
+        self.assertEquals(instance.tags, {'Name': 'a'})
+        self.assertEquals(instance.state, 'stopped')
+
+    def test_save_load(self):
+        cache = Ec2InventoryCache('use')
+        self.assertEquals(cache.load('eu-west-1'), None)
+        cache.save('eu-west-1', [MockInstance('i-a')])
+        self.assertEquals([dct['id'] for dct in cache.load('eu-west-1')], ['i-a'])
+        self.assertEquals(cache.load('us-east-1'), None)
+
+    def test_load_expired(self):
+        cache = Ec2InventoryCache('use')
+        cache.save('eu-west-1', [MockInstance('i-a')])
+        awsfab_settings.EC2_INVENTORY_CACHE_TTL = -1
+        self.assertEquals(cache.load('eu-west-1'), None)
+
+    def test_load_refresh_mode(self):
+        Ec2InventoryCache('use').save('eu-west-1', [MockInstance('i-a')])
+        self.assertEquals(Ec2InventoryCache('refresh').load('eu-west-1'), None)
+
+    def test_separated_by_access_key(self):
+        cache = Ec2InventoryCache('use')
+        cache.save('eu-west-1', [MockInstance('i-a')])
+        awsfab_settings.AUTH = {'aws_access_key_id': 'other'}
+        self.assertEquals(cache.load('eu-west-1'), None)
+
+    def test_invalidate_region(self):
+        cache = Ec2InventoryCache('use')
+        cache.save('eu-west-1', [MockInstance('i-a')])
+        invalidate_region('eu-west-1')
+        self.assertFalse(exists(cache.get_cachefile('eu-west-1')))
+
+    def test_get_many_warm_cache(self):
+        instancewrappers = self.wrapperclass.get_many(names=['a'], tags={'role': 'web'}, cache='use')
+        self.assertEquals([w['id'] for w in instancewrappers], ['i-a', 'i-b'])
+        self.assertEquals(self.connection.requests, [{}])
+        instancewrappers = self.wrapperclass.get_many(instanceids=['i-b'], names=['a'], cache='use')
+        self.assertEquals([w['id'] for w in instancewrappers], ['i-b', 'i-a'])
+        self.assertEquals(self.connection.requests, [{}])
+
+    def test_get_many_warm_cache_miss(self):
+        self.wrapperclass.get_many(names=['a'], cache='use')
+        self.connection.instances.append(MockInstance('i-c', {'Name': 'c'}))
+        instancewrappers = self.wrapperclass.get_many(instanceids=['i-c'], names=['a'], cache='use')
+        self.assertEquals([w['id'] for w in instancewrappers], ['i-c', 'i-a'])
+        self.assertEquals(self.connection.requests, [{}, {}])
+        instancewrappers = self.wrapperclass.get_many(names=['c'], cache='use')
+        self.assertEquals([w['id'] for w in instancewrappers], ['i-c'])
+        self.assertEquals(self.connection.requests, [{}, {}])
+
+    def test_get_many_warm_cache_missing_instance(self):
+        self.wrapperclass.get_many(names=['a'], cache='use')
+        self.assertRaises(LookupError, self.wrapperclass.get_many,
+                          instanceids=['i-x'], cache='use')
+        self.assertEquals(self.connection.requests, [{}, {}])
+
+        # Known to be missing, so the inventory is not fetched again
+        self.assertRaises(LookupError, self.wrapperclass.get_many,
+                          instanceids=['i-x'], cache='use')
+        self.assertRaises(NoInstanceWithNameFound, self.wrapperclass.get_many,
+                          names=['x'], cache='use')
+        self.assertEquals(self.connection.requests, [{}, {}, {}])
+        self.assertRaises(NoInstanceWithNameFound, self.wrapperclass.get_many,
+                          names=['x'], cache='use')
+        self.assertEquals(self.connection.requests, [{}, {}, {}])
+
+    def test_save_load_missing(self):
+        cache = Ec2InventoryCache('use')
+        self.assertEquals(cache.load_missing('eu-west-1'), (set(), set()))
+        cache.save('eu-west-1', [MockInstance('i-a')], missing_instanceids=['i-x'],
+                   missing_names=['x'])
+        self.assertEquals(cache.load_missing('eu-west-1'), (set(['i-x']), set(['x'])))
+
+    def test_get_many_refresh(self):
+        self.wrapperclass.get_many(names=['a'], cache='use')
+        self.wrapperclass.get_many(names=['a'], cache='refresh')
+        self.assertEquals(self.connection.requests, [{}, {}])
+
+    def test_get_many_filters_cached(self):
+        self.connection.instances[1].state = 'stopped'
+        self.wrapperclass.get_many(names=['a'], cache='use')
+        instancewrappers = self.wrapperclass.get_many(tags={'role': ['web', 'db']},
+                                                      filters={'instance-state-name': 'running'},
+                                                      cache='use')
+        self.assertEquals([w['id'] for w in instancewrappers], ['i-a'])
+        self.assertEquals(self.connection.requests, [{}])
+
+    def test_get_many_filters_not_cached(self):
+        self.wrapperclass.get_many(names=['a'], cache='use')
+        self.wrapperclass.get_many(filters={'group-name': 'web'}, cache='use')
+        self.assertEquals(self.connection.requests, [{}, {'group-name': 'web'}])
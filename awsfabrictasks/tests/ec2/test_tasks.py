@@ -0,0 +1,117 @@
+from unittest import TestCase
+
+from fabric.api import env
+
+import awsfabrictasks.ec2.tasks
+from awsfabrictasks.ec2.tasks import _get_instancewrappers_once
+from awsfabrictasks.ec2.tasks import ec2_rsync_upload_dir
+from awsfabrictasks.ec2.tasks import ec2_rsync_download_dir
+from awsfabrictasks.ec2.tasks import ec2_rsync_broadcast_dir
+
+
+class MockEc2InstanceWrapper(object):
+    @classmethod
+    def get_from_host_string(cls):
+        return env.ec2instances[env.host_string]
+
+
+class TestGetInstancewrappersOnce(TestCase):
+    def setUp(self):
+        self.orig_env = dict(env)
+        self.orig_wrapperclass = awsfabrictasks.ec2.tasks.Ec2InstanceWrapper
+        awsfabrictasks.ec2.tasks.Ec2InstanceWrapper = MockEc2InstanceWrapper
+        env.all_hosts = ['a', 'b']
+        env.ec2instances = {'a': 'wrapper-a', 'b': 'wrapper-b'}
+        env.parallel = False
+        env.pop('ec2_bulk_tasks_hosts_done', None)
+
+    def tearDown(self):
+        awsfabrictasks.ec2.tasks.Ec2InstanceWrapper = self.orig_wrapperclass
+        env.clear()
+        env.update(self.orig_env)
+
+    def _execute(self, taskname):
+        results = []
+        for host in env.all_hosts:
+            env.host_string = host
+            results.append(_get_instancewrappers_once(taskname, 'true'))
+        return results
+
+    def test_once_per_execution(self):
+        self.assertEquals(self._execute('ec2_add_tag'), [['wrapper-a', 'wrapper-b'], []])
+
+    def test_same_task_executed_twice(self):
+        self.assertEquals(self._execute('ec2_add_tag'), [['wrapper-a', 'wrapper-b'], []])
+        self.assertEquals(self._execute('ec2_add_tag'), [['wrapper-a', 'wrapper-b'], []])
+
+    def test_single_host(self):
+        env.all_hosts = ['a']
+        self.assertEquals(self._execute('ec2_add_tag'), [['wrapper-a']])
+        self.assertEquals(self._execute('ec2_add_tag'), [['wrapper-a']])
+
+    def test_parallel(self):
+        # Each host runs in a separate process with its own env
+        results = []
+        for host in env.all_hosts:
+            env.host_string = host
+            env.parallel = True
+            env.pop('ec2_bulk_tasks_hosts_done', None)
+            results.append(_get_instancewrappers_once('ec2_add_tag', 'true'))
+        self.assertEquals(results, [['wrapper-a'], ['wrapper-b']])
+
+
+class TestRsyncFanoutTasks(TestCase):
+    def setUp(self):
+        self.orig_env = dict(env)
+        env.all_hosts = ['a', 'b']
+        env.ec2instances = {'a': 'wrapper-a', 'b': 'wrapper-b'}
+        env.pop('ec2_bulk_tasks_hosts_done', None)
+        self.orig_wrapperclass = awsfabrictasks.ec2.tasks.Ec2InstanceWrapper
+        awsfabrictasks.ec2.tasks.Ec2InstanceWrapper = MockEc2InstanceWrapper
+        self.synced = []
+        self.orig_many = (awsfabrictasks.ec2.tasks.ec2_rsync_upload_many,
+                          awsfabrictasks.ec2.tasks.ec2_rsync_download_many)
+        def rsync_many(instancewrappers, *args, **kwargs):
+            self.synced.append(list(instancewrappers))
+            return []
+        awsfabrictasks.ec2.tasks.ec2_rsync_upload_many = rsync_many
+        awsfabrictasks.ec2.tasks.ec2_rsync_download_many = rsync_many
+        self.orig_broadcast = awsfabrictasks.ec2.tasks.ec2_rsync_broadcast
+        awsfabrictasks.ec2.tasks.ec2_rsync_broadcast = rsync_many
+
+    def tearDown(self):
+        awsfabrictasks.ec2.tasks.Ec2InstanceWrapper = self.orig_wrapperclass
+        (awsfabrictasks.ec2.tasks.ec2_rsync_upload_many,
+         awsfabrictasks.ec2.tasks.ec2_rsync_download_many) = self.orig_many
+        awsfabrictasks.ec2.tasks.ec2_rsync_broadcast = self.orig_broadcast
+        env.clear()
+        env.update(self.orig_env)
+
+    def _execute(self, task, parallel, *args, **kwargs):
+        for host in env.all_hosts:
+            env.host_string = host
+            env.parallel = parallel
+            if parallel:
+                # Each host runs in a separate process with its own env
+                env.pop('ec2_bulk_tasks_hosts_done', None)
+            task(*args, noconfirm=True, **kwargs)
+
+    def test_upload_serial(self):
+        self._execute(ec2_rsync_upload_dir, False, '/tmp/a', '/tmp/b', fanout=True)
+        self.assertEquals(self.synced, [['wrapper-a', 'wrapper-b']])
+
+    def test_upload_parallel(self):
+        self._execute(ec2_rsync_upload_dir, True, '/tmp/a', '/tmp/b', fanout=True)
+        self.assertEquals(self.synced, [['wrapper-a'], ['wrapper-b']])
+
+    def test_download_parallel(self):
+        self._execute(ec2_rsync_download_dir, True, '/tmp/a', '/tmp/b', fanout=True)
+        self.assertEquals(self.synced, [['wrapper-a'], ['wrapper-b']])
+
+    def test_broadcast_serial(self):
+        self._execute(ec2_rsync_broadcast_dir, False, '/tmp/a', '/tmp/b')
+        self.assertEquals(self.synced, [['wrapper-a', 'wrapper-b']])
+
+    def test_broadcast_parallel(self):
+        self._execute(ec2_rsync_broadcast_dir, True, '/tmp/a', '/tmp/b')
+        self.assertEquals(self.synced, [['wrapper-a'], ['wrapper-b']])
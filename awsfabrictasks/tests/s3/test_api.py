@@ -5,10 +5,24 @@ from shutil import rmtree
 from tempfile import mkdtemp
 from os import makedirs
 from os.path import join, exists, dirname
+from hashlib import md5
+from threading import current_thread, Lock
 
 from awsfabrictasks.s3.api import dirlist_absfilenames
 from awsfabrictasks.s3.api import localpath_to_s3path
 from awsfabrictasks.s3.api import s3path_to_localpath
+from awsfabrictasks.s3.api import S3File
+from awsfabrictasks.s3.api import S3SyncIterFile
+from awsfabrictasks.s3.api import S3SyncError
+from awsfabrictasks.s3.api import run_sync_workers
+from awsfabrictasks.s3.api import get_multipart_parts
+from awsfabrictasks.s3.api import S3MultipartUploadError
+from awsfabrictasks.s3.api import S3RangedDownloadError
+from awsfabrictasks.s3.api import parse_multipart_etag
+from awsfabrictasks.s3.api import get_multipart_partsize_candidates
+from awsfabrictasks.s3.api import compute_localfile_multipart_etag
+from awsfabrictasks.s3.api import compute_localfile_checksums
+from awsfabrictasks.conf import awsfab_settings
 
 def makefile(tempdir, path, contents):
     path = join(tempdir, *path.split('/'))
@@ -52,3 +66,481 @@ class TestLocalpathToS3path(TestCase):
     def test_s3path_to_localpath(self):
         localpath = s3path_to_localpath('mydir/', 'mydir/hello/world.txt', join(self.tempdir, 'my', 'test'))
         self.assertEquals(localpath, join(self.tempdir, 'my', 'test', 'hello', 'world.txt'))
+
+
+class MockBucket(object):
+    def __init__(self, name):
+        self.name = name
+
+def create_syncfile(bucket, s3path):
+    syncfile = S3SyncIterFile()
+    syncfile.s3path = s3path
+    syncfile.s3file = S3File.raw(bucket, s3path)
+    return syncfile
+
+
+class TestRunSyncWorkers(TestCase):
+    def setUp(self):
+        awsfab_settings.reset_settings(S3_SYNC_WORKERS=3)
+        self.bucket = MockBucket('main')
+        self.workerbuckets = []
+        self.lock = Lock()
+
+    def _get_bucket(self):
+        with self.lock:
+            bucket = MockBucket('worker{0}'.format(len(self.workerbuckets)))
+            self.workerbuckets.append(bucket)
+            return bucket
+
+    def test_run_sync_workers(self):
+        handled = {}
+        def handler(syncfile):
+            with self.lock:
+                handled[syncfile.s3path] = (syncfile.s3file.bucket, current_thread().name)
+            return 'CREATED', 10
+        syncfiles = (create_syncfile(self.bucket, 'file{0}'.format(index)) for index in range(50))
+        stats = run_sync_workers(self.bucket, syncfiles, handler, get_bucket=self._get_bucket)
+        self.assertEquals(len(handled), 50)
+        self.assertEquals(stats.actions, {'CREATED': 50})
+        self.assertEquals(stats.bytecount, 500)
+        self.assertTrue(1 <= len(self.workerbuckets) <= 3)
+
+        # Each worker uses its own bucket (connection)
+        bucketsbythread = {}
+        for bucket, threadname in handled.values():
+            bucketsbythread.setdefault(threadname, set()).add(bucket)
+            self.assertTrue(bucket in self.workerbuckets)
+        for buckets in bucketsbythread.values():
+            self.assertEquals(len(buckets), 1)
+
+    def test_run_sync_workers_error(self):
+        def handler(syncfile):
+            if syncfile.s3path == 'file3':
+                raise IOError('Failed')
+            return 'UNCHANGED', 0
+        syncfiles = [create_syncfile(self.bucket, 'file{0}'.format(index)) for index in range(200)]
+        try:
+            run_sync_workers(self.bucket, syncfiles, handler, workers=2,
+                             get_bucket=self._get_bucket)
+        except S3SyncError as e:
+            self.assertEquals([syncfile.s3path for syncfile, error in e.errors], ['file3'])
+        else:
+            self.fail('S3SyncError not raised')
+
+    def test_with_bucket(self):
+        s3file = S3File.raw(self.bucket, 'hello.txt')
+        s3file.key.etag = '"abc"'
+        other = s3file.with_bucket(MockBucket('other'))
+        self.assertEquals(other.bucket.name, 'other')
+        self.assertEquals(other.key.bucket.name, 'other')
+        self.assertEquals(other.key.etag, '"abc"')
+        self.assertEquals(s3file.key.bucket.name, 'main')
+
+
+class MockMultiPartUpload(object):
+    def __init__(self, bucket, key_name, metadata, failures):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.metadata = metadata
+        self.failures = failures
+        self.parts = {}
+        self.attempts = []
+        self.state = 'initiated'
+
+    def upload_part_from_file(self, fp, part_num, size=None):
+        self.attempts.append(part_num)
+        if self.failures.get(part_num):
+            self.failures[part_num] -= 1
+            raise IOError('Part failed')
+        self.parts[part_num] = (fp.read(size), self.bucket.name)
+
+    def complete_upload(self):
+        self.state = 'completed'
+
+    def cancel_upload(self):
+        self.state = 'cancelled'
+
+class MockMultipartBucket(MockBucket):
+    def __init__(self, name, failures={}):
+        super(MockMultipartBucket, self).__init__(name)
+        self.failures = dict(failures)
+        self.uploads = []
+
+    def initiate_multipart_upload(self, key_name, headers=None, metadata=None):
+        upload = MockMultiPartUpload(self, key_name, metadata, self.failures)
+        self.uploads.append(upload)
+        return upload
+
+
+class TestMultipartUpload(TestCase):
+    def setUp(self):
+        awsfab_settings.reset_settings(S3_MULTIPART_THRESHOLD=10, S3_MULTIPART_PARTSIZE=4,
+                                       S3_MULTIPART_WORKERS=3, S3_MULTIPART_RETRIES=2)
+        self.tempdir = mkdtemp()
+        self.localfile = makefile(self.tempdir, 'data.bin', 'abcdefghijklmnopqrstuvw')
+        import awsfabrictasks.s3.api
+        self.orig_sleep = awsfabrictasks.s3.api.sleep
+        self.orig_min_partsize = awsfabrictasks.s3.api.S3_MULTIPART_MIN_PARTSIZE
+        awsfabrictasks.s3.api.sleep = lambda seconds: None
+        awsfabrictasks.s3.api.S3_MULTIPART_MIN_PARTSIZE = 1
+
+    def tearDown(self):
+        import awsfabrictasks.s3.api
+        awsfabrictasks.s3.api.sleep = self.orig_sleep
+        awsfabrictasks.s3.api.S3_MULTIPART_MIN_PARTSIZE = self.orig_min_partsize
+        rmtree(self.tempdir)
+
+    def _upload(self, bucket):
+        s3file = S3File.raw(bucket, 'data.bin')
+        s3file.multipart_upload_from_filename(self.localfile,
+                                              get_bucket=lambda: MockBucket('worker'))
+        return bucket.uploads[0]
+
+    def test_get_multipart_parts(self):
+        self.assertEquals(get_multipart_parts(10, 4), [(1, 0, 4), (2, 4, 4), (3, 8, 2)])
+        self.assertEquals(get_multipart_parts(8, 4), [(1, 0, 4), (2, 4, 4)])
+        self.assertEquals(get_multipart_parts(0, 4), [])
+        self.assertEquals(len(get_multipart_parts(20000, 1)), 10000)
+
+    def test_multipart_upload(self):
+        upload = self._upload(MockMultipartBucket('main'))
+        self.assertEquals(upload.state, 'completed')
+        self.assertEquals(sorted(upload.parts.keys()), [1, 2, 3, 4, 5, 6])
+        data = ''.join(upload.parts[partnumber][0].decode('utf-8')
+                       for partnumber in sorted(upload.parts))
+        self.assertEquals(data, 'abcdefghijklmnopqrstuvw')
+        self.assertEquals(set(bucketname for part, bucketname in upload.parts.values()),
+                          set(['worker']))
+        self.assertEquals(upload.metadata, {'awsfabchecksum': '74525c3a55bdcaee9139bd1e33c764fb'})
+
+    def test_multipart_upload_min_partsize(self):
+        import awsfabrictasks.s3.api
+        awsfabrictasks.s3.api.S3_MULTIPART_MIN_PARTSIZE = 10
+        upload = self._upload(MockMultipartBucket('main'))
+        self.assertEquals([len(upload.parts[partnumber][0]) for partnumber in sorted(upload.parts)],
+                          [10, 10, 3])
+
+    def test_multipart_upload_retry(self):
+        upload = self._upload(MockMultipartBucket('main', failures={2: 2}))
+        self.assertEquals(upload.state, 'completed')
+        self.assertEquals(upload.attempts.count(2), 3)
+
+    def test_multipart_upload_abort(self):
+        bucket = MockMultipartBucket('main', failures={2: 3})
+        try:
+            self._upload(bucket)
+        except S3MultipartUploadError as e:
+            self.assertEquals(e.partnumber, 2)
+        else:
+            self.fail('S3MultipartUploadError not raised')
+        self.assertEquals(bucket.uploads[0].state, 'cancelled')
+
+    def test_multipart_upload_complete_fails(self):
+        bucket = MockMultipartBucket('main')
+        def complete_upload():
+            raise IOError('Complete failed')
+        orig_initiate = bucket.initiate_multipart_upload
+        def initiate_multipart_upload(*args, **kwargs):
+            upload = orig_initiate(*args, **kwargs)
+            upload.complete_upload = complete_upload
+            return upload
+        bucket.initiate_multipart_upload = initiate_multipart_upload
+        self.assertRaises(IOError, self._upload, bucket)
+        self.assertEquals(bucket.uploads[0].state, 'cancelled')
+
+
+
+class MockRangeKey(object):
+    def __init__(self, bucket, name, data, etag=None, failures=None):
+        self.bucket = bucket
+        self.name = name
+        self.data = data
+        self.size = len(data)
+        self.etag = '"{0}"'.format(etag or md5(data).hexdigest())
+        self.is_latest = False
+        self.failures = failures if failures is not None else {}
+        self.requests = []
+
+    def get_file(self, fp, headers=None):
+        start, end = [int(value) for value in headers['Range'][len('bytes='):].split('-')]
+        self.requests.append((start, end, self.bucket.name))
+        if self.failures.get(start):
+            self.failures[start] -= 1
+            fp.write(self.data[start:start + 1])
+            return
+        fp.write(self.data[start:end + 1])
+
+
+class TestRangedDownload(TestCase):
+    def setUp(self):
+        awsfab_settings.reset_settings(S3_RANGED_DOWNLOAD_THRESHOLD=10,
+                                       S3_RANGED_DOWNLOAD_PARTSIZE=4,
+                                       S3_RANGED_DOWNLOAD_WORKERS=3,
+                                       S3_RANGED_DOWNLOAD_RETRIES=2)
+        self.tempdir = mkdtemp()
+        self.localfile = join(self.tempdir, 'data.bin')
+        self.bucket = MockBucket('main')
+        import awsfabrictasks.s3.api
+        self.orig_sleep = awsfabrictasks.s3.api.sleep
+        awsfabrictasks.s3.api.sleep = lambda seconds: None
+
+    def tearDown(self):
+        import awsfabrictasks.s3.api
+        awsfabrictasks.s3.api.sleep = self.orig_sleep
+        rmtree(self.tempdir)
+
+    def _download(self, key):
+        s3file = S3File(self.bucket, key)
+        s3file.ranged_download_to_filename(self.localfile,
+                                           get_bucket=lambda: MockBucket('worker'))
+
+    def test_ranged_download(self):
+        key = MockRangeKey(self.bucket, 'data.bin', b'abcdefghijklmnopqrstuvw')
+        self._download(key)
+        self.assertEquals(open(self.localfile, 'rb').read(), b'abcdefghijklmnopqrstuvw')
+        self.assertEquals(sorted(key.requests),
+                          [(0, 3, 'worker'), (4, 7, 'worker'), (8, 11, 'worker'),
+                           (12, 15, 'worker'), (16, 19, 'worker'), (20, 22, 'worker')])
+        self.assertFalse(exists(self.localfile + '.awsfab-download'))
+
+    def test_ranged_download_retry(self):
+        key = MockRangeKey(self.bucket, 'data.bin', b'abcdefghijklmnopqrstuvw', failures={4: 2})
+        self._download(key)
+        self.assertEquals(open(self.localfile, 'rb').read(), b'abcdefghijklmnopqrstuvw')
+        self.assertEquals(len([start for start, end, bucketname in key.requests if start == 4]), 3)
+
+    def test_ranged_download_failure(self):
+        key = MockRangeKey(self.bucket, 'data.bin', b'abcdefghijklmnopqrstuvw', failures={4: 3})
+        self.assertRaises(S3RangedDownloadError, self._download, key)
+        self.assertFalse(exists(self.localfile))
+        self.assertFalse(exists(self.localfile + '.awsfab-download'))
+
+    def test_ranged_download_etag_mismatch(self):
+        key = MockRangeKey(self.bucket, 'data.bin', b'abcdefghijklmnopqrstuvw',
+                           etag='0' * 32)
+        self.assertRaises(S3RangedDownloadError, self._download, key)
+        self.assertFalse(exists(self.localfile))
+
+
+class MockStreamKey(object):
+    def __init__(self, bucket, name, data):
+        self.bucket = bucket
+        self.name = name
+        self.data = data
+        self.size = None
+        self.etag = None
+        self.requests = []
+
+    def open_read(self):
+        self.requests.append('GET')
+        self.size = len(self.data)
+        self.etag = '"{0}"'.format(md5(self.data).hexdigest())
+
+    def close(self, fast=False):
+        self.requests.append('close')
+
+    def get_contents_to_filename(self, localfile):
+        with open(localfile, 'wb') as fp:
+            fp.write(self.data)
+
+
+class TestGetContentsToFilename(TestCase):
+    def setUp(self):
+        awsfab_settings.reset_settings(S3_RANGED_DOWNLOAD_THRESHOLD=10)
+        self.tempdir = mkdtemp()
+        self.localfile = join(self.tempdir, 'data.bin')
+        self.bucket = MockHeadBucket('main', None)
+        self.ranged = []
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def _download(self, data):
+        key = MockStreamKey(self.bucket, 'data.bin', data)
+        s3file = S3File(self.bucket, key)
+        s3file.ranged_download_to_filename = lambda localfile: self.ranged.append(localfile)
+        s3file.get_contents_to_filename(self.localfile)
+        return key
+
+    def test_small_without_head(self):
+        key = self._download(b'abc')
+        self.assertEquals(key.requests, ['GET'])
+        self.assertEquals(self.bucket.headrequests, 0)
+        self.assertEquals(open(self.localfile, 'rb').read(), b'abc')
+        self.assertEquals(self.ranged, [])
+
+    def test_large_without_head(self):
+        key = self._download(b'abcdefghijklmnopqrstuvw')
+        self.assertEquals(key.requests, ['GET', 'close'])
+        self.assertEquals(self.bucket.headrequests, 0)
+        self.assertEquals(self.ranged, [self.localfile])
+
+
+def multipart_etag(data, partsize):
+    digests = [md5(data[offset:offset + partsize]).digest()
+               for offset in range(0, len(data), partsize)]
+    return '{0}-{1}'.format(md5(b''.join(digests)).hexdigest(), len(digests))
+
+class MockHeadKey(object):
+    def __init__(self, name, size, etag, metadata=None):
+        self.name = name
+        self.size = size
+        self.etag = '"{0}"'.format(etag)
+        self.is_latest = False
+        self.metadata = metadata or {}
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+class MockHeadBucket(MockBucket):
+    def __init__(self, name, headkey):
+        super(MockHeadBucket, self).__init__(name)
+        self.headkey = headkey
+        self.headrequests = 0
+
+    def get_key(self, name):
+        self.headrequests += 1
+        return self.headkey
+
+
+class TestMultipartEtag(TestCase):
+    def setUp(self):
+        awsfab_settings.reset_settings(S3_MULTIPART_PARTSIZE=4)
+        self.tempdir = mkdtemp()
+        self.data = b'abcdefghijklmnopqrstuvw'
+        self.localfile = makefile(self.tempdir, 'data.bin', self.data.decode('utf-8'))
+        import awsfabrictasks.s3.api
+        del awsfabrictasks.s3.api._matched_partsizes[:]
+        self.orig_compute = awsfabrictasks.s3.api.compute_localfile_checksums
+        self.computed = []
+        def compute(localfile, partsizes, include_md5=False):
+            self.computed.append((sorted(partsizes), include_md5))
+            return self.orig_compute(localfile, partsizes, include_md5)
+        awsfabrictasks.s3.api.compute_localfile_checksums = compute
+
+    def tearDown(self):
+        import awsfabrictasks.s3.api
+        awsfabrictasks.s3.api.compute_localfile_checksums = self.orig_compute
+        rmtree(self.tempdir)
+
+    def _create_s3file(self, etag, metadata=None):
+        listkey = MockHeadKey('data.bin', len(self.data), etag)
+        headkey = MockHeadKey('data.bin', len(self.data), etag, metadata)
+        return S3File(MockHeadBucket('main', headkey), listkey)
+
+    def test_parse_multipart_etag(self):
+        self.assertEquals(parse_multipart_etag('"abc123-12"'), ('abc123', 12))
+        self.assertEquals(parse_multipart_etag('abc123'), None)
+        self.assertEquals(parse_multipart_etag('abc-x'), None)
+
+    def test_get_multipart_partsize_candidates(self):
+        megabyte = 1024 * 1024
+        awsfab_settings.S3_MULTIPART_PARTSIZE = 16 * megabyte
+        self.assertEquals(get_multipart_partsize_candidates(100 * megabyte, 7),
+                          [16 * megabyte, 15 * megabyte])
+        self.assertEquals(get_multipart_partsize_candidates(100 * megabyte + 1, 13),
+                          [8 * megabyte])
+        self.assertEquals(get_multipart_partsize_candidates(11 * megabyte, 3),
+                          [4 * megabyte, 5 * megabyte])
+
+    def test_compute_localfile_multipart_etag(self):
+        self.assertEquals(compute_localfile_multipart_etag(self.localfile, 4),
+                          multipart_etag(self.data, 4))
+        self.assertEquals(compute_localfile_multipart_etag(self.localfile, 4)[-2:], '-6')
+
+    def test_compute_localfile_checksums(self):
+        checksums = compute_localfile_checksums(self.localfile, [3, 4, 5], include_md5=True)
+        self.assertEquals(checksums, {3: multipart_etag(self.data, 3),
+                                      4: multipart_etag(self.data, 4),
+                                      5: multipart_etag(self.data, 5),
+                                      'md5': md5(self.data).hexdigest()})
+
+    def test_single_pass(self):
+        self.data = b'0123456789' * 10
+        makefile(self.tempdir, 'data.bin', self.data.decode('utf-8'))
+        awsfab_settings.S3_MULTIPART_PARTSIZE = 11
+        import awsfabrictasks.s3.api
+        awsfabrictasks.s3.api.COMMON_MULTIPART_PARTSIZES, orig_common = \
+            [10, 12], awsfabrictasks.s3.api.COMMON_MULTIPART_PARTSIZES
+        try:
+            s3file = self._create_s3file(multipart_etag(self.data, 10))
+            self.assertTrue(s3file.etag_matches_localfile(self.localfile))
+            self.assertEquals(self.computed, [([10, 11], True)])
+
+            # The part size that matched is tried alone first
+            del self.computed[:]
+            s3file = self._create_s3file(multipart_etag(self.data, 10))
+            self.assertTrue(s3file.etag_matches_localfile(self.localfile))
+            self.assertEquals(self.computed, [([10], False)])
+        finally:
+            awsfabrictasks.s3.api.COMMON_MULTIPART_PARTSIZES = orig_common
+
+    def test_etag_matches_localfile_multipart_cached(self):
+        from awsfabrictasks.s3.checksumcache import ChecksumCache
+        awsfab_settings.S3_CHECKSUM_CACHE_MAX_AGE = 100
+        cache = ChecksumCache(join(self.tempdir, 'checksums.sqlite'))
+        try:
+            s3file = self._create_s3file(multipart_etag(self.data, 5),
+                                         {'awsfabchecksum': md5(self.data).hexdigest()})
+            self.assertTrue(s3file.etag_matches_localfile(self.localfile, cache))
+            self.assertEquals(len(self.computed), 1)
+            s3file = self._create_s3file(multipart_etag(self.data, 5),
+                                         {'awsfabchecksum': md5(self.data).hexdigest()})
+            self.assertTrue(s3file.etag_matches_localfile(self.localfile, cache))
+            self.assertEquals(len(self.computed), 1)
+        finally:
+            cache.close()
+
+    def test_etag_matches_localfile_multipart(self):
+        s3file = self._create_s3file(multipart_etag(self.data, 4))
+        self.assertTrue(s3file.etag_matches_localfile(self.localfile))
+        self.assertEquals(s3file.bucket.headrequests, 0)
+
+    def test_etag_matches_localfile_metadata_fallback(self):
+        s3file = self._create_s3file(multipart_etag(self.data, 5),
+                                     {'awsfabchecksum': md5(self.data).hexdigest()})
+        self.assertTrue(s3file.etag_matches_localfile(self.localfile))
+        self.assertEquals(s3file.bucket.headrequests, 1)
+
+        s3file = self._create_s3file(multipart_etag(self.data, 5),
+                                     {'awsfabchecksum': '0' * 32})
+        self.assertFalse(s3file.etag_matches_localfile(self.localfile))
+
+    def test_etag_matches_localfile_unknown(self):
+        s3file = self._create_s3file(multipart_etag(self.data, 5))
+        self.assertEquals(s3file.multipart_etag_matches_localfile(self.localfile), None)
+        self.assertFalse(s3file.etag_matches_localfile(self.localfile))
+
+    def test_etag_matches_localfile_size_mismatch(self):
+        s3file = self._create_s3file(multipart_etag(self.data, 4))
+        s3file.key.size = 10
+        self.assertFalse(s3file.etag_matches_localfile(self.localfile))
+        self.assertEquals(s3file.bucket.headrequests, 0)
+
+
+class TestS3SyncIterFileCreateLocaldir(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_create_localdir_concurrently(self):
+        import awsfabrictasks.s3.api
+        syncfile = S3SyncIterFile()
+        syncfile.localpath = join(self.tempdir, 'new', 'file.txt')
+        orig_exists = awsfabrictasks.s3.api.exists
+        checked = []
+        def exists_created_by_other_worker(path):
+            # Simulate another worker creating the directory after our check
+            if not checked:
+                checked.append(path)
+                makedirs(path)
+                return False
+            return orig_exists(path)
+        awsfabrictasks.s3.api.exists = exists_created_by_other_worker
+        try:
+            syncfile.create_localdir()
+        finally:
+            awsfabrictasks.s3.api.exists = orig_exists
+        self.assertTrue(exists(join(self.tempdir, 'new')))
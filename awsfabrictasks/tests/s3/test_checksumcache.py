@@ -0,0 +1,151 @@
+from unittest import TestCase
+from shutil import rmtree
+from tempfile import mkdtemp
+from os import utime
+from time import time
+from os.path import join, exists
+
+from awsfabrictasks.conf import awsfab_settings
+from awsfabrictasks.s3.checksumcache import ChecksumCache
+from awsfabrictasks.s3.checksumcache import get_filestat_key
+from awsfabrictasks.s3.api import S3File
+import awsfabrictasks.s3.api
+from .test_api import makefile
+
+
+class TestChecksumCache(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        self.dbpath = join(self.tempdir, 'cache', 'checksums.sqlite')
+        awsfab_settings.reset_settings(S3_CHECKSUM_CACHE=self.dbpath,
+                                       S3_CHECKSUM_CACHE_MAX_AGE=100)
+        self.path = makefile(self.tempdir, 'hello.txt', 'Hello world')
+        self.computed = []
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def _compute(self, path):
+        self.computed.append(path)
+        return open(path, 'rb').read().decode('utf-8').upper()
+
+    def test_open(self):
+        cache = ChecksumCache.open()
+        try:
+            self.assertTrue(exists(self.dbpath))
+        finally:
+            cache.close()
+        awsfab_settings.S3_CHECKSUM_CACHE = None
+        self.assertEquals(ChecksumCache.open(), None)
+
+    def test_get_checksum(self):
+        cache = ChecksumCache(self.dbpath)
+        self.assertEquals(cache.get_checksum(self.path, 'upper', self._compute), 'HELLO WORLD')
+        self.assertEquals(cache.get_checksum(self.path, 'upper', self._compute), 'HELLO WORLD')
+        self.assertEquals(len(self.computed), 1)
+        cache.close()
+
+        # Persisted
+        cache = ChecksumCache(self.dbpath)
+        self.assertEquals(cache.get_checksum(self.path, 'upper', self._compute), 'HELLO WORLD')
+        self.assertEquals(len(self.computed), 1)
+        cache.close()
+
+    def test_get_md5sum(self):
+        cache = ChecksumCache(self.dbpath)
+        self.assertEquals(cache.get_md5sum(self.path), '3e25960a79dbc69b674cd4ec67a72c62')
+        cache.close()
+
+    def test_changed_file(self):
+        cache = ChecksumCache(self.dbpath)
+        cache.get_checksum(self.path, 'upper', self._compute)
+        makefile(self.tempdir, 'hello.txt', 'Hello cruel world')
+        self.assertEquals(cache.get_checksum(self.path, 'upper', self._compute), 'HELLO CRUEL WORLD')
+        self.assertEquals(cache.count(), 1)
+
+        # Same size, new mtime
+        size, mtime_ns, inode = get_filestat_key(self.path)
+        makefile(self.tempdir, 'hello.txt', 'Hello CRUEL world')
+        utime(self.path, (1000, 1000))
+        self.assertEquals(cache.get_checksum(self.path, 'upper', self._compute), 'HELLO CRUEL WORLD')
+        self.assertEquals(len(self.computed), 3)
+        cache.close()
+
+    def test_rehash(self):
+        cache = ChecksumCache(self.dbpath)
+        cache.get_checksum(self.path, 'upper', self._compute)
+        cache.close()
+        cache = ChecksumCache(self.dbpath, rehash=True)
+        cache.get_checksum(self.path, 'upper', self._compute)
+        self.assertEquals(len(self.computed), 2)
+        cache.close()
+
+    def test_evict(self):
+        now = [1000]
+        cache = ChecksumCache(self.dbpath, clock=lambda: now[0])
+        cache.get_checksum(self.path, 'upper', self._compute)
+        cache.close()
+        now[0] += 50
+        cache = ChecksumCache(self.dbpath, clock=lambda: now[0])
+        self.assertEquals(cache.count(), 1)
+        cache.close()
+        now[0] += 101
+        cache = ChecksumCache(self.dbpath, clock=lambda: now[0])
+        self.assertEquals(cache.count(), 0)
+        cache.close()
+
+    def test_lookup_refreshes_last_used(self):
+        now = [1000]
+        cache = ChecksumCache(self.dbpath, clock=lambda: now[0])
+        cache.get_checksum(self.path, 'upper', self._compute)
+        cache.close()
+        now[0] += 90
+        cache = ChecksumCache(self.dbpath, clock=lambda: now[0])
+        cache.get_checksum(self.path, 'upper', self._compute)
+        cache.close()
+        now[0] += 90
+        cache = ChecksumCache(self.dbpath, clock=lambda: now[0])
+        self.assertEquals(cache.count(), 1)
+        self.assertEquals(len(self.computed), 1)
+        cache.close()
+
+    def test_concurrent_caches(self):
+        other_path = makefile(self.tempdir, 'other.txt', 'Other')
+        first = ChecksumCache(self.dbpath)
+        first.get_checksum(self.path, 'upper', self._compute)
+        first.commit()
+        second = ChecksumCache(self.dbpath)
+        try:
+            # Hits and stores in one cache do not lock out the other
+            first.get_checksum(self.path, 'upper', self._compute)
+            first.get_checksum(other_path, 'upper', self._compute)
+            started = time()
+            self.assertEquals(second.get_checksum(self.path, 'upper', self._compute), 'HELLO WORLD')
+            self.assertEquals(len(self.computed), 2)
+            self.assertEquals(second.get_checksum(other_path, 'upper', self._compute), 'OTHER')
+            second.commit()
+            first.commit()
+            self.assertTrue(time() - started < ChecksumCache.LOCK_TIMEOUT)
+            self.assertEquals(first.count(), 2)
+        finally:
+            first.close()
+            second.close()
+
+    def test_etag_matches_localfile_empty_cache(self):
+        s3file = S3File(None, None)
+        s3file.get_etag = lambda: '3e25960a79dbc69b674cd4ec67a72c62'
+        orig_compute = awsfabrictasks.s3.api.compute_localfile_md5sum
+        computed = []
+        def compute(path):
+            computed.append(path)
+            return orig_compute(path)
+        awsfabrictasks.s3.api.compute_localfile_md5sum = compute
+        cache = ChecksumCache(self.dbpath)
+        try:
+            self.assertEquals(cache.count(), 0)
+            self.assertTrue(s3file.etag_matches_localfile(self.path, cache))
+            self.assertTrue(s3file.etag_matches_localfile(self.path, cache))
+            self.assertEquals(len(computed), 1)
+        finally:
+            cache.close()
+            awsfabrictasks.s3.api.compute_localfile_md5sum = orig_compute
@@ -0,0 +1,86 @@
+from unittest import TestCase
+from threading import Thread
+
+from awsfabrictasks.connections import ConnectionRegistry
+from awsfabrictasks.conf import awsfab_settings
+
+
+class MockConnection(object):
+    def __init__(self, service, region_name, **auth):
+        self.service = service
+        self.region_name = region_name
+        self.auth = auth
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionRegistry(TestCase):
+    def setUp(self):
+        awsfab_settings.reset_settings(AUTH={'aws_access_key_id': 'a'},
+                                       CONNECTION_MAX_IDLE=10)
+        self.now = 0
+        self.connected = []
+        def connect(service):
+            def connect_to_region(region_name, **auth):
+                if region_name == 'invalid':
+                    return None
+                connection = MockConnection(service, region_name, **auth)
+                self.connected.append(connection)
+                return connection
+            return connect_to_region
+        self.registry = ConnectionRegistry(connect=connect, clock=lambda: self.now)
+
+    def test_reuse(self):
+        first = self.registry.get_connection('ec2', 'eu-west-1')
+        self.assertTrue(self.registry.get_connection('ec2', 'eu-west-1') is first)
+        self.assertEquals(len(self.connected), 1)
+        self.assertEquals(first.auth, {'aws_access_key_id': 'a'})
+
+    def test_keyed_by_service_region_and_credentials(self):
+        ec2 = self.registry.get_connection('ec2', 'eu-west-1')
+        self.assertFalse(self.registry.get_connection('rds', 'eu-west-1') is ec2)
+        self.assertFalse(self.registry.get_connection('ec2', 'us-east-1') is ec2)
+        awsfab_settings.AUTH = {'aws_access_key_id': 'b'}
+        self.assertFalse(self.registry.get_connection('ec2', 'eu-west-1') is ec2)
+        self.assertEquals(len(self.registry), 4)
+
+    def test_one_connection_per_thread(self):
+        first = self.registry.get_connection('ec2', 'eu-west-1')
+        result = []
+        thread = Thread(target=lambda: result.append(self.registry.get_connection('ec2', 'eu-west-1')))
+        thread.start()
+        thread.join()
+        self.assertFalse(result[0] is first)
+
+    def test_exited_thread_eviction(self):
+        first = self.registry.get_connection('ec2', 'eu-west-1')
+        result = []
+        thread = Thread(target=lambda: result.append(self.registry.get_connection('ec2', 'eu-west-1')))
+        thread.start()
+        thread.join()
+        self.assertEquals(len(self.registry), 2)
+        self.assertTrue(self.registry.get_connection('ec2', 'eu-west-1') is first)
+        self.assertEquals(len(self.registry), 1)
+        self.assertTrue(result[0].closed)
+        self.assertFalse(first.closed)
+
+    def test_idle_eviction(self):
+        first = self.registry.get_connection('ec2', 'eu-west-1')
+        self.now = 5
+        self.assertTrue(self.registry.get_connection('ec2', 'eu-west-1') is first)
+        self.now = 16
+        second = self.registry.get_connection('ec2', 'eu-west-1')
+        self.assertFalse(second is first)
+        self.assertTrue(first.closed)
+
+    def test_failed_connection_not_cached(self):
+        self.assertEquals(self.registry.get_connection('ec2', 'invalid'), None)
+        self.assertEquals(len(self.registry), 0)
+
+    def test_clear(self):
+        first = self.registry.get_connection('ec2', 'eu-west-1')
+        self.registry.clear()
+        self.assertTrue(first.closed)
+        self.assertEquals(len(self.registry), 0)
@@ -0,0 +1,96 @@
+from unittest import TestCase
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from awsfabrictasks.conf import awsfab_settings
+from awsfabrictasks.decorators import ec2instance
+from awsfabrictasks.decorators import LazyHostsList
+from awsfabrictasks.ec2.api import Ec2InstanceWrapper
+from awsfabrictasks.ec2.api import resolve_instances
+from awsfabrictasks.ec2.api import clear_resolved_instances
+from awsfabrictasks.ec2.api import invalidate_region_instances
+from awsfabrictasks.ec2.api import create_tags
+from .ec2.test_api import MockInstance
+from .ec2.test_api import MockConnection
+
+
+class TestLazyHostsList(TestCase):
+    def test_resolve_once(self):
+        calls = []
+        def resolve():
+            calls.append(1)
+            return ['a', 'b']
+        hosts = LazyHostsList(resolve)
+        self.assertEquals(calls, [])
+        self.assertEquals(list(hosts), ['a', 'b'])
+        self.assertEquals(len(hosts), 2)
+        self.assertTrue('a' in hosts)
+        self.assertTrue(hosts)
+        self.assertEquals(calls, [1])
+
+
+class MockTaggingConnection(MockConnection):
+    def create_tags(self, resource_ids, tags):
+        for instance in self.instances:
+            if instance.id in resource_ids:
+                instance.tags.update(tags)
+
+
+class TestEc2InstanceDecorator(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        awsfab_settings.reset_settings(DEFAULT_REGION='eu-west-1', REGION_WORKERS=4, AUTH={},
+                                       EC2_PAGE_SIZE=500, EC2_INVENTORY_CACHE_DIR=self.tempdir)
+        a = MockInstance('i-a', {'Name': 'a', 'role': 'web'})
+        a.public_dns_name = 'a.example.com'
+        b = MockInstance('i-b', {'Name': 'b', 'role': 'web'})
+        b.public_dns_name = 'b.example.com'
+        self.connection = MockTaggingConnection([a, b])
+        self.orig_get_connection = Ec2InstanceWrapper.__dict__['get_connection']
+        Ec2InstanceWrapper.get_connection = classmethod(lambda cls, region=None: self.connection)
+        clear_resolved_instances()
+
+    def tearDown(self):
+        Ec2InstanceWrapper.get_connection = self.orig_get_connection
+        clear_resolved_instances()
+        rmtree(self.tempdir)
+
+    def test_lazy(self):
+        @ec2instance(nametag='a')
+        def mytask():
+            pass
+        self.assertEquals(self.connection.requests, [])
+        self.assertEquals(list(mytask.hosts), ['a.example.com'])
+        self.assertEquals(self.connection.requests, [{'tag:Name': ['a']}])
+
+    def test_tags(self):
+        @ec2instance(tags={'role': 'web'})
+        def mytask():
+            pass
+        self.assertEquals(list(mytask.hosts), ['a.example.com', 'b.example.com'])
+
+    def test_shared_memo(self):
+        @ec2instance(instanceid='i-b')
+        def mytask():
+            pass
+        instancewrappers = resolve_instances(instanceids=['i-b'], names=['a'])
+        self.assertEquals([w['id'] for w in instancewrappers], ['i-b', 'i-a'])
+        self.assertEquals(list(mytask.hosts), ['b.example.com'])
+        self.assertEquals(self.connection.requests,
+                          [{'instance-id': ['i-b']}, {'tag:Name': ['a']}])
+        resolve_instances(names=['a', 'b'])
+        self.assertEquals(self.connection.requests[2:], [{'tag:Name': ['b']}])
+
+    def test_invalidate_region_instances(self):
+        resolve_instances(names=['a'])
+        invalidate_region_instances('us-east-1')
+        resolve_instances(names=['a'])
+        self.assertEquals(len(self.connection.requests), 1)
+        invalidate_region_instances('eu-west-1')
+        resolve_instances(names=['a'])
+        self.assertEquals(len(self.connection.requests), 2)
+
+    def test_tagging_invalidates(self):
+        self.assertEquals([w['id'] for w in resolve_instances(tags={'role': 'db'})], [])
+        create_tags('eu-west-1', ['i-a'], {'role': 'db'})
+        self.assertEquals([w['id'] for w in resolve_instances(tags={'role': 'db'})], ['i-a'])
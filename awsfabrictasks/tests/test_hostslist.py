@@ -0,0 +1,33 @@
+from unittest import TestCase
+from subprocess import check_output
+from shutil import rmtree
+from tempfile import mkdtemp
+from os.path import join
+
+from awsfabrictasks.hostslist import get_hostsfile_checksum
+from awsfabrictasks.hostslist import get_upload_hostsfile_if_changed_command
+
+
+class TestUploadHostsfileIfChanged(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        self.hostsfile = join(self.tempdir, 'hosts')
+        with open(self.hostsfile, 'w') as outfile:
+            outfile.write('127.0.0.1 localhost\n')
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def _run(self, hostsfile_string):
+        command = get_upload_hostsfile_if_changed_command(hostsfile_string, self.hostsfile)
+        return check_output(['bash', '-c', command]).decode('utf-8').strip()
+
+    def test_get_hostsfile_checksum(self):
+        self.assertEquals(get_hostsfile_checksum(''),
+                          'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855')
+
+    def test_upload_if_changed(self):
+        hostsfile_string = '127.0.0.1 localhost\n10.0.0.1 web.ec2\n'
+        self.assertEquals(self._run(hostsfile_string), 'awsfab-hostsfile:updated')
+        self.assertEquals(open(self.hostsfile).read(), hostsfile_string)
+        self.assertEquals(self._run(hostsfile_string), 'awsfab-hostsfile:unchanged')
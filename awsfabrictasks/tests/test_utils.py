@@ -1,9 +1,36 @@
 from unittest import TestCase
+from os import makedirs, chmod, stat, getuid
+from os.path import join, exists
+from shutil import rmtree, copyfile
+from subprocess import check_call, check_output
+from tempfile import mkdtemp
+from threading import current_thread
+import tarfile
+from fabric.operations import _shell_escape
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 from awsfabrictasks.utils import force_slashend
 from awsfabrictasks.utils import force_noslashend
 from awsfabrictasks.utils import rsyncformat_path
 from awsfabrictasks.utils import guess_contenttype
+from awsfabrictasks.utils import iter_parallel
+from awsfabrictasks.utils import thread_pool
+from awsfabrictasks.utils import run_local_commands
+from awsfabrictasks.utils import format_local_command_summary
+from awsfabrictasks.utils import create_tar_archive
+from awsfabrictasks.utils import get_local_manifest
+from awsfabrictasks.utils import parse_remote_manifest
+from awsfabrictasks.utils import diff_manifests
+from awsfabrictasks.utils import remote_batch
+from awsfabrictasks.utils import sudo_mkdir_p
+from awsfabrictasks.utils import RemoteBatch
+from awsfabrictasks.utils import sudo_upload_dir_bulk
+from awsfabrictasks.ubuntu import set_locale
+from fabric.api import hide
+import awsfabrictasks.utils
 
 
 class TestUtils(TestCase):
@@ -25,3 +52,206 @@ class TestUtils(TestCase):
         self.assertEquals(guess_contenttype('hello.py'), 'text/x-python')
         self.assertEquals(guess_contenttype('hello.txt'), 'text/plain')
         self.assertEquals(guess_contenttype('hello.json'), 'application/json')
+
+    def test_iter_parallel(self):
+        def square(x):
+            if x == 3:
+                raise ValueError('three')
+            return x * x
+        results = dict((item, (result, error)) for item, result, error
+                       in iter_parallel(square, [1, 2, 3, 4], workers=2))
+        self.assertEquals(results[1], (1, None))
+        self.assertEquals(results[4], (16, None))
+        self.assertEquals(results[3][0], None)
+        self.assertTrue(isinstance(results[3][1], ValueError))
+
+    def test_iter_parallel_empty(self):
+        self.assertEquals(list(iter_parallel(lambda x: x, [])), [])
+
+    def test_iter_parallel_single_item_inline(self):
+        self.assertEquals(list(iter_parallel(lambda x: current_thread(), [1])),
+                          [(1, current_thread(), None)])
+
+    def test_iter_parallel_pool_reused(self):
+        threads = set()
+        with thread_pool(2) as pool:
+            for round in range(5):
+                for item, thread, error in iter_parallel(lambda x: current_thread(), [1, 2, 3], pool=pool):
+                    threads.add(thread)
+        self.assertTrue(len(threads) <= 2)
+        self.assertFalse(current_thread() in threads)
+
+    def test_run_local_commands(self):
+        stream = StringIO()
+        results = run_local_commands([('a', 'echo hello'), ('b', 'echo fail; exit 3')],
+                                     workers=2, stream=stream)
+        self.assertEquals([result.label for result in results], ['a', 'b'])
+        self.assertEquals([result.returncode for result in results], [0, 3])
+        self.assertEquals(sorted(stream.getvalue().splitlines()), ['[a] hello', '[b] fail'])
+        summary = format_local_command_summary(results).splitlines()
+        self.assertTrue(summary[0].startswith('a: OK in '))
+        self.assertTrue(summary[1].startswith('b: FAILED (exit status 3) in '))
+        self.assertEquals(summary[2], '1 succeeded, 1 failed.')
+
+    def test_create_tar_archive(self):
+        tempdir = mkdtemp()
+        try:
+            local_dir = join(tempdir, 'local')
+            makedirs(join(local_dir, 'sub'))
+            open(join(local_dir, 'a.txt'), 'w').close()
+            open(join(local_dir, 'sub', 'b.txt'), 'w').close()
+            archivepath = join(tempdir, 'archive.tar.gz')
+            create_tar_archive(local_dir, archivepath)
+            archive = tarfile.open(archivepath)
+            self.assertEquals(sorted(archive.getnames()), ['a.txt', 'sub', 'sub/b.txt'])
+            archive.close()
+        finally:
+            rmtree(tempdir)
+
+    def test_parse_remote_manifest(self):
+        output = '\r\n'.join(['dir ./sub',
+                               'size 3 ./a b.txt',
+                               'size 0 ./sub/c.txt',
+                               'abc123  ./a b.txt',
+                               'e3b0c4  ./sub/c.txt'])
+        self.assertEquals(parse_remote_manifest(output),
+                          ({'a b.txt': (3, 'abc123'), 'sub/c.txt': (0, 'e3b0c4')}, set(['sub'])))
+        self.assertEquals(parse_remote_manifest(''), ({}, set()))
+
+    def test_diff_manifests(self):
+        tempdir = mkdtemp()
+        try:
+            makedirs(join(tempdir, 'new'))
+            for name, content in (('same.txt', 'abc'), ('changed.txt', 'abc'),
+                                  ('resized.txt', 'abcd'), ('new/added.txt', '')):
+                with open(join(tempdir, name), 'w') as outfile:
+                    outfile.write(content)
+            abc = 'ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad'
+            remote = ({'same.txt': (3, abc), 'changed.txt': (3, 'other'),
+                       'resized.txt': (3, abc), 'extra.txt': (1, 'x')}, set(['old']))
+            self.assertEquals(diff_manifests(tempdir, get_local_manifest(tempdir), remote),
+                              (['new', 'changed.txt', 'new/added.txt', 'resized.txt'],
+                               ['extra.txt'], ['old']))
+        finally:
+            rmtree(tempdir)
+
+
+class MockSudoOutput(str):
+    return_code = 0
+
+
+class TestRemoteBatch(TestCase):
+    def setUp(self):
+        self.orig_sudo = awsfabrictasks.utils.sudo
+        self.commands = []
+        def sudo(command):
+            self.commands.append(command)
+            output = MockSudoOutput(self.run_script(command))
+            output.return_code = self.return_code
+            return output
+        self.return_code = 0
+        awsfabrictasks.utils.sudo = sudo
+
+    def tearDown(self):
+        awsfabrictasks.utils.sudo = self.orig_sudo
+
+    def run_script(self, script):
+        # Simulate the script by echoing the markers, and failing at the
+        # first command containing "fail"
+        output = []
+        for line in script.splitlines()[1:]:
+            if line.startswith('echo @@awsfab-batch'):
+                output.append(line[5:])
+            elif 'fail' in line:
+                output.append('failed!')
+                break
+            else:
+                output.append('ran ' + line)
+        return '\r\n'.join(output)
+
+    def test_batch(self):
+        with hide('stdout'):
+            with remote_batch() as batch:
+                sudo_mkdir_p('/srv/app', owner='www', mode=755)
+                set_locale('nb_NO')
+                self.assertEquals(self.commands, [])
+        self.assertEquals(len(self.commands), 1)
+        self.assertEquals([result.label for result in batch.results],
+                          ['sudo_mkdir_p', 'sudo_chown', 'sudo_chmod', 'set_locale', 'set_locale'])
+        self.assertEquals([result.return_code for result in batch.results], [0, 0, 0, 0, 0])
+        self.assertEquals(batch.results[1].output, 'ran chown www /srv/app')
+
+    def test_batch_failure(self):
+        batch = RemoteBatch()
+        batch.add('first', 'echo ok')
+        batch.add('second', 'fail')
+        batch.add('third', 'echo never')
+        results = batch.parse_output(self.run_script(batch.get_script()), 2)
+        self.assertEquals([result.return_code for result in results], [0, 2, None])
+        self.assertEquals(results[1].output, 'failed!')
+
+    def test_no_batch(self):
+        sudo_mkdir_p('/srv/app')
+        self.assertEquals(self.commands, ['mkdir -p /srv/app'])
+
+    def test_exception_discards(self):
+        try:
+            with remote_batch():
+                sudo_mkdir_p('/srv/app')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEquals(self.commands, [])
+        sudo_mkdir_p('/srv/app')
+        self.assertEquals(self.commands, ['mkdir -p /srv/app'])
+
+
+class TestSudoUploadDirBulk(TestCase):
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        self.local_dir = join(self.tempdir, 'local')
+        self.remote_dir = join(self.tempdir, 'remote')
+        makedirs(join(self.local_dir, 'sub'))
+        open(join(self.local_dir, 'sub', 'new.txt'), 'w').close()
+        makedirs(self.remote_dir)
+        self.existing = join(self.remote_dir, 'existing.txt')
+        open(self.existing, 'w').close()
+        chmod(self.existing, 0o644)
+        self.tmpdirs = []
+        self.orig = (awsfabrictasks.utils.run, awsfabrictasks.utils.put,
+                     awsfabrictasks.utils.sudo)
+        def run(command):
+            tmpdir = check_output(['bash', '-c', command]).decode('utf-8')
+            self.tmpdirs.append(tmpdir.strip())
+            return tmpdir
+        awsfabrictasks.utils.run = run
+        awsfabrictasks.utils.put = copyfile
+        # Wrapped and escaped just like fabric.api.sudo() does
+        awsfabrictasks.utils.sudo = lambda command: check_call(
+            ['bash', '-c', 'bash -c "{0}"'.format(_shell_escape(command))])
+
+    def tearDown(self):
+        (awsfabrictasks.utils.run, awsfabrictasks.utils.put,
+         awsfabrictasks.utils.sudo) = self.orig
+        rmtree(self.tempdir)
+
+    def _mode(self, path):
+        return stat(path).st_mode & 0o777
+
+    def test_only_uploaded_files_are_changed(self):
+        sudo_upload_dir_bulk(self.local_dir, self.remote_dir, owner=str(getuid()), mode='go-rwx')
+        self.assertEquals(self._mode(join(self.remote_dir, 'sub', 'new.txt')) & 0o077, 0)
+        self.assertEquals(self._mode(join(self.remote_dir, 'sub')) & 0o077, 0)
+        self.assertEquals(self._mode(self.existing), 0o644)
+
+    def test_quoted_remote_dir(self):
+        remote_dir = join(self.tempdir, 'it\'s a "$dir"')
+        sudo_upload_dir_bulk(self.local_dir, remote_dir, mode='go-rwx')
+        self.assertTrue(exists(join(remote_dir, 'sub', 'new.txt')))
+        self.assertEquals(self._mode(join(remote_dir, 'sub', 'new.txt')) & 0o077, 0)
+
+    def test_staging_directory(self):
+        sudo_upload_dir_bulk(self.local_dir, self.remote_dir)
+        self.assertEquals(len(self.tmpdirs), 1)
+        self.assertFalse(exists(self.tmpdirs[0]))
+        self.assertTrue(exists(join(self.remote_dir, 'sub', 'new.txt')))
@@ -1,12 +1,13 @@
 """
 Ubuntu utilities.
 """
-from fabric.api import sudo
+from awsfabrictasks.utils import batched_sudo
 
 def set_locale(locale='en_US'):
     """
     Set locale to avoid the warnings from perl and others about locale
-    failures.
+    failures. Batched within :func:`awsfabrictasks.utils.remote_batch`.
     """
-    sudo('locale-gen {locale}.UTF-8'.format(**vars()))
-    sudo('update-locale LANG={locale}.UTF-8 LC_ALL={locale}.UTF-8 LC_MESSAGES=POSIX'.format(**vars()))
+    batched_sudo('locale-gen {locale}.UTF-8'.format(**vars()), 'set_locale')
+    batched_sudo('update-locale LANG={locale}.UTF-8 LC_ALL={locale}.UTF-8 LC_MESSAGES=POSIX'.format(**vars()),
+                 'set_locale')
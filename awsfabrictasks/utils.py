@@ -1,10 +1,27 @@
-from fabric.api import put, sudo
-from os import walk, remove
-from os.path import relpath, join
+from __future__ import print_function
+from fabric.api import put, run, sudo, hide, settings, env
+from fabric.state import output as fabric_output
+from fabric.utils import error
+from contextlib import contextmanager
+from os import walk, remove, listdir
+from uuid import uuid4
+from hashlib import sha256
+import tarfile
+from os.path import relpath, join, getsize
 from mimetypes import guess_type
 from tempfile import NamedTemporaryFile
 from boto.utils import compute_md5
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from threading import local as threading_local
+from subprocess import Popen, PIPE, STDOUT
+from time import time
+import sys
 import logging
+try:
+    from shlex import quote as shellquote
+except ImportError:
+    from pipes import quote as shellquote
 
 
 #: Map of strings to loglevels (for the logging module)
@@ -89,17 +106,198 @@ def configureStreamLoggerForTask(modulename, taskname, loglevel):
     return configureStreamLogger(modulename + '.' + taskname, loglevel)
 
 
+#: Prefix for the lines that separate the output of each command in a
+#: :class:`RemoteBatch` script.
+REMOTE_BATCH_MARKER = '@@awsfab-batch'
+
+_remote_batch_state = threading_local()
+
+class RemoteBatchCommandResult(object):
+    """
+    The result of a command in a :class:`RemoteBatch`.
+    """
+    def __init__(self, label, command, output, return_code):
+        #: The name of the helper that queued the command (E.g.: ``"sudo_chown"``).
+        self.label = label
+
+        #: The command.
+        self.command = command
+
+        #: The output from the command.
+        self.output = output
+
+        #: The exit status of the command, or ``None`` if the command was not
+        #: run because an earlier command failed.
+        self.return_code = return_code
+
+    def succeeded(self):
+        return self.return_code == 0
+
+class RemoteBatch(object):
+    """
+    Queue of sudo commands run as a single remote shell script. Use it
+    through :func:`remote_batch`.
+    """
+    def __init__(self):
+        #: List of ``(label, command)`` tuples not yet flushed.
+        self.commands = []
+
+        #: List of :class:`RemoteBatchCommandResult` objects for all the
+        #: commands flushed so far.
+        self.results = []
+
+    def add(self, label, command):
+        """
+        Queue ``command``. ``label`` is used to report failures.
+        """
+        self.commands.append((label, command))
+
+    def get_script(self):
+        """
+        Get the queued commands as a ``set -e`` shell script that echos a
+        marker line (see :obj:`REMOTE_BATCH_MARKER`) before and after each
+        command.
+        """
+        lines = ['set -e']
+        for index, (label, command) in enumerate(self.commands):
+            lines.append('echo {0}:start:{1}'.format(REMOTE_BATCH_MARKER, index))
+            lines.append(command)
+            lines.append('echo {0}:end:{1}'.format(REMOTE_BATCH_MARKER, index))
+        return '\n'.join(lines)
+
+    def parse_output(self, output, return_code):
+        """
+        Split the output of the script from :meth:`get_script` into a
+        :class:`RemoteBatchCommandResult` for each queued command.
+        """
+        outputs = {}
+        finished = set()
+        current = None
+        for line in output.splitlines():
+            if line.startswith(REMOTE_BATCH_MARKER + ':'):
+                marker, event, index = line.split(':')
+                if event == 'start':
+                    current = int(index)
+                    outputs[current] = []
+                else:
+                    finished.add(int(index))
+                    current = None
+            elif current is not None:
+                outputs[current].append(line)
+        results = []
+        for index, (label, command) in enumerate(self.commands):
+            if index in finished:
+                status = 0
+            elif index in outputs:
+                status = return_code or 1
+            else:
+                status = None
+            results.append(RemoteBatchCommandResult(label, command,
+                                                    '\n'.join(outputs.get(index, [])), status))
+        return results
+
+    def flush(self):
+        """
+        Run the queued commands as a single sudo command, and add their
+        results to :obj:`.results`. Fails (with ``fabric.utils.error``, which
+        aborts unless ``env.warn_only`` is set) with the label, command and
+        output of the command that failed.
+
+        :return: The :class:`RemoteBatchCommandResult` objects for the flushed commands.
+        """
+        if not self.commands:
+            return []
+        with settings(hide('stdout', 'warnings'), warn_only=True):
+            output = sudo(self.get_script())
+        results = self.parse_output(output, output.return_code)
+        self.commands = []
+        self.results.extend(results)
+        if fabric_output.stdout:
+            for result in results:
+                for line in result.output.splitlines():
+                    print('[{0}] {1}: {2}'.format(env.host_string, result.label, line))
+        for result in results:
+            if result.return_code:
+                error(('Batched command from {label} failed with exit status '
+                       '{return_code}: {command}\n{output}').format(**result.__dict__))
+        return results
+
+def get_remote_batch():
+    """
+    Get the :class:`RemoteBatch` of the current :func:`remote_batch` context,
+    or ``None``.
+    """
+    return getattr(_remote_batch_state, 'batch', None)
+
+@contextmanager
+def remote_batch():
+    """
+    Context manager that queues the commands from :func:`batched_sudo`
+    (used by :func:`sudo_chown`, :func:`sudo_chmod`, :func:`sudo_chattr`,
+    :func:`sudo_mkdir_p`, :func:`awsfabrictasks.ubuntu.set_locale`, ...)
+    instead of running them, and runs them as a single ``set -e`` remote
+    script when the block exits. Helpers that must run right away (like
+    :func:`sudo_upload_file`) flush the queue first, so the commands still
+    run in order. Nested contexts join the outermost context. If the block
+    raises an exception, the queued commands are discarded.
+
+    Example::
+
+        with remote_batch() as batch:
+            sudo_mkdir_p('/srv/app', owner='www-data', mode=755)
+            set_locale()
+        for result in batch.results:
+            print(result.label, result.return_code)
+
+    The commands run on the host that is current when the block exits.
+    """
+    batch = get_remote_batch()
+    if batch:
+        yield batch
+        return
+    batch = RemoteBatch()
+    _remote_batch_state.batch = batch
+    try:
+        yield batch
+    finally:
+        _remote_batch_state.batch = None
+    batch.flush()
+
+def batched_sudo(command, label):
+    """
+    Run ``command`` with ``sudo``, or queue it if we are within a
+    :func:`remote_batch` context.
+
+    :param label: Name of the helper running the command. Used to report failures.
+    :return: The output of ``sudo``, or ``None`` if the command was queued.
+    """
+    batch = get_remote_batch()
+    if batch:
+        batch.add(label, command)
+        return None
+    return sudo(command)
+
+def flush_remote_batch():
+    """
+    Run the commands queued in the current :func:`remote_batch` context (if
+    any). Used by helpers that need the queued commands to have run.
+    """
+    batch = get_remote_batch()
+    if batch:
+        batch.flush()
+
+
 def sudo_chown(remote_path, owner):
     """
-    Run ``sudo chown <owner> remote_path``.
+    Run ``sudo chown <owner> remote_path``. Batched within :func:`remote_batch`.
     """
-    sudo('chown {owner} {remote_path}'.format(**vars()))
+    batched_sudo('chown {owner} {remote_path}'.format(**vars()), 'sudo_chown')
 
 def sudo_chmod(remote_path, mode):
     """
-    Run ``sudo chmod <mode> remote_path``.
+    Run ``sudo chmod <mode> remote_path``. Batched within :func:`remote_batch`.
     """
-    sudo('chmod {mode} {remote_path}'.format(**vars()))
+    batched_sudo('chmod {mode} {remote_path}'.format(**vars()), 'sudo_chmod')
 
 def sudo_chattr(remote_path, owner=None, mode=None):
     """
@@ -116,6 +314,7 @@ def sudo_upload_file(local_path, remote_path, **chattr_kw):
     Use sudo to upload a file from ``local_path`` to ``remote_path`` and run
     :func:`sudo_chattr` with the given ``chattr_kw`` as arguments.
     """
+    flush_remote_batch()
     put(local_path, remote_path, use_sudo=True)
     sudo_chattr(remote_path, **chattr_kw)
 
@@ -141,17 +340,38 @@ def sudo_upload_string_to_file(string_to_upload, remote_path, **chattr_kw):
 def sudo_mkdir_p(remote_path, **chattr_kw):
     """
     ``sudo mkdir -p <remote_path>`` followed by :func:`sudo_chattr`(remote_path, **chattr_kw).
+    Batched within :func:`remote_batch`.
     """
-    sudo('mkdir -p {remote_path}'.format(**vars()))
+    batched_sudo('mkdir -p {remote_path}'.format(**vars()), 'sudo_mkdir_p')
     sudo_chattr(remote_path, **chattr_kw)
 
 
-def sudo_upload_dir(local_dir, remote_dir, **chattr_kw):
+def sudo_upload_dir(local_dir, remote_dir, bulk=False, incremental=False, delete=False,
+                    **chattr_kw):
     """
     Upload all files and directories in ``local_dir`` to ``remote_dir``.
     Directories are created with :func:`sudo_mkdir_p` and files are uploaded
     with :func:`sudo_upload_file`. ``chattr_kw`` is forwarded in both cases.
-    """
+
+    :param bulk:
+        Use :func:`sudo_upload_dir_bulk` instead. Uploads the entire
+        directory as a single archive, and unpacks it with a single command
+        instead of several commands for each file. Defaults to ``False``.
+    :param incremental:
+        Use :func:`sudo_upload_dir_incremental` instead. Only uploads new and
+        changed files. Defaults to ``False``.
+    :param delete:
+        Delete remote files that do not exist in ``local_dir``. Only
+        supported with ``incremental=True``. Defaults to ``False``.
+    """
+    if incremental:
+        sudo_upload_dir_incremental(local_dir, remote_dir, delete=delete, **chattr_kw)
+        return
+    if delete:
+        raise ValueError('delete=True is only supported with incremental=True.')
+    if bulk:
+        sudo_upload_dir_bulk(local_dir, remote_dir, **chattr_kw)
+        return
     for local_dirpath, dirnames, filenames in walk(local_dir):
         remote_dirpath = remote_dir
         rel = relpath(local_dirpath, local_dir)
@@ -165,6 +385,210 @@ def sudo_upload_dir(local_dir, remote_dir, **chattr_kw):
             #print local_filepath, '-->', remote_filepath
             sudo_upload_file(local_filepath, remote_filepath, **chattr_kw)
 
+def create_tar_archive(local_dir, archivepath, names=None):
+    """
+    Create a gzipped tar archive at ``archivepath`` containing everything in
+    ``local_dir``. The paths in the archive are relative to ``local_dir``
+    (without any ``./`` prefix).
+
+    :param names:
+        Only include these ``/``-separated paths relative to ``local_dir``
+        instead of everything. Directories in ``names`` are added without
+        their contents.
+    """
+    archive = tarfile.open(archivepath, 'w:gz')
+    try:
+        if names is None:
+            for name in sorted(listdir(local_dir)):
+                archive.add(join(local_dir, name), arcname=name)
+        else:
+            for name in sorted(names):
+                archive.add(join(local_dir, slashpath_to_localpath(name)), arcname=name,
+                            recursive=False)
+    finally:
+        archive.close()
+
+def _sudo_upload_archive(local_dir, remote_dir, names=None, owner=None, mode=None,
+                         delete_files=(), delete_dirs=()):
+    commands = []
+    remote_tmpdir = None
+    if names is None or names:
+        # ``mktemp -d`` creates a directory only readable by the user we log in as
+        with hide('everything'):
+            remote_tmpdir = run('mktemp -d /tmp/awsfab-upload.XXXXXXXXXX').strip()
+        remote_archive = '{0}/upload.tar.gz'.format(remote_tmpdir)
+        tmpfile = NamedTemporaryFile(suffix='.tar.gz', delete=False)
+        tmpfile.close()
+        try:
+            create_tar_archive(local_dir, tmpfile.name, names)
+            put(tmpfile.name, remote_archive)
+        finally:
+            remove(tmpfile.name)
+
+    # Only change owner and mode of remote_dir itself if we create it (like
+    # sudo_mkdir_p does in sudo_upload_dir), and of the extracted members.
+    quoted_dir = shellquote(remote_dir)
+    commands.append('created=0; [ -d {quoted_dir} ] || created=1'.format(**vars()))
+    commands.append('mkdir -p {quoted_dir}'.format(**vars()))
+    attrcommands = [(attrcommand, shellquote(value))
+                    for attrcommand, value in (('chown', owner), ('chmod', mode)) if value]
+    for attrcommand, value in attrcommands:
+        commands.append('if [ $created = 1 ]; then {attrcommand} {value} {quoted_dir}; fi'.format(**vars()))
+    if remote_tmpdir:
+        quoted_archive = shellquote(remote_archive)
+        commands.append('tar -xzf {quoted_archive} -C {quoted_dir} --no-same-owner'.format(**vars()))
+        for attrcommand, value in attrcommands:
+            commands.append(('(cd {quoted_dir} && tar -tzf {quoted_archive} | tr "\\n" "\\0" '
+                             '| xargs -0 -r {attrcommand} {value} --)').format(**vars()))
+    for rm_command, paths in (('rm -f', delete_files), ('rm -rf', delete_dirs)):
+        if paths:
+            paths = ' '.join(shellquote(path) for path in paths)
+            commands.append('(cd {quoted_dir} && {rm_command} {paths})'.format(**vars()))
+    command = ' && '.join(commands)
+    if remote_tmpdir:
+        quoted_tmpdir = shellquote(remote_tmpdir)
+        command = '{command}; status=$?; rm -rf {quoted_tmpdir}; exit $status'.format(**vars())
+    flush_remote_batch()
+    sudo(command)
+
+def sudo_upload_dir_bulk(local_dir, remote_dir, owner=None, mode=None):
+    """
+    Does the same as :func:`sudo_upload_dir`, however the contents of
+    ``local_dir`` is uploaded as a single tar archive (see
+    :func:`create_tar_archive`), and unpacked into ``remote_dir`` by a single
+    sudo command that also applies ``owner`` and ``mode`` to the uploaded
+    files and directories (and to ``remote_dir`` if it is created). Files
+    already in ``remote_dir`` are not changed. This makes the number of SSH
+    round trips independent of the number of files (three: creating a
+    private staging directory, uploading the archive, and the sudo command).
+
+    Unlike :func:`sudo_upload_dir`, the files keep their local permissions
+    unless ``mode`` is given.
+    """
+    _sudo_upload_archive(local_dir, remote_dir, owner=owner, mode=mode)
+
+def compute_localfile_sha256sum(localfile):
+    """
+    Compute the hex-digested sha256 checksum of the given ``localfile``.
+    """
+    checksum = sha256()
+    with open(localfile, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+def get_local_manifest(local_dir):
+    """
+    Get a manifest of ``local_dir`` that can be compared with
+    :func:`get_remote_manifest` using :func:`diff_manifests`.
+
+    :return:
+        ``(files, dirs)`` where ``files`` is a dict mapping the
+        ``/``-separated path of each file relative to ``local_dir`` to its
+        size, and ``dirs`` is a set of the relative directory paths.
+        Checksums are computed on demand by :func:`diff_manifests`, and only
+        for files with the same size as the remote file.
+    """
+    files = {}
+    dirs = set()
+    for dirpath, dirnames, filenames in walk(local_dir):
+        for dirname in dirnames:
+            dirs.add(localpath_to_slashpath(relpath(join(dirpath, dirname), local_dir)))
+        for filename in filenames:
+            path = join(dirpath, filename)
+            files[localpath_to_slashpath(relpath(path, local_dir))] = getsize(path)
+    return files, dirs
+
+def get_remote_manifest(remote_dir):
+    """
+    Get a manifest of ``remote_dir`` using a single sudo command. Works with
+    GNU find and sha256sum.
+
+    :return:
+        ``(files, dirs)`` where ``files`` is a dict mapping the
+        ``/``-separated path of each file relative to ``remote_dir`` to
+        ``(size, sha256sum)``, and ``dirs`` is a set of the relative
+        directory paths. Both are empty if ``remote_dir`` does not exist.
+    """
+    command = ('if [ -d {remote_dir} ]; then cd {remote_dir} && '
+               "find . -mindepth 1 -type d -printf 'dir %p\\n' && "
+               "find . -type f -printf 'size %s %p\\n' && "
+               'find . -type f -print0 | xargs -0 -r sha256sum; fi').format(**vars())
+    flush_remote_batch()
+    with hide('stdout'):
+        output = sudo(command)
+    return parse_remote_manifest(output)
+
+def parse_remote_manifest(output):
+    """
+    Parse the output of the command used by :func:`get_remote_manifest`.
+    """
+    sizes = {}
+    checksums = {}
+    dirs = set()
+    for line in output.splitlines():
+        if line.startswith('dir ./'):
+            dirs.add(line[6:])
+        elif line.startswith('size '):
+            size, path = line[5:].split(' ', 1)
+            sizes[path[2:]] = int(size)
+        elif line.strip():
+            checksum, path = line.split('  ', 1)
+            checksums[path[2:]] = checksum
+    files = dict((path, (size, checksums.get(path))) for path, size in sizes.items())
+    return files, dirs
+
+def diff_manifests(local_dir, local_manifest, remote_manifest):
+    """
+    Compare the manifests returned by :func:`get_local_manifest` and
+    :func:`get_remote_manifest`.
+
+    :return:
+        ``(upload, delete_files, delete_dirs)``. ``upload`` is a list of the
+        new and changed files and the new directories in ``local_dir``.
+        ``delete_files`` and ``delete_dirs`` are lists of the remote files and
+        directories that do not exist in ``local_dir``.
+    """
+    local_files, local_dirs = local_manifest
+    remote_files, remote_dirs = remote_manifest
+    upload = sorted(local_dirs - remote_dirs)
+    for path, size in sorted(local_files.items()):
+        if path in remote_files:
+            remote_size, remote_checksum = remote_files[path]
+            if remote_size == size:
+                localfile = join(local_dir, slashpath_to_localpath(path))
+                if compute_localfile_sha256sum(localfile) == remote_checksum:
+                    continue
+        upload.append(path)
+    delete_files = sorted(set(remote_files) - set(local_files))
+    delete_dirs = sorted(remote_dirs - local_dirs)
+    return upload, delete_files, delete_dirs
+
+def sudo_upload_dir_incremental(local_dir, remote_dir, delete=False, owner=None, mode=None):
+    """
+    Does the same as :func:`sudo_upload_dir_bulk`, however only new and
+    changed files are uploaded. The remote files are compared with the local
+    files by size and sha256 checksum using a manifest retrieved with a single
+    command (see :func:`get_remote_manifest`). Does nothing more than
+    retrieving the manifest if no files have changed.
+
+    :param delete:
+        Delete remote files and directories that do not exist in
+        ``local_dir``. Defaults to ``False``.
+    :return:
+        ``(upload, delete_files, delete_dirs)`` as returned by
+        :func:`diff_manifests`. ``delete_files`` and ``delete_dirs`` are empty
+        unless ``delete`` is ``True``.
+    """
+    upload, delete_files, delete_dirs = diff_manifests(local_dir, get_local_manifest(local_dir),
+                                                       get_remote_manifest(remote_dir))
+    if not delete:
+        delete_files, delete_dirs = [], []
+    if upload or delete_files or delete_dirs:
+        _sudo_upload_archive(local_dir, remote_dir, names=upload, owner=owner, mode=mode,
+                             delete_files=delete_files, delete_dirs=delete_dirs)
+    return upload, delete_files, delete_dirs
+
 
 def parse_bool(data):
     """
@@ -246,6 +670,154 @@ def compute_localfile_md5sum(localfile):
     fp.close()
     return md5sum
 
+@contextmanager
+def thread_pool(workers):
+    """
+    Context manager that creates a pool of ``workers`` threads, and
+    terminates it on exit. Pass the pool to :func:`iter_parallel` to run many
+    rounds of work (E.g.: each poll in a wait-loop) in the same threads, so
+    per-thread state like the region connections from
+    :mod:`awsfabrictasks.connections` is reused between the rounds.
+
+    Yields ``None`` instead of a pool if ``workers`` is less than 2, which
+    makes :func:`iter_parallel` run the items in the calling thread.
+    """
+    if workers < 2:
+        yield None
+        return
+    pool = ThreadPool(workers)
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+
+def iter_parallel(function, items, workers=8, pool=None):
+    """
+    Run ``function(item)`` for each item in ``items`` in a pool of at most
+    ``workers`` threads, and yield ``(item, result, error)`` tuples as each
+    call completes. ``error`` is ``None`` if the call succeeded, and the
+    exception raised by ``function`` if it failed (``result`` is ``None`` in
+    that case). A failing item never stops the other items.
+
+    A single item (or any number of items with ``workers=1``) is run in the
+    calling thread, so the common single-region case does not start any
+    threads, and reuses the connections of the calling thread.
+
+    Example::
+
+        for region, reservations, error in iter_parallel(lookup, regions):
+            if error:
+                print('{0} failed: {1}'.format(region, error))
+
+    :param pool:
+        A pool from :func:`thread_pool` to run the calls in. ``workers`` is
+        ignored, and the pool is not terminated. Defaults to a new pool of
+        at most ``workers`` threads that is terminated when all the items
+        are done.
+    """
+    items = list(items)
+    if not items:
+        return
+
+    def call(item):
+        try:
+            return item, function(item), None
+        except Exception as e:
+            return item, None, e
+
+    if len(items) == 1 or (pool is None and workers < 2):
+        for item in items:
+            yield call(item)
+        return
+    if pool is not None:
+        for item, result, error in pool.imap_unordered(call, items):
+            yield item, result, error
+        return
+    with thread_pool(min(workers, len(items))) as pool:
+        for item, result, error in pool.imap_unordered(call, items):
+            yield item, result, error
+
+class LocalCommandResult(object):
+    """
+    The result of a command run with :func:`run_local_commands`.
+    """
+    def __init__(self, label, command, returncode, elapsed, error=None):
+        #: The label of the command (typically the host it works on).
+        self.label = label
+
+        #: The command.
+        self.command = command
+
+        #: The exit status of the command, or ``None`` if it could not be started.
+        self.returncode = returncode
+
+        #: Number of seconds the command used.
+        self.elapsed = elapsed
+
+        #: The exception raised if the command could not be started, or ``None``.
+        self.error = error
+
+    def succeeded(self):
+        return self.returncode == 0
+
+def _run_local_command(label, command, outputlock, stream):
+    start = time()
+    process = Popen(command, shell=True, stdout=PIPE, stderr=STDOUT)
+    for line in iter(process.stdout.readline, b''):
+        line = line.decode('utf-8', 'replace').rstrip('\r\n')
+        with outputlock:
+            stream.write('[{0}] {1}\n'.format(label, line))
+            stream.flush()
+    process.stdout.close()
+    returncode = process.wait()
+    return LocalCommandResult(label, command, returncode, time() - start)
+
+def run_local_commands(commands, workers=8, stream=None):
+    """
+    Run many shell commands on the local host concurrently, in at most
+    ``workers`` processes at a time. Each line of output (stdout and stderr)
+    is written to ``stream`` prefixed with ``[<label>]`` as soon as it is
+    produced.
+
+    :param commands: Iterable of ``(label, command)`` tuples.
+    :param workers: Maximum number of commands to run at the same time.
+    :param stream: Output stream. Defaults to ``sys.stdout``.
+    :return:
+        List of :class:`LocalCommandResult` objects, in the same order as
+        ``commands``. A failing command never stops the other commands.
+    """
+    stream = stream or sys.stdout
+    outputlock = Lock()
+    commands = list(commands)
+    results = {}
+    def run(index):
+        label, command = commands[index]
+        return _run_local_command(label, command, outputlock, stream)
+    for index, result, error in iter_parallel(run, range(len(commands)), workers=workers):
+        if error:
+            label, command = commands[index]
+            result = LocalCommandResult(label, command, None, 0, error=error)
+        results[index] = result
+    return [results[index] for index in range(len(commands))]
+
+def format_local_command_summary(results):
+    """
+    Format a summary of the results from :func:`run_local_commands` with one
+    line per command.
+    """
+    lines = []
+    for result in results:
+        if result.succeeded():
+            status = 'OK'
+        elif result.error:
+            status = 'FAILED ({0})'.format(result.error)
+        else:
+            status = 'FAILED (exit status {0})'.format(result.returncode)
+        lines.append('{0}: {1} in {2:.1f}s'.format(result.label, status, result.elapsed))
+    failed = len([result for result in results if not result.succeeded()])
+    lines.append('{0} succeeded, {1} failed.'.format(len(results) - failed, failed))
+    return '\n'.join(lines)
+
 def guess_contenttype(filename):
     """
     Return the content-type for the given ``filename``. Uses
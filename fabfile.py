@@ -1,4 +1,12 @@
-from fabric.api import local, task
+from __future__ import print_function
+
+from os import makedirs
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from fabric.api import local, task, sudo
 
 
 @task
@@ -7,3 +15,44 @@ def docs():
     Build the Trafo docs.
     """
     local('sphinx-build -b html docs/ build/docs')
+
+
+@task
+def benchmark_sudo_upload_dir(files=500, dirs=25, remote_dir='/tmp/awsfab-benchmark'):
+    """
+    Benchmark ``awsfabrictasks.utils.sudo_upload_dir`` with and without
+    ``bulk=True``. Run it against a local sshd, for example::
+
+        $ fab -H localhost benchmark_sudo_upload_dir:files=500
+
+    :param files: Number of files in the uploaded tree.
+    :param dirs: Number of directories the files are spread across.
+    :param remote_dir: Remote directory to upload into (removed afterwards).
+    """
+    from awsfabrictasks.utils import sudo_upload_dir
+    files, dirs = int(files), int(dirs)
+    local_dir = mkdtemp()
+    try:
+        for index in range(files):
+            dirpath = join(local_dir, 'dir{0}'.format(index % dirs))
+            try:
+                makedirs(dirpath)
+            except OSError:
+                pass
+            with open(join(dirpath, 'file{0}.conf'.format(index)), 'w') as outfile:
+                outfile.write('setting{0} = {0}\n'.format(index) * 20)
+        timings = []
+        for bulk in (False, True):
+            target = '{0}-{1}'.format(remote_dir, bulk and 'bulk' or 'perfile')
+            start = time()
+            sudo_upload_dir(local_dir, target, bulk=bulk, mode='u+rwX,go+rX')
+            timings.append((bulk, time() - start))
+            sudo('rm -rf {0}'.format(target))
+    finally:
+        rmtree(local_dir)
+
+    print()
+    print('sudo_upload_dir with {files} files in {dirs} directories:'.format(**vars()))
+    for bulk, elapsed in timings:
+        print('   bulk={0}: {1:.2f}s'.format(bulk, elapsed))
+    print('   speedup: {0:.1f}x'.format(timings[0][1] / max(timings[1][1], 0.001)))